@@ -0,0 +1,158 @@
+import os
+import sys
+import argparse
+import signal
+import math
+import asyncio
+
+# include the netbot src directory in sys.path so we can import modules from it.
+robotpath = os.path.dirname(os.path.abspath(__file__))
+srcpath = os.path.join(os.path.dirname(robotpath),"src")
+sys.path.insert(0,srcpath)
+
+from netbots_log import log
+from netbots_log import setLogLevel
+import netbots_ipc as nbipc
+
+robotName = "AsyncLight v1"
+
+
+async def play(botSocket, srvConf):
+    gameNumber = 0  # The last game number bot got from the server (0 == no game has been started)
+
+    # Async Lighthouse works like Lighthouse but it sends all its requests for a step at the same time
+    # with asyncio.gather(). All the replies come back in the same server step so it scans twice as
+    # much of the arena per step as Lighthouse does.
+
+    # scan the area in this many slices (think pizza slices with this bot in the middle)
+    scanSlices = 32
+
+    # Each scan will be this wide in radians (note, math.pi*2 radians is the same as 360 Degrees)
+    scanSliceWidth = math.pi * 2 / scanSlices
+
+    nextScanSlice = 0  # The slice the next scan will start at
+    fireRequest = None  # fireCanonRequest to send next step, if we found an enemy.
+
+    while True:
+        requests = [{'type': 'getInfoRequest'}]
+        if fireRequest:
+            requests.append(fireRequest)
+            fireRequest = None
+        else:
+            requests.append({'type': 'getCanonRequest'})
+            for scanSlice in range(2):
+                scanRadStart = ((nextScanSlice + scanSlice) % scanSlices) * scanSliceWidth
+                scanRadEnd = min(scanRadStart + scanSliceWidth, math.pi * 2)
+                requests.append({'type': 'scanRequest', 'startRadians': scanRadStart, 'endRadians': scanRadEnd})
+
+        # Send every request for this step at once. Errors are returned rather than raised
+        # so one Error reply (e.g. we died during the step) doesn't lose the other replies.
+        replies = await asyncio.gather(*[botSocket.sendRecvMessage(msg) for msg in requests], return_exceptions=True)
+
+        getInfoReply = replies[0]
+        if isinstance(getInfoReply, Exception):
+            # We are always allowed to make getInfoRequests, even if our health == 0. Something serious has gone wrong.
+            log(str(getInfoReply), "FAILURE")
+            log("Is netbot server still running?")
+            quit()
+
+        if getInfoReply['gameNumber'] != gameNumber:
+            # A new game has started. Record new gameNumber and reset any variables back to their initial state
+            gameNumber = getInfoReply['gameNumber']
+            log("Game " + str(gameNumber) + " has started. Points so far = " + str(getInfoReply['points']))
+            nextScanSlice = 0
+            fireRequest = None
+            continue
+
+        if getInfoReply['health'] == 0:
+            # we are dead, there is nothing we can do until we are alive again. Rather than asking over
+            # and over, have the server hold our request and reply when the next game starts.
+            try:
+                await botSocket.sendRecvMessage({'type': 'waitForGameRequest'}, retries=15, delay=1, delayMultiplier=1)
+            except nbipc.NetBotSocketException as e:
+                log(str(e), "WARNING")
+            continue
+
+        errors = [reply for reply in replies[1:] if isinstance(reply, Exception)]
+        if errors:
+            # Consider this a warning here. It may simply be that a request returned
+            # an Error reply because our health == 0 since we last checked. We can
+            # continue until the next game starts.
+            log(str(errors[0]), "WARNING")
+            continue
+
+        if requests[1]['type'] == 'getCanonRequest':
+            getCanonReply, scanReplies = replies[1], replies[2:]
+            for msg, scanReply in zip(requests[2:], scanReplies):
+                # if we found an enemy robot with our scan and we don't already have a shell in the air.
+                if scanReply['distance'] != 0 and not getCanonReply['shellInProgress']:
+                    # fire down the center of the slice we just scanned.
+                    fireRequest = {'type': 'fireCanonRequest', 'direction': msg['startRadians'] + scanSliceWidth / 2,
+                                   'distance': scanReply['distance']}
+                    break
+
+            nextScanSlice = (nextScanSlice + len(scanReplies)) % scanSlices
+
+##################################################################
+# Standard stuff below.
+##################################################################
+
+
+def quit(signal=None, frame=None):
+    global botSocket
+    log(botSocket.getStats())
+    log("Quiting", "INFO")
+    exit()
+
+
+async def joinAndPlay(args):
+    global botSocket  # This is global so quit() can print stats in botSocket
+    global robotName
+
+    try:
+        botSocket = nbipc.AsyncNetBotSocket(args.myIP, args.myPort, args.serverIP, args.serverPort)
+        joinRequest = {'type': 'joinRequest', 'name': robotName}
+        if args.struct:
+            joinRequest['codec'] = 'struct'
+        joinReply = await botSocket.sendRecvMessage(joinRequest, retries=300, delay=1, delayMultiplier=1)
+    except nbipc.NetBotSocketException as e:
+        log("Is netbot server running at" + args.serverIP + ":" + str(args.serverPort) + "?")
+        log(str(e), "FAILURE")
+        quit()
+
+    log("Join server was successful. We are ready to play!")
+
+    # the server configuration tells us all about how big the arena is and other useful stuff.
+    srvConf = joinReply['conf']
+    log(str(srvConf), "VERBOSE")
+
+    # Now we can play, but we may have to wait for a game to start.
+    await play(botSocket, srvConf)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-ip', metavar='My IP', dest='myIP', type=nbipc.argParseCheckIPFormat, nargs='?',
+                        default='127.0.0.1', help='My IP Address')
+    parser.add_argument('-p', metavar='My Port', dest='myPort', type=int, nargs='?',
+                        default=20010, help='My port number')
+    parser.add_argument('-sip', metavar='Server IP', dest='serverIP', type=nbipc.argParseCheckIPFormat, nargs='?',
+                        default='127.0.0.1', help='Server IP Address')
+    parser.add_argument('-sp', metavar='Server Port', dest='serverPort', type=int, nargs='?',
+                        default=20000, help='Server port number')
+    parser.add_argument('-struct', dest='struct', action='store_true',
+                        default=False, help='Ask the server to send the most frequent msgs with the compact struct codec. Servers without it drop the joinRequest.')
+    parser.add_argument('-debug', dest='debug', action='store_true',
+                        default=False, help='Print DEBUG level log messages.')
+    parser.add_argument('-verbose', dest='verbose', action='store_true',
+                        default=False, help='Print VERBOSE level log messages. Note, -debug includes -verbose.')
+    args = parser.parse_args()
+    setLogLevel(args.debug, args.verbose)
+
+    asyncio.run(joinAndPlay(args))
+
+
+if __name__ == "__main__":
+    # execute only if run as a script
+    signal.signal(signal.SIGINT, quit)
+    main()
@@ -25,7 +25,11 @@ def play(botSocket, srvConf):
     while True:
         try:
             # Get information to determine if bot is alive (health > 0) and if a new game has started.
-            getInfoReply = botSocket.sendRecvMessage({'type': 'getInfoRequest'})
+            # The server pushes it after every step (see subscribeRequest in main()). If it doesn't
+            # arrive (e.g. between games) then ask for it.
+            getInfoReply = botSocket.recvBotState()
+            if getInfoReply is None:
+                getInfoReply = botSocket.sendRecvMessage({'type': 'getInfoRequest'})
         except nbipc.NetBotSocketException as e:
             # We are always allowed to make getInfoRequests, even if our health == 0. Something serious has gone wrong.
             log(str(e), "FAILURE")
@@ -33,7 +37,12 @@ def play(botSocket, srvConf):
             quit()
 
         if getInfoReply['health'] == 0:
-            # we are dead, there is nothing we can do until we are alive again.
+            # we are dead, there is nothing we can do until we are alive again. Rather than asking over
+            # and over, have the server hold our request and reply when the next game starts.
+            try:
+                botSocket.sendRecvMessage({'type': 'waitForGameRequest'}, retries=15, delay=1, delayMultiplier=1)
+            except nbipc.NetBotSocketException as e:
+                log(str(e), "WARNING")
             continue
 
         if getInfoReply['gameNumber'] != gameNumber:
@@ -113,6 +122,10 @@ def main():
                         default='127.0.0.1', help='Server IP Address')
     parser.add_argument('-sp', metavar='Server Port', dest='serverPort', type=int, nargs='?',
                         default=20000, help='Server port number')
+    parser.add_argument('-shm', dest='shm', action='store_true',
+                        default=False, help='Use shared memory to talk to a server on this computer started with -shm.')
+    parser.add_argument('-struct', dest='struct', action='store_true',
+                        default=False, help='Ask the server to send the most frequent msgs with the compact struct codec. Servers without it drop the joinRequest.')
     parser.add_argument('-debug', dest='debug', action='store_true',
                         default=False, help='Print DEBUG level log messages.')
     parser.add_argument('-verbose', dest='verbose', action='store_true',
@@ -121,8 +134,16 @@ def main():
     setLogLevel(args.debug, args.verbose)
 
     try:
-        botSocket = nbipc.NetBotSocket(args.myIP, args.myPort, args.serverIP, args.serverPort)
-        joinReply = botSocket.sendRecvMessage({'type': 'joinRequest', 'name': robotName}, retries=300, delay=1, delayMultiplier=1)
+        if args.shm:
+            botSocket = nbipc.ShmNetBotSocket(args.myIP, args.myPort, args.serverIP, args.serverPort)
+        else:
+            botSocket = nbipc.NetBotSocket(args.myIP, args.myPort, args.serverIP, args.serverPort)
+        joinRequest = {'type': 'joinRequest', 'name': robotName}
+        if args.struct:
+            joinRequest['codec'] = 'struct'
+        joinReply = botSocket.sendRecvMessage(joinRequest, retries=300, delay=1, delayMultiplier=1)
+        # Ask the server to send our state after every step so we don't have to poll for it.
+        botSocket.sendRecvMessage({'type': 'subscribeRequest', 'everyNSteps': 1})
     except nbipc.NetBotSocketException as e:
         log("Is netbot server running at" + args.serverIP + ":" + str(args.serverPort) + "?")
         log(str(e), "FAILURE")
@@ -34,11 +34,16 @@ class Robot(threading.Thread):
         log(name + ": Running!")
 
         try:
-            botSocket = nbipc.NetBotSocket(ip, port, serverip, serverport)
+            if args.shm:
+                botSocket = nbipc.ShmNetBotSocket(ip, port, serverip, serverport)
+            else:
+                botSocket = nbipc.NetBotSocket(ip, port, serverip, serverport)
             self.botSocket = botSocket
 
-            joinReply = botSocket.sendRecvMessage(
-                {'type': 'joinRequest', 'name': name}, retries=300, delay=1, delayMultiplier=1)
+            joinRequest = {'type': 'joinRequest', 'name': name}
+            if args.struct:
+                joinRequest['codec'] = 'struct'
+            joinReply = botSocket.sendRecvMessage(joinRequest, retries=300, delay=1, delayMultiplier=1)
             self.srvConf = joinReply['conf']
 
         except nbipc.NetBotSocketException as e:
@@ -136,6 +141,7 @@ def quit(signal=None, frame=None):
 
 def main():
     global leader, follower  # This is global so quit() can access them.
+    global args  # This is global so Robot can use the command line options.
 
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-ip', metavar='My IP', dest='myIP', type=nbipc.argParseCheckIPFormat, nargs='?',
@@ -146,6 +152,10 @@ def main():
                         default='127.0.0.1', help='Server IP Address')
     parser.add_argument('-sp', metavar='Server Port', dest='serverPort', type=int, nargs='?',
                         default=20000, help='Server port number')
+    parser.add_argument('-shm', dest='shm', action='store_true',
+                        default=False, help='Use shared memory to talk to a server on this computer started with -shm.')
+    parser.add_argument('-struct', dest='struct', action='store_true',
+                        default=False, help='Ask the server to send the most frequent msgs with the compact struct codec. Servers without it drop the joinRequest.')
     parser.add_argument('-debug', dest='debug', action='store_true',
                         default=False, help='Print DEBUG level log messages.')
     parser.add_argument('-verbose', dest='verbose', action='store_true',
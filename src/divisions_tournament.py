@@ -18,9 +18,10 @@ sys.path.insert(0,srcpath)
 from netbots_log import log
 from netbots_log import setLogLevel
 from netbots_log import setLogFile
+import netbots_server as nbsrv
 
 # THE FOLLOWING CAN BE CHANGED AS NEEDED
-serverMax = 3  # Max number of netbots servers to run at once.
+serverMax = 3  # Max number of netbots servers to run at once (not used with -arenas).
 games = 1000  # Games in each tournament
 stepsec = 0.001  # Duration of each step in seconds
 stepmax = 5000  # Max steps in each game
@@ -29,11 +30,8 @@ stepmax = 5000  # Max steps in each game
 botsMax = 64 # Max bots in div tournament
 botsInDivision = 4  # This cannot be changed without significant changes to the code below.
 
-def rundivision(bots, divisionName, divisionDir, robotsDir, botkeys, serverPort):
-    global games, stepmax, stepsec
-
-    pythoncmd = ['python3']
-    srvoptions = [
+def srvcmdline(serverPort, jsonFile):
+    return ['python3',
         os.path.join('src','netbots_server.py'),
         '-p', str(serverPort),
         '-bots', str(botsInDivision), 
@@ -44,34 +42,27 @@ def rundivision(bots, divisionName, divisionDir, robotsDir, botkeys, serverPort)
         '-startperms',
         '-noviewers',
         '-onlylastsb',
-        '-jsonsb'
+        '-jsonsb', jsonFile
         ]
 
-    fd = []
-
-    log(str(divisionName) + ": " + "Starting Division")
-    os.mkdir(divisionDir)
-
-    f = open(os.path.join(divisionDir,"server.output.txt"), "w")
-    fd.append(f)
-    cmdline = pythoncmd + srvoptions + [os.path.join(divisionDir,"results.json")]
-    log(str(divisionName) + ": " + str(cmdline), "VERBOSE")
-    srvProc = subprocess.Popen(cmdline, stdout=f, stderr=subprocess.STDOUT)
 
+def startbots(bots, divisionName, divisionDir, robotsDir, botkeys, serverPort, fd):
     botProcs = []
     for botkey in botkeys:
         bot = bots[botkey]
         f = open(os.path.join(divisionDir, bot['file'] + ".output.txt"), "w")
         fd.append(f)
-        cmdline = pythoncmd + [os.path.join(robotsDir, bot['file']), '-p', str(bot['port']),'-sp', str(serverPort)]
+        cmdline = ['python3', os.path.join(robotsDir, bot['file']), '-p', str(bot['port']),'-sp', str(serverPort)]
         log(str(divisionName) + ": " + str(cmdline), "VERBOSE")
         p = subprocess.Popen(cmdline, stdout=f, stderr=subprocess.STDOUT)
         botProcs.append(p)
+    return botProcs
 
+
+def stopbots(divisionName, botProcs, srvProc, fd):
     time.sleep(2)
 
     #ensure all botProcs still running (make sure we did not have a startup problem.)
-    botDead = False
     for bot in botProcs:
         if bot.poll() != None:
             log(str(divisionName) + ": " + "A bot crashed shortly after being run. {}".format(bot.args), "ERROR")
@@ -97,8 +88,9 @@ def rundivision(bots, divisionName, divisionDir, robotsDir, botkeys, serverPort)
     for f in fd:
         f.flush()
         f.close()
-    fd = []
 
+
+def loadresults(divisionName, divisionDir, botkeys):
     # if results.json has been created then load results else log error.
     jsonFile = os.path.join(divisionDir,"results.json")
     if os.path.isfile(jsonFile):
@@ -124,10 +116,85 @@ def rundivision(bots, divisionName, divisionDir, robotsDir, botkeys, serverPort)
             botkeys[i] = missing.pop()
     else:
         log(str(divisionName) + ": " + "Server did not produce json file: " + jsonFile + ". Can't update results!", "ERROR")
-    
+
+
+def rundivision(bots, divisionName, divisionDir, robotsDir, botkeys, serverPort):
+    fd = []
+
+    log(str(divisionName) + ": " + "Starting Division")
+    os.mkdir(divisionDir)
+
+    f = open(os.path.join(divisionDir,"server.output.txt"), "w")
+    fd.append(f)
+    cmdline = srvcmdline(serverPort, os.path.join(divisionDir,"results.json"))
+    log(str(divisionName) + ": " + str(cmdline), "VERBOSE")
+    srvProc = subprocess.Popen(cmdline, stdout=f, stderr=subprocess.STDOUT)
+
+    botProcs = startbots(bots, divisionName, divisionDir, robotsDir, botkeys, serverPort, fd)
+    stopbots(divisionName, botProcs, srvProc, fd)
+    loadresults(divisionName, divisionDir, botkeys)
+
     log(str(divisionName) + ": " + "Completed Division")
 
 
+def rundivisions(bots, roundName, serverDir, divisionNames, divisionDirs, robotsDir, divisions, serverPort):
+    """
+    Run all divisions in one server with one arena per division (netbots_server.py -arenas).
+    Each division dir gets its bots output and results.json, the same as rundivision().
+    """
+    fd = []
+
+    log(str(roundName) + ": " + "Starting " + str(len(divisions)) + " Divisions as Arenas")
+
+    # Tell the server which arena (division) each bot goes in.
+    arenaMap = {}
+    for arena, botkeys in enumerate(divisions):
+        for botkey in botkeys:
+            arenaMap[botkey] = arena
+    arenaMapFile = os.path.join(serverDir, "arenamap.json")
+    with open(arenaMapFile, "w") as f:
+        json.dump(arenaMap, f)
+
+    f = open(os.path.join(serverDir, "server.output.txt"), "w")
+    fd.append(f)
+    cmdline = srvcmdline(serverPort, os.path.join(serverDir, "results.json")) + \
+        ['-arenas', str(len(divisions)), '-arenamap', arenaMapFile]
+    log(str(roundName) + ": " + str(cmdline), "VERBOSE")
+    srvProc = subprocess.Popen(cmdline, stdout=f, stderr=subprocess.STDOUT)
+
+    botProcs = []
+    for arena, botkeys in enumerate(divisions):
+        os.mkdir(divisionDirs[arena])
+        botProcs += startbots(bots, divisionNames[arena], divisionDirs[arena], robotsDir, botkeys, serverPort, fd)
+    stopbots(roundName, botProcs, srvProc, fd)
+
+    for arena, botkeys in enumerate(divisions):
+        # server saves each arena's results as results-<arena>.json
+        jsonFile = os.path.join(serverDir, "results-" + str(arena) + ".json")
+        if os.path.isfile(jsonFile):
+            os.replace(jsonFile, os.path.join(divisionDirs[arena], "results.json"))
+        loadresults(divisionNames[arena], divisionDirs[arena], botkeys)
+
+    log(str(roundName) + ": " + "Completed " + str(len(divisions)) + " Divisions as Arenas")
+
+
+def rundivisionthreads(bots, divisionNames, divisionDirs, robotsDir, divisions):
+    serverPort = 20000
+    for divisionNumber in range(len(divisions)):
+        # if serverMax server threads are already running then wait for one to finish
+        while threading.active_count() - 1 == serverMax:
+            time.sleep(1)
+        # Start running a new division
+        t = threading.Thread(target=rundivision, 
+            args=(bots, divisionNames[divisionNumber], divisionDirs[divisionNumber], robotsDir, divisions[divisionNumber], serverPort), 
+            daemon=True)
+        t.start()
+        serverPort += 1
+    # Wait for all threads to finish.
+    while threading.active_count() > 1:
+        time.sleep(1)
+
+
 def quit(signal=None, frame=None):
     log("Quiting","INFO")
     exit()
@@ -143,6 +210,7 @@ def main():
                         required=True, help='Full directory path to send output. Directory should exist and be empty. (eg. /tmp/tournament.2020-50-02-11:37:23)')
     parser.add_argument('-copy', dest='copy', action='store_true', default=False, help='Copy robots dir to output dir.')
     parser.add_argument('-md5sum', dest='md5sum', action='store_true', default=False, help='Print MD5sum for each robot.')
+    parser.add_argument('-arenas', dest='arenas', action='store_true', default=False, help='Run all divisions of a round in one server with an arena per division, rather than a server per division (serverMax at a time).')
     parser.add_argument('-debug', dest='debug', action='store_true', default=False, help='Print DEBUG level log messages.')
     parser.add_argument('-verbose', dest='verbose', action='store_true', default=False, help='Print VERBOSE level log messages. Note, -debug includes -verbose.')
     
@@ -231,22 +299,17 @@ def main():
                     divisions[divisionNumber+1][1]
                    ])
 
-            serverPort = 20000
+            divisionDirs = []
+            divisionNames = []
             for divisionNumber in range(divisionsTotal-1):
-                # if serverMax server threads are already running then wait for one to finish
-                while threading.active_count() - 1 == serverMax:
-                    time.sleep(1)
-                # Start running a new division
-                divisionDir = os.path.join(roundDir, "crossdivision-" + str(divisionNumber) + "x" + str(divisionNumber+1))
-                divisionName = "R" + str(round) + "D" + str(divisionNumber) + "x" + str(divisionNumber+1)
-                t = threading.Thread(target=rundivision, 
-                    args=(bots, divisionName, divisionDir, robotsDir, crossDivisions[divisionNumber], serverPort), 
-                    daemon=True)
-                t.start()
-                serverPort += 1
-            # Wait for all threads to finish.
-            while threading.active_count() > 1:
-                time.sleep(1)
+                divisionDirs.append(os.path.join(roundDir, "crossdivision-" + str(divisionNumber) + "x" + str(divisionNumber+1)))
+                divisionNames.append("R" + str(round) + "D" + str(divisionNumber) + "x" + str(divisionNumber+1))
+            if args.arenas:
+                serverDir = os.path.join(roundDir, "crossdivisions")
+                os.mkdir(serverDir)
+                rundivisions(bots, "R" + str(round) + "X", serverDir, divisionNames, divisionDirs, robotsDir, crossDivisions, 20000)
+            else:
+                rundivisionthreads(bots, divisionNames, divisionDirs, robotsDir, crossDivisions)
 
             for b in range(divisionsTotal-1):
                 # !!! ASSUMES botsInDivition == 4
@@ -258,22 +321,17 @@ def main():
                 divisions[b+1][1] = crossDivisions[b][3]
 
         # Run each division and put robots in division in order of points.
-        serverPort = 20000
+        divisionDirs = []
+        divisionNames = []
         for divisionNumber in range(divisionsTotal):
-            # if serverMax server threads are already running then wait for one to finish
-            while threading.active_count() - 1 == serverMax:
-                time.sleep(1)
-            # Start running a new division
-            divisionDir = os.path.join(roundDir, "division-" + str(divisionNumber))
-            divisionName = "R" + str(round) + "D" + str(divisionNumber)
-            t = threading.Thread(target=rundivision, 
-                args=(bots, divisionName, divisionDir, robotsDir, divisions[divisionNumber], serverPort), 
-                daemon=True)
-            t.start()
-            serverPort += 1
-        # Wait for all threads to finish.
-        while threading.active_count() > 1:
-            time.sleep(1)
+            divisionDirs.append(os.path.join(roundDir, "division-" + str(divisionNumber)))
+            divisionNames.append("R" + str(round) + "D" + str(divisionNumber))
+        if args.arenas:
+            serverDir = os.path.join(roundDir, "divisions")
+            os.mkdir(serverDir)
+            rundivisions(bots, "R" + str(round), serverDir, divisionNames, divisionDirs, robotsDir, divisions, 20000)
+        else:
+            rundivisionthreads(bots, divisionNames, divisionDirs, robotsDir, divisions)
 
         # Output Results
         output = "\n" + \
@@ -285,10 +343,17 @@ def main():
 
         for divisionNumber in range(divisionsTotal):
             output += "DIVISION " + str(divisionNumber)
-            roundoutput = os.path.join(roundDir, "division-" + str(divisionNumber), "server.output.txt")
-            p = subprocess.Popen(["grep", "-m1", "-A", str(botsInDivision), "\------------------", roundoutput], stdout=subprocess.PIPE, stderr=sys.stdout.buffer)
-            tmp = p.stdout.read().decode("utf-8")
-            output += re.sub(r'---*','',tmp)
+            jsonFile = os.path.join(divisionDirs[divisionNumber], "results.json")
+            if args.arenas and os.path.isfile(jsonFile):
+                # all arenas share one server output so make the scoreboard lines from the division's results.
+                with open(jsonFile) as json_file:
+                    results = json.load(json_file)
+                output += nbsrv.scoreboardRows(results['bots'], results['state']['serverSteps']) + "\n"
+            else:
+                roundoutput = os.path.join(roundDir, "division-" + str(divisionNumber), "server.output.txt")
+                p = subprocess.Popen(["grep", "-m1", "-A", str(botsInDivision), "\------------------", roundoutput], stdout=subprocess.PIPE, stderr=sys.stdout.buffer)
+                tmp = p.stdout.read().decode("utf-8")
+                output += re.sub(r'---*','',tmp)
             output += "\n"
 
         with open(resultsfilename,"a+") as f: 
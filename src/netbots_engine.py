@@ -0,0 +1,166 @@
+from netbots_log import log
+import netbots_ipc as nbipc
+import netbots_server as nbsrv
+
+"""
+In-process NetBots arena for training and bulk evaluation of robot logic.
+
+Arena runs the same simulation code as netbots_server.py (step() and the netbots_srvmsghl
+handlers) but robots are python callables in the same process. There are no sockets, no
+msgpack and no stepSec pacing, so games run as fast as the CPU allows.
+
+A robot is either a callable or an object with a play() method. It is called once per step as:
+
+    requests = robot(replies)
+
+replies is the list of reply messages to the requests the robot returned last time, in the
+same order (the first call gets the joinReply). requests is a list of request messages, exactly
+as they would be passed to NetBotSocket.sendRecvMessage(). The server only answers
+botMsgsPerStep msgs per step, requests over that budget are dropped without a reply. Messages
+are never dropped at random (dropRate is not used).
+
+A waitForGameRequest that the server holds keeps its place in replies. The robot is not called
+again until the server answers it, just as sendRecvMessage() would block. A robot that sent a
+subscribeRequest gets its botState msgs after the replies.
+
+For example:
+
+    def sitAndSpin(replies):
+        return [{'type': 'setDirectionRequest', 'requestedDirection': random.random() * math.pi * 2},
+                {'type': 'fireCanonRequest', 'direction': random.random() * math.pi * 2, 'distance': 200}]
+
+    arena = Arena(seed=1)
+    arena.addRobot("Spinner 1", sitAndSpin)
+    arena.addRobot("Spinner 2", sitAndSpin)
+    for bot in arena.run(games=10).values():
+        print(bot['name'], bot['points'])
+"""
+
+
+# Msg types that may use more than one of a bot's botMsgsPerStep, see netbots_server.getMsgCost()
+costlyMsgTypes = frozenset(('multiScanRequest', 'batchRequest'))
+
+
+class Arena:
+
+    def __init__(self, conf=None, obstacles=0, jamZones=0, seed=None, backend='python', validate=True):
+        """
+        conf is a dict of SrvData.conf values to change, e.g. {'arenaSize': 2000, 'allowClasses': True}.
+        obstacles and jamZones are how many of each to lay out. If seed is not None the layout of
+        obstacles, jam zones and start locations is the same each time.
+        If validate is True each request is checked with nbipc.isValidMsg() as a server would.
+        """
+        d = self.d = nbsrv.SrvData()
+        d.conf['dropRate'] = 0
+        d.conf['noViewers'] = True
+        if conf:
+            d.conf.update(conf)
+        d.state['backend'] = backend
+
+        d.random.seed(seed)
+        d.conf['obstacles'] = nbsrv.mkObstacles(d, obstacles)
+        d.conf['jamZones'] = nbsrv.mkJamZones(d, jamZones)
+
+        self.validate = validate
+        self.robots = {}  # {src: play function}
+        self.replies = {}  # {src: [reply, ...]} replies to give to robot next time it plays
+
+    def addRobot(self, name, robot, robotClass=None):
+        """
+        Add robot to arena. robot is a callable or an object with a play() method (see above).
+        Returns the src (pretend ip:port) the arena uses for this robot, which is also its key in
+        the bots returned by run().
+        """
+        d = self.d
+        src = "arena:" + str(len(self.robots) + 1)
+        d.conf['botsInGame'] = len(self.robots) + 1
+
+        msg = {'type': 'joinRequest', 'name': name}
+        if robotClass:
+            msg['class'] = robotClass
+        reply = nbsrv.processMsg(d, msg, src)
+        if reply['type'] == 'Error':
+            raise Exception("Robot " + name + " could not join arena: " + reply['result'])
+
+        self.robots[src] = robot.play if hasattr(robot, 'play') else robot
+        self.replies[src] = [reply]
+        return src
+
+    def playRobots(self):
+        """ Give each robot its replies and process the requests it returns. """
+        d = self.d
+        botMsgCount = {}
+        validate = self.validate
+        msgsPerStep = d.conf['botMsgsPerStep']
+        # local names are faster to look up in the loop below.
+        isValidMsg = nbipc.isValidMsg
+        processMsg = nbsrv.processMsg
+        for src, play in self.robots.items():
+            if src in d.waitingBots:
+                continue  # robot is blocked on a held waitForGameRequest.
+            requests = play(self.replies[src])
+            replies = self.replies[src] = []
+            if not requests:
+                continue
+
+            count = 0
+            for msg in requests:
+                reply = None
+                cost = 1
+                if validate and not isValidMsg(msg):
+                    reply = {'type': 'Error', 'result': "Msg is not valid: " + str(msg)}
+                elif msg['type'] in costlyMsgTypes:
+                    cost = nbsrv.getMsgCost(d, msg)
+                    if cost > msgsPerStep:
+                        # would never fit in a step, see netbots_server.recvReplyMsgs()
+                        reply = nbsrv.msgCostError(d, msg, cost)
+                        cost = 1
+                count += cost
+                if count > msgsPerStep:
+                    break
+                if reply is None:
+                    reply = processMsg(d, msg, src)
+                # reply is None for a held waitForGameRequest, see answerWaitingBots().
+                replies.append(reply)
+            botMsgCount[src] = count
+
+        nbsrv.countMissedSteps(d, botMsgCount)
+
+    def sendBotStates(self):
+        """ Put the botState msgs due after this step after the replies of robots that subscribed. """
+        for src, botState in nbsrv.sendBotStates(self.d).items():
+            self.replies[src].append(botState)
+
+    def answerWaitingBots(self):
+        """ Put the server's replies to held waitForGameRequests in the place kept for them. """
+        for src, reply in nbsrv.answerWaitingBots(self.d).items():
+            replies = self.replies[src]
+            for i in range(len(replies)):
+                if replies[i] is None:
+                    replies[i] = reply
+
+    def run(self, games=1):
+        """ Play games and return the bots dict, {src: bot, ...}, with points, winCount, etc. """
+        d = self.d
+        if len(self.robots) < 2:
+            raise Exception("Arena needs at least 2 robots to play.")
+
+        # make start locations for just the games in this run then set gamesToPlay to the total.
+        d.conf['gamesToPlay'] = games
+        nbsrv.mkStartLocations(d)
+        d.conf['gamesToPlay'] = d.state['gameNumber'] + games
+
+        while True:
+            if any(bot['health'] != 0 for bot in d.bots.values()):
+                nbsrv.step(d)
+                self.sendBotStates()
+            elif d.state['gameNumber'] < d.conf['gamesToPlay']:
+                nbsrv.initGame(d)
+            else:
+                break
+            self.answerWaitingBots()
+            self.playRobots()
+
+        d.syncBots()
+        log("Arena played " + str(games) + " games, " + str(d.state['serverSteps']) + " steps in total.", "VERBOSE")
+        return d.bots
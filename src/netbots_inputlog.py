@@ -0,0 +1,69 @@
+import struct
+import zlib
+
+import netbots_ipc as nbipc
+
+############################################################
+# Input log for deterministic re-simulation (server -inputlog option).
+#
+# A game only depends on the server's starting layout and on the
+# bot msgs the server accepted, and in what order relative to the
+# steps. The input log records just those, so netbots_replay.py can
+# re-run a tournament through step() and the netbots_srvmsghl
+# handlers without any robots or network.
+#
+# The file is a sequence of records. Each record is a 4 byte big
+# endian length followed by a msgpack list:
+#
+# [HEADER, {'conf': conf, 'starts': [...], 'startLocs': [...], 'seed': int or None, 'backend': str}]
+# [MSG, src, msg]                 msg accepted and processed by server
+# [INITGAME]                      initGame() was called
+# [STEP, stateHash]               step() was called, stateHash is after step
+# [BOTSINGAME, int]               server changed conf['botsInGame'] (maxSecsToJoin)
+#############################################################
+
+HEADER = 'h'
+MSG = 'm'
+INITGAME = 'i'
+STEP = 's'
+BOTSINGAME = 'b'
+
+
+def openInputLog(filename):
+    """ Return file for writing an input log to filename. """
+    return open(filename, 'wb')
+
+
+def writeRecord(f, record):
+    """ Append record (a list) to input log file f. """
+    b = nbipc.serialize(record)
+    f.write(struct.pack('>I', len(b)))
+    f.write(b)
+
+
+def readRecords(f):
+    """ Yield each record in input log file f. """
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            return
+        length = struct.unpack('>I', header)[0]
+        yield nbipc.deserialize(f.read(length))
+
+
+def stateHash(d):
+    """
+    Return crc32 of the game state that step() changes. Bot fields that depend on timing
+    (e.g. missedSteps) are left out and numbers are hashed as floats so 0 and 0.0 hash the same.
+    """
+    d.syncBots()
+    state = [d.state['gameNumber'], d.state['gameStep']]
+    for src, bot in d.bots.items():
+        state.append(src)
+        state.extend(float(bot[fld]) for fld in ('x', 'y', 'health', 'currentSpeed', 'requestedSpeed',
+                                                  'currentDirection', 'requestedDirection', 'points', 'shellDamage'))
+    for src, shell in d.shells.items():
+        state.append(src)
+        state.extend(float(shell[fld]) for fld in ('x', 'y', 'direction', 'distanceRemaining'))
+    state.append(len(d.explosions))
+    return zlib.crc32(nbipc.serialize(state))
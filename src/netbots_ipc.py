@@ -1,17 +1,29 @@
 import socket
+import select
+import asyncio
+import struct
 import random
 import time
 import re
 import math
 import argparse
+import bisect
+import os
+import atexit
+import ipaddress
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
 
 from netbots_log import log
+from netbots_log import logEnabled
 
 try:
     import msgpack as umsgpack
+    binaryMsgpack = True
     log("Using binary python msgpack.")
 except:
     import umsgpack
+    binaryMsgpack = False
     log("Using pure python msgpack. Install binary msgpack for better performance.", "WARNING")
 
 """
@@ -35,14 +47,19 @@ All fields have a defined type in the form of <type> or [<type>,min,max].
 <type> can be expressed as multiple acceptable types as (<type>,<type>,...)
 
 For fields types of 'str' min and max are the min length and max length of the string.
+For fields types of 'list' min and max are the min length and max length of the list.
 
 All Request messages have a corresponding Reply message. The Request is sent to the
 server and the server returns the reply message or an Error message.
+
+MsgDef is compiled into MsgValidators when this module is imported, so isValidMsg()
+does not see changes made to MsgDef after that.
 """
 MsgDef = {
     # msg type              other required msg fields
-    'joinRequest': {'name': ['str', 1, 16], 'class_o': ['str', 1, 16]},
-    'joinReply': {'conf': 'dict'},
+    'joinRequest': {'name': ['str', 1, 16], 'class_o': ['str', 1, 16], 'arena_o': ['int', 0, 255], 'codec_o': ['str', 1, 16],
+                    'shm_o': ['str', 1, 64]},
+    'joinReply': {'conf': 'dict', 'codec_o': ['str', 1, 16], 'shm_o': ['str', 1, 64]},
 
     'getInfoRequest': {},
     'getInfoReply': {'gameNumber': 'int', 'gameStep': 'int', 'health': ['(int,float)', 0, 100], 'points': 'int'},
@@ -71,21 +88,217 @@ MsgDef = {
     'scanRequest': {'startRadians': ['(int,float)', 0, math.pi * 2], 'endRadians': ['(int,float)', 0, math.pi * 2]},
     'scanReply': {'distance': ['(int,float)', 0, 32767]},
 
-    'addViewerRequest': {},
+    # slices is a list of [startRadians, endRadians] pairs. distances has one distance per slice.
+    'multiScanRequest': {'slices': ['list', 1, 16]},
+    'multiScanReply': {'distances': ['list', 1, 16]},
+
+    # requests is a list of request msgs. replies has one reply or Error msg per request, in the same order.
+    'batchRequest': {'requests': ['list', 1, 16]},
+    'batchReply': {'replies': ['list', 1, 16]},
+
+    # everyNSteps is how often the server pushes a botState msg to the bot, e.g. 1 is after every step. 0 stops them.
+    'subscribeRequest': {'everyNSteps': ['int', 0, 1000]},
+    'subscribeReply': {},
+
+    # The server does not reply until the bot is alive in a game or maxSecs (default 10) have passed.
+    'waitForGameRequest': {'maxSecs_o': ['(int,float)', 0, 60]},
+    'waitForGameReply': {'gameNumber': 'int'},
+
+    # version 2 asks for viewFrame msgs rather than viewData (see netbots_viewdata.py). The viewer is sent a frame at
+    # most every everyNSteps steps (default 1) and at most maxFps frames per sec (default no limit).
+    'addViewerRequest': {'arena_o': ['int', 0, 255], 'version_o': ['int', 1, 2],
+                         'everyNSteps_o': ['int', 1, 100000], 'maxFps_o': ['(int,float)', 0.1, 1000]},
     'addViewerReply': {'conf': 'dict'},
 
     # The msg types below do not have, nor expect, a matching reply
+    'botState': {'gameNumber': 'int', 'gameStep': 'int', 'health': ['(int,float)', 0, 100], 'points': 'int',
+                 'x': ['(int,float)', 0, 32767], 'y': ['(int,float)', 0, 32767],
+                 'requestedSpeed': ['(int,float)', 0, 100], 'currentSpeed': ['(int,float)', 0, 100],
+                 'requestedDirection': ['(int,float)', 0, math.pi * 2], 'currentDirection': ['(int,float)', 0, math.pi * 2],
+                 'shellInProgress': 'bool'},
     'viewData': {'state': 'dict', 'bots': 'dict', 'shells': 'dict', 'explosions': 'dict'},
+    'viewFrame': {'frame': 'int', 'keyframe': 'bool', 'gameNumber': 'int', 'gameStep': 'int', 'bots': 'dict',
+                  'shells': 'dict', 'explosions': 'dict', 'goneBots': 'list', 'goneExplosions': 'list'},
     'viewKeepAlive': {},
-    'Error': {'result': 'str'}
+    # retryAfter is how many secs a dead bot should wait before sending again.
+    'Error': {'result': 'str', 'retryAfter_o': ['(int,float)', 0, 3600]}
 }
 
 
-def isValidMsg(msg):
-    """ Returns True if msg is a valid message, otherwise returns false. """
+"""
+**Struct Codec**
+
+The most frequent messages can also be sent in a fixed binary layout rather than as a
+msgpack map. Each one is a marker byte (0xC1, which msgpack never uses), a msg type code
+byte and the msgID as an unsigned short, followed by the msg fields in the order given in
+StructDef below. Numbers that can be floats are sent as doubles so no precision is lost.
+
+deserialize() reads both formats. A robot asks for the struct codec by adding
+'codec': 'struct' to its joinRequest. If the server supports it the joinReply has
+'codec': 'struct' and from then on NetBotSocket sends StructDef msgs to and from that
+robot in the struct layout. Msgs without a msgID, with replyData or with values that do
+not fit the layout are still sent with msgpack.
+"""
+StructDef = {
+    # msg type              (code, format of fields, field names)
+    'getInfoRequest': (1, '', ()),
+    'getInfoReply': (2, 'IIdi', ('gameNumber', 'gameStep', 'health', 'points')),
+    'getLocationRequest': (3, '', ()),
+    'getLocationReply': (4, 'dd', ('x', 'y')),
+    'getSpeedRequest': (5, '', ()),
+    'getSpeedReply': (6, 'dd', ('requestedSpeed', 'currentSpeed')),
+    'setSpeedRequest': (7, 'd', ('requestedSpeed',)),
+    'setSpeedReply': (8, '', ()),
+    'getDirectionRequest': (9, '', ()),
+    'getDirectionReply': (10, 'dd', ('requestedDirection', 'currentDirection')),
+    'setDirectionRequest': (11, 'd', ('requestedDirection',)),
+    'setDirectionReply': (12, '', ()),
+    'fireCanonRequest': (13, 'dd', ('direction', 'distance')),
+    'fireCanonReply': (14, '', ()),
+    'scanRequest': (15, 'dd', ('startRadians', 'endRadians')),
+    'scanReply': (16, 'd', ('distance',)),
+}
+
+STRUCT_MARKER = 0xC1
+
+# {msg type: (code, struct.Struct, field names), ...} and {code: (msg type, struct.Struct, field names), ...}
+structEncoders = {}
+structDecoders = {}
+for msgtype, (code, fmt, names) in StructDef.items():
+    structEncoders[msgtype] = (code, struct.Struct('<BBH' + fmt), names)
+    structDecoders[code] = (msgtype, structEncoders[msgtype][1], names)
+
+
+def serialize(msg):
+    """ Return msg converted from python objects to network binary format. """
+    return umsgpack.packb(msg, use_bin_type=True)
+
+
+def serializeStruct(msg):
+    """ Return msg in the struct codec layout, or None if msg can't be sent that way (see StructDef). """
+    try:
+        code, layout, names = structEncoders[msg['type']]
+        msgID = msg['msgID']
+        if len(msg) != len(names) + 2:
+            return None  # msg has replyData or other fields the layout can't hold.
+        return layout.pack(STRUCT_MARKER, code, msgID, *[msg[fld] for fld in names])
+    except (KeyError, TypeError, struct.error):
+        return None
+
+
+def deserialize(b):
+    """ Return python objects from network binary format b. """
+    if b and b[0] == STRUCT_MARKER:
+        msgtype, layout, names = structDecoders[b[1]]
+        values = layout.unpack(b)
+        msg = dict(zip(names, values[3:]))
+        msg['type'] = msgtype
+        msg['msgID'] = values[2]
+        return msg
+    # Allow integer keys in incoming msgpack maps to match server behavior
+    return umsgpack.unpackb(b, raw=False, strict_map_key=False)
+
+
+# Python types that may be named in MsgDef field specs.
+fieldTypes = {'int': int, 'float': float, 'bool': bool, 'str': str, 'list': list, 'tuple': tuple, 'dict': dict}
+
+
+def compileMsgSpec(msgtype, msgspec):
+    """
+    Return a function that checks a msg of type msgtype against msgspec (see MsgDef). Type names
+    and optional field names are resolved here, once, so checking a msg is just a few lookups.
+    """
+    fields = []  # [(fld, optional, typeName, types, lengthCheck, min, max), ...]
+    for fld, fldspec in msgspec.items():
+        optional = fld.endswith('_o')
+        if optional:
+            # remove magic suffix marking field as optional
+            fld = fld[:-2]
+        if isinstance(fldspec, list):
+            typeName, low, high = fldspec
+        else:
+            typeName, low, high = fldspec, None, None
+        types = tuple(fieldTypes[t] for t in typeName.strip('()').split(','))
+        fields.append((fld, optional, typeName, types, typeName == 'str' or typeName == 'list', low, high))
+
+    # msgId and replyData are always optional and have no specific format. So they are always valid if present.
+    knownFields = frozenset([f[0] for f in fields] + ['type', 'msgID', 'replyData'])
+
+    def isValid(msg):
+        for fld, optional, typeName, types, lengthCheck, low, high in fields:
+            if fld not in msg:
+                if optional:
+                    # optional field is not present, which is valid.
+                    continue
+                log("Msg does not contain required '" + fld + "' key: " + str(msg), "ERROR")
+                return False
+            value = msg[fld]
+            if not isinstance(value, types):
+                log("Msg '" + fld + "' key has value of type " + str(type(value)) +
+                    " but expected " + typeName + ": " + str(msg), "ERROR")
+                return False
+            if low is None:
+                continue
+            if lengthCheck:
+                if len(value) < low or len(value) > high:
+                    log("Msg '" + fld + "' key has a " + typeName + " value " + str(value) +
+                        " with length out of range [" + str(low) + "," + str(high) + "] : " + str(msg), "ERROR")
+                    return False
+            elif value < low or value > high:
+                log("Msg '" + fld + "' key has a value " + str(value) +
+                    " which is out of range [" + str(low) + "," + str(high) + "] : " + str(msg), "ERROR")
+                return False
+
+        if not knownFields.issuperset(msg):
+            # message has fields it should not have.
+            unvalidedFields = [fld for fld in msg if fld not in knownFields]
+            log("Msg contains field(s) " + str(unvalidedFields) + " which is not defined for message type " +
+                msgtype + ": " + str(msg), "ERROR")
+            for fld in unvalidedFields:
+                if fld.endswith('_o'):
+                    log("Optional message fields should not include '_o' suffix in field name.", "WARNING")
+                    break
+            return False
+
+        # message is valid and has no extra fields.
+        return True
+
+    return isValid
+
+
+# {msgtype: function, ...} compiled from MsgDef by compileMsgSpec()
+MsgValidators = {msgtype: compileMsgSpec(msgtype, msgspec) for msgtype, msgspec in MsgDef.items()}
+
+# Msg types that may be sent inside a batchRequest and batchReply.
+batchRequestTypes = frozenset(t for t in MsgDef if t.endswith('Request')) - \
+    {'joinRequest', 'addViewerRequest', 'batchRequest', 'waitForGameRequest'}
+batchReplyTypes = frozenset(t[:-7] + 'Reply' for t in batchRequestTypes) | {'Error'}
 
-    global MsgDef
 
+def compileBatchSpec(msgtype, fld, subTypes):
+    """ Return a function that checks a batch msg and every msg in its fld list, which must be one of subTypes. """
+    isValidBatch = MsgValidators[msgtype]
+
+    def isValid(msg):
+        if not isValidBatch(msg):
+            return False
+        for subMsg in msg[fld]:
+            if not isValidMsg(subMsg):
+                return False
+            if subMsg['type'] not in subTypes:
+                log("Msg of type " + subMsg['type'] + " can't be sent in a " + msgtype + ": " + str(msg), "ERROR")
+                return False
+        return True
+
+    return isValid
+
+
+MsgValidators['batchRequest'] = compileBatchSpec('batchRequest', 'requests', batchRequestTypes)
+MsgValidators['batchReply'] = compileBatchSpec('batchReply', 'replies', batchReplyTypes)
+
+
+def isValidMsg(msg):
+    """ Returns True if msg is a valid message, otherwise returns false. """
     if not isinstance(msg, dict):
         log("Msg is type " + str(type(msg)) + " but must be dict type: " + str(msg), "ERROR")
         return False
@@ -93,63 +306,12 @@ def isValidMsg(msg):
         log("Msg does not contain 'type' key: " + str(msg), "ERROR")
         return False
 
-    unvalidedFields = list(msg.keys())
-    # type is validated below as part of loop so does not need specific validation.
-    unvalidedFields.remove('type')
-    # msgId and replyData are always optional and have no specific format. So they are always valid if present.
-    if 'msgID' in unvalidedFields:
-        unvalidedFields.remove('msgID')
-    if 'replyData' in unvalidedFields:
-        unvalidedFields.remove('replyData')
-
-    for msgtype, msgspec in MsgDef.items():
-        if msgtype == msg['type']:
-            for fld, fldspec in msgspec.items():
-                if fld.endswith('_o'):
-                    # remove magic suffix marking field as optional
-                    fld = fld.rstrip('_o')
-                    if fld not in msg:
-                        # optional field is not present, which is valid.
-                        continue
-                elif fld not in msg:
-                    log("Msg does not contain required '" + fld + "' key: " + str(msg), "ERROR")
-                    return False
-                if isinstance(fldspec, list):
-                    if not isinstance(msg[fld], eval(fldspec[0])):
-                        log("Msg '" + fld + "' key has value of type " + str(type(msg[fld])) +
-                            " but expected " + fldspec[0] + ": " + str(msg), "ERROR")
-                        return False
-                    if fldspec[0] is 'str':
-                        if len(msg[fld]) < fldspec[1] or len(msg[fld]) > fldspec[2]:
-                            log("Msg '" + fld + "' key has a string value " + str(msg[fld]) +
-                                " with length out of range [" + str(fldspec[1]) + "," +
-                                str(fldspec[2]) + "] : " + str(msg), "ERROR")
-                            return False
-                    elif msg[fld] < fldspec[1] or msg[fld] > fldspec[2]:
-                        log("Msg '" + fld + "' key has a value " + str(msg[fld]) +
-                            " which is out of range [" + str(fldspec[1]) + "," +
-                            str(fldspec[2]) + "] : " + str(msg), "ERROR")
-                        return False
-                else:
-                    if not isinstance(msg[fld], eval(fldspec)):
-                        log("Msg '" + fld + "' key has value of type " + str(type(msg[fld])) +
-                            " but expected " + fldspec + ": " + str(msg), "ERROR")
-                        return False
-                unvalidedFields.remove(fld)
-            # All fields defined for message type have now been examined and are valid
-            if len(unvalidedFields):
-                # message has fields it should not have.
-                log("Msg contains field(s) " + str(unvalidedFields) + " which is not defined for message type " + msg['type'] + ": " + str(msg), "ERROR")
-                for fld in unvalidedFields:
-                    if fld.endswith('_o'):
-                        log("Optional message fields should not include '_o' suffix in field name.", "WARNING")
-                        break
-                return False
-            else:
-                # message is valid and has no extra fields.
-                return True
-    log("Msg 'type' key has value '" + str(msg['type']) + "' which is not known: " + str(msg), "ERROR")
-    return False
+    try:
+        isValid = MsgValidators[msg['type']]
+    except (KeyError, TypeError):
+        log("Msg 'type' key has value '" + str(msg['type']) + "' which is not known: " + str(msg), "ERROR")
+        return False
+    return isValid(msg)
 
 
 def isValidIP(ip):
@@ -195,6 +357,25 @@ class NetBotSocketException(Exception):
     pass
 
 
+# sendRecvMessage() waits for a reply for a retransmit timeout (RTO) worked out from the round trip
+# times (RTT) it has measured to each destination, like the TCP retransmit timer (RFC 6298):
+#   first RTT R:  srtt = R, rttvar = R / 2
+#   next RTT R:   rttvar = (1 - rttBeta) * rttvar + rttBeta * |srtt - R|, srtt = (1 - rttAlpha) * srtt + rttAlpha * R
+#   RTO = srtt + max(rttClock, 4 * rttvar), kept between minRTO and maxRTO.
+# Only replies to requests that were not resent are measured (Karn's algorithm) since a reply to a
+# resent request could be a reply to any of the copies. When no reply comes in time the RTO is
+# doubled for each resend, and the doubled RTO is kept for later requests until the next RTT is
+# measured (see backOffRTO()).
+rttAlpha = 1 / 8
+rttBeta = 1 / 4
+rttClock = 0.001  # secs, how finely the RTO is worth setting
+# RFC 6298 uses 1 sec. It only has to be longer than the server can stall, e.g. for a slow step.
+minRTO = 0.05
+maxRTO = 5.0
+# Upper bound in secs of each bucket in the RTT histogram shown by getStats(). The last bucket is everything slower.
+rttBuckets = (0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
 class NetBotSocket:
     """NetBot Msg filtering and basic reliable send/recv for UDP soket. """
 
@@ -212,34 +393,102 @@ class NetBotSocket:
         Raises socket related exceptions.
         """
 
-        self.sent = {}  # Number of messages sent to OS socket
-        self.recv = {}  # Number of messages recv from OS socket
-        self.sendRecvMessageCalls = 0  # Number of calls to sendRecvMessage
-        self.sendRecvMessageResends = 0  # Number of resends made by sendRecvMessage
-        self.sendRecvMessageTime = 0  # Total time in sendRecvMessage
-        self.sendTypes = {}
-        self.recvTypes = {}
-
-        self.sendrecvDelay = 0.1
-
         self.sourceIP = sourceIP
         self.sourcePort = sourcePort
         log("Creating socket with sourceIP=" + sourceIP + ", sourcePort=" + str(sourcePort), "VERBOSE")
-        self.s = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        s = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
         try:
-            self.s.bind((sourceIP, sourcePort))
+            s.bind((sourceIP, sourcePort))
             log("Source Socket Binding Successful. Listening on " + formatIpPort(sourceIP, sourcePort))
         except Exception as e:
-            self.s.close()
+            s.close()
             self.s = None
             log("Source Socket Binding Failed. The source port may already be in use. Try another port.", "FAILURE")
             raise
+        self.initSocket(s, destinationIP, destinationPort)
+
+    def initSocket(self, s, destinationIP, destinationPort):
+        """ Set up everything but the UDP socket, s, which must already be bound. """
+        self.clearStats()
+        self.structDests = set()  # {ip:port, ...} that agreed to use the struct codec in joinRequest/joinReply
+        self.botState = None  # newest botState msg pushed by the server and not yet taken by recvBotState()
+        self.rtt = {}  # {ip:port: (srtt, rttvar, rto), ...} see addRTT(). srtt and rttvar are None until an RTT is measured.
+
+        self.sendrecvDelay = 0.1
+
+        self.s = s
         self.s.settimeout(0)
         self.destinationIP = destinationIP
         self.destinationPort = destinationPort
         self.bufferSize = 4096
-        random.seed()
-        self.msgID = random.randrange(0, 65000, 1)
+        # recvMessages() receives every datagram into this one buffer rather than allocating bytes for each.
+        self.recvBuffer = bytearray(self.bufferSize)
+        self.recvView = memoryview(self.recvBuffer)
+        # Use own random generator so sockets don't reseed (or depend on) the random module other code uses.
+        self.msgID = random.Random().randrange(0, 65000, 1)
+
+    def clearStats(self):
+        self.sent = {}  # Number of messages sent to OS socket
+        self.recv = {}  # Number of messages recv from OS socket
+        self.sendRecvMessageCalls = 0  # Number of calls to sendRecvMessage
+        self.sendRecvMessageResends = 0  # Number of resends made by sendRecvMessage
+        self.sendRecvMessageTime = 0  # Total time in sendRecvMessage
+        self.sendTypes = {}
+        self.recvTypes = {}
+        # {ip:port: {'count': int, 'total': secs, 'min': secs, 'max': secs, 'histogram': [count per rttBuckets]}}
+        self.rttStats = {}
+
+    def getRTO(self, dest):
+        """ Return secs sendRecvMessage() should wait for a reply from dest (ip:port) before resending. """
+        if dest in self.rtt:
+            return self.rtt[dest][2]
+        # nothing measured yet
+        return self.sendrecvDelay
+
+    def backOffRTO(self, dest, rto):
+        """
+        Keep rto, the RTO sendRecvMessage() backed off to when dest (ip:port) didn't reply in time,
+        until addRTT() measures the next RTT. rto is kept at or below maxRTO.
+        """
+        rto = min(maxRTO, rto)
+        if dest in self.rtt:
+            srtt, rttvar, oldRto = self.rtt[dest]
+            self.rtt[dest] = (srtt, rttvar, max(oldRto, rto))
+        else:
+            self.rtt[dest] = (None, None, rto)
+
+    def addRTT(self, dest, rtt):
+        """ Update the RTO for dest (ip:port) with a new round trip time, rtt secs, and add it to the stats. """
+        if dest in self.rtt and self.rtt[dest][0] is not None:
+            srtt, rttvar, rto = self.rtt[dest]
+            rttvar = (1 - rttBeta) * rttvar + rttBeta * abs(srtt - rtt)
+            srtt = (1 - rttAlpha) * srtt + rttAlpha * rtt
+        else:
+            srtt = rtt
+            rttvar = rtt / 2
+        rto = min(maxRTO, max(minRTO, srtt + max(rttClock, 4 * rttvar)))
+        self.rtt[dest] = (srtt, rttvar, rto)
+
+        stats = self.rttStats.get(dest)
+        if stats is None:
+            stats = self.rttStats[dest] = {'count': 0, 'total': 0, 'min': rtt, 'max': rtt,
+                                           'histogram': [0] * (len(rttBuckets) + 1)}
+        stats['count'] += 1
+        stats['total'] += rtt
+        stats['min'] = min(stats['min'], rtt)
+        stats['max'] = max(stats['max'], rtt)
+        stats['histogram'][bisect.bisect_left(rttBuckets, rtt)] += 1
+
+    def setCodec(self, dest, codec):
+        """ Use codec ('msgpack' or 'struct') for msgs sent to dest (ip:port). """
+        if codec == 'struct':
+            self.structDests.add(dest)
+        else:
+            self.structDests.discard(dest)
+
+    def fileno(self):
+        """ Return the socket's file descriptor so a NetBotSocket can be passed to select() and friends. """
+        return self.s.fileno()
 
     def settimeout(self, t):
         self.s.settimeout(t)
@@ -247,6 +496,16 @@ class NetBotSocket:
     def setDelay(self, delay):
         self.sendrecvDelay = delay
 
+    def waitForMessage(self, timeout):
+        """
+        Block until the socket receive buffer has data or timeout secs have passed,
+        without using any CPU while waiting.
+
+        Returns True if a message is ready to receive, otherwise False.
+        """
+        readable, writable, exceptional = select.select([self.s], [], [], max(0, timeout))
+        return len(readable) != 0
+
     def getStats(self):
         """ Return str of NetBotSocket stats. """
         output = "\n\n                 ====== Stats ======"
@@ -273,6 +532,22 @@ class NetBotSocket:
                 for t, c in sorted(self.recvTypes[src].items(), key=lambda x: x[0]):
                     output += "\n" + '%26s' % (t) + ": " + str(c)
 
+            if src in self.rttStats:
+                stats = self.rttStats[src]
+                srtt, rttvar, rto = self.rtt[src]
+                output += "\n\n                Round Trip Times (ms)" + \
+                    "\n                   Samples: " + str(stats['count']) + \
+                    "\n           Min / Avg / Max: " + '%.3f / %.3f / %.3f' % (
+                        stats['min'] * 1000, stats['total'] / stats['count'] * 1000, stats['max'] * 1000) + \
+                    "\n   Smoothed RTT / Variance: " + '%.3f / %.3f' % (srtt * 1000, rttvar * 1000) + \
+                    "\n         Retransmit Timeout: " + '%.3f' % (rto * 1000)
+                low = 0
+                for high, count in zip(rttBuckets + (None,), stats['histogram']):
+                    if count:
+                        bucket = '%g - %g' % (low * 1000, high * 1000) if high else '> %g' % (low * 1000)
+                        output += "\n" + '%26s' % (bucket) + ": " + str(count)
+                    low = high
+
             output += "\n"
 
         return output
@@ -294,12 +569,10 @@ class NetBotSocket:
         self.destinationPort = destinationPort
 
     def serialize(self, msg):
-        return umsgpack.packb(msg, use_bin_type=True)
+        return serialize(msg)
 
     def deserialize(self, b):
-        # return umsgpack.unpackb(b, raw=False)
-        # Allow integer keys in incoming msgpack maps to match server behavior
-        return umsgpack.unpackb(b, raw=False, strict_map_key=False)
+        return deserialize(b)
 
     def sendMessage(self, msg, destinationIP=None, destinationPort=None, packedAndChecked=False):
         """
@@ -334,15 +607,16 @@ class NetBotSocket:
                 raise NetBotSocketException("Could not send because destinationPort is not valid format.")
 
             # Convert data from python objects to network binary format
-            networkbytes = self.serialize(msg)
+            networkbytes = self.encodeMessage(msg, formatIpPort(destinationIP, destinationPort))
         else:
             networkbytes = msg
 
-        log("Sending msg to " + destinationIP + ":" + str(destinationPort) +
-            " len=" + str(len(networkbytes)) + " bytes " + str(msg), "DEBUG")
-        self.s.sendto(networkbytes, (destinationIP, destinationPort))
-
+        if logEnabled("DEBUG"):
+            log("Sending msg to " + destinationIP + ":" + str(destinationPort) +
+                " len=" + str(len(networkbytes)) + " bytes " + str(msg), "DEBUG")
         dest = formatIpPort(destinationIP, destinationPort)
+        self.sendBytes(networkbytes, destinationIP, destinationPort, dest)
+
         if dest in self.sent:
             self.sent[dest] += 1
         else:
@@ -360,6 +634,50 @@ class NetBotSocket:
         else:
             self.sendTypes[dest][msgtype] = 1
 
+    def sendBytes(self, networkbytes, ip, port, dest):
+        """ Send networkbytes, a serialized msg, to ip:port (dest). """
+        self.s.sendto(networkbytes, (ip, port))
+
+    def encodeMessage(self, msg, dest):
+        """ Return msg serialized with the codec dest (ip:port) uses. """
+        if msg['type'] == 'joinReply':
+            self.setCodec(dest, msg.get('codec', 'msgpack'))
+        if dest in self.structDests:
+            networkbytes = serializeStruct(msg)
+            if networkbytes is not None:
+                return networkbytes
+        return self.serialize(msg)
+
+    def sendMessages(self, msgs):
+        """
+        Send each (msg, destinationIP, destinationPort) in msgs and then return immediately.
+
+        Unlike sendMessage() the msgs, IPs and ports are not checked, so only use this for msgs
+        made by trusted code, such as the replies a server makes. Each msg is serialized once
+        and the stats are updated once for the whole batch. A msg that can't be sent is logged
+        and the rest are still sent.
+        """
+        sendBytes = self.sendBytes
+        debug = logEnabled("DEBUG")
+        counts = {}  # {(dest, msgtype): count}
+        for msg, ip, port in msgs:
+            dest = formatIpPort(ip, port)
+            try:
+                networkbytes = self.encodeMessage(msg, dest)
+                if debug:
+                    log("Sending msg to " + dest + " len=" + str(len(networkbytes)) + " bytes " + str(msg), "DEBUG")
+                sendBytes(networkbytes, ip, port, dest)
+            except Exception as e:
+                log("Could not send msg to " + dest + ": " + str(e), "ERROR")
+                continue
+            key = (dest, msg['type'])
+            counts[key] = counts.get(key, 0) + 1
+
+        for (dest, msgtype), count in counts.items():
+            self.sent[dest] = self.sent.get(dest, 0) + count
+            types = self.sendTypes.setdefault(dest, {})
+            types[msgtype] = types.get(msgtype, 0) + count
+
     def recvMessage(self):
         """
         Check the socket receive buffer and returns message, ip, and port only
@@ -384,28 +702,52 @@ class NetBotSocket:
         (non-blocking), which is the default in NetBotSocket.
 
         """
-        try:
-            bytesAddressPair = self.s.recvfrom(self.bufferSize)
-            # Convert data from network binary format to python objects
-            msg = self.deserialize(bytesAddressPair[0])
-            ip = bytesAddressPair[1][0]
-            port = bytesAddressPair[1][1]
-            log("Received msg from " + ip + ":" + str(port) + " len=" +
-                str(len(bytesAddressPair[0])) + " bytes " + str(msg), "DEBUG")
+        msgBytes, ip, port = self.recvBytes()
+        return self.loadMessage(msgBytes, ip, port)
 
-            src = formatIpPort(ip, port)
-            if src in self.recv:
-                self.recv[src] += 1
-            else:
-                self.recv[src] = 1
+    def recvMessages(self, maxMessages=64):
+        """
+        Receive up to maxMessages messages that are immediately ready in the socket receive
+        buffer. Returns [(msg, ip, port), ...], which is empty if the buffer is empty.
+        Invalid messages are logged and left out. No exception is raised for an empty buffer.
 
-            if src not in self.recvTypes:
-                self.recvTypes[src] = {}
-            if msg['type'] in self.recvTypes[src]:
-                self.recvTypes[src][msg['type']] += 1
-            else:
-                self.recvTypes[src][msg['type']] = 1
+        Each datagram is received into a preallocated buffer with recvfrom_into() and
+        deserialized straight from it, so no bytes object is made per datagram.
+        """
+        msgs = []
+        for i in range(maxMessages):
+            try:
+                nbytes, address = self.s.recvfrom_into(self.recvBuffer)
+            except (BlockingIOError, socket.timeout):
+                # There was no data in the receive buffer.
+                break
+            except (ConnectionResetError):
+                # Windows raises this when it gets back an ICMP destination unreachable packet
+                log("The destination ip:port returned ICMP destination unreachable. Is the destination running?", "WARNING")
+                continue
+
+            if nbytes == 0:
+                continue  # a ShmNetBotSocket wakeup, the msg is in shared memory.
+
+            # pure python msgpack can't unpack from a memoryview
+            msgBytes = self.recvView[:nbytes] if binaryMsgpack else self.recvBuffer[:nbytes]
+            try:
+                msgs.append(self.loadMessage(msgBytes, address[0], address[1]))
+            except NetBotSocketException:
+                pass  # isValidMsg() has already logged why
+            except Exception as e:
+                log(str(type(e)) + " " + str(e), "ERROR")
+
+        return msgs
 
+    def recvBytes(self):
+        """
+        Same as recvMessage() but returns msgBytes, ip, port where msgBytes is the message
+        still in network binary format. The message is not checked or counted in stats.
+        Useful for passing messages on to another process without deserializing them.
+        """
+        try:
+            bytesAddressPair = self.s.recvfrom(self.bufferSize)
         except (BlockingIOError, socket.timeout):
             # There was no data in the receive buffer.
             raise NetBotSocketException("Receive buffer empty.")
@@ -415,17 +757,78 @@ class NetBotSocket:
             raise NetBotSocketException(
                 "The destination ip:port returned ICMP destination unreachable. Is the destination running?")
 
+        return bytesAddressPair[0], bytesAddressPair[1][0], bytesAddressPair[1][1]
+
+    def loadMessage(self, msgBytes, ip, port):
+        """
+        Deserialize and check msgBytes received from ip:port and count it in stats.
+
+        Returns msg, ip, port. Raises NetBotSocketException if msg is not a valid message.
+        """
+        # Convert data from network binary format to python objects
+        msg = self.deserialize(msgBytes)
+        if logEnabled("DEBUG"):
+            log("Received msg from " + ip + ":" + str(port) + " len=" +
+                str(len(msgBytes)) + " bytes " + str(msg), "DEBUG")
+
+        src = formatIpPort(ip, port)
+        if src in self.recv:
+            self.recv[src] += 1
+        else:
+            self.recv[src] = 1
+
+        if src not in self.recvTypes:
+            self.recvTypes[src] = {}
+        if msg['type'] in self.recvTypes[src]:
+            self.recvTypes[src][msg['type']] += 1
+        else:
+            self.recvTypes[src][msg['type']] = 1
+
         if not isValidMsg(msg):
             raise NetBotSocketException("Received message invalid format.")
 
         # If we get a joinReply then use the server conf to tune our send delay in sendRecvMessage()
+        # and use the codec the server agreed to.
         if msg['type'] == 'joinReply':
             self.setDelay(msg['conf']['stepSec'] * 2)
+            self.setCodec(src, msg.get('codec', 'msgpack'))
+        # Keep the newest state the server pushed (see subscribeRequest) even if it arrived while
+        # sendRecvMessage() was waiting for a reply.
+        elif msg['type'] == 'botState':
+            self.botState = msg
+        # Any botState kept from before the game started is out of date.
+        elif msg['type'] == 'waitForGameReply':
+            self.botState = None
 
         return msg, ip, port
 
+    def recvBotState(self, timeout=None):
+        """
+        Returns the newest botState msg the server has pushed (see subscribeRequest) since the last
+        call. If there isn't one, waits up to timeout secs for it (default is the sendRecvMessage()
+        delay). Returns None if no botState arrived.
+
+        Other msgs received are discarded, like in sendRecvMessage().
+        """
+        if timeout is None:
+            timeout = self.sendrecvDelay
+        endTime = time.perf_counter() + timeout
+
+        # Take everything already waiting so a robot that fell behind gets the newest state, not the oldest.
+        while self.recvMessages():
+            pass
+        while self.botState is None:
+            remaining = endTime - time.perf_counter()
+            if remaining <= 0 or not self.waitForMessage(remaining):
+                return None
+            self.recvMessages()
+
+        botState = self.botState
+        self.botState = None
+        return botState
+
     def sendRecvMessage(self, msg, destinationIP=None, destinationPort=None,
-                        retries=10, delay=None, delayMultiplier=1.2):
+                        retries=10, delay=None, delayMultiplier=2):
         """
         Sends msg to destinationIP:destinationPort and then returns the reply.
         sendRecvMessage is considered synchronous because it will not return
@@ -456,10 +859,11 @@ class NetBotSocket:
         if destinationPort is None:
             destinationPort = self.destinationPort
 
+        dest = formatIpPort(destinationIP, destinationPort)
         if delay:
             nextDelay = delay
         else:
-            nextDelay = self.sendrecvDelay
+            nextDelay = self.getRTO(dest)
 
         remaining = retries
 
@@ -476,10 +880,15 @@ class NetBotSocket:
                 self.sendMessage(msg, destinationIP, destinationPort)
                 if sendMessage != 0:
                     self.sendRecvMessageResends += 1
+                else:
+                    sentAt = time.perf_counter()
                 remaining = remaining - 1
                 sendMessage = time.perf_counter() + nextDelay
                 self.s.settimeout(nextDelay)
                 nextDelay = nextDelay * delayMultiplier
+                if not delay and remaining != retries - 1:
+                    # dest didn't reply within the RTO so later requests start from the backed off RTO too.
+                    self.backOffRTO(dest, nextDelay / delayMultiplier)
 
             try:
                 replyMsg, ip, port = self.recvMessage()
@@ -496,9 +905,16 @@ class NetBotSocket:
 
         self.s.settimeout(0)
 
+        if not gotReply and not delay:
+            self.backOffRTO(dest, nextDelay)
+
+        if gotReply and remaining == retries - 1:
+            # only sent once so we know which send the reply is for.
+            self.addRTT(dest, time.perf_counter() - sentAt)
+
         if not gotReply:
-            log("Raising Exception NetBotSocketException because failed to get valid respose after " + str(retries) +
-                " retries with delay = " + str(delay) + " and delayMultiplier = " + str(delayMultiplier), "VERBOSE")
+            log("Raising Exception NetBotSocketException because failed to get valid respose after %s"
+                " retries with delay = %s and delayMultiplier = %s", "VERBOSE", retries, delay, delayMultiplier)
             raise NetBotSocketException("Failed to get valid respose.")
 
         if replyMsg['type'] == "Error":
@@ -510,3 +926,481 @@ class NetBotSocket:
 
         self.sendRecvMessageTime += time.perf_counter() - startTime
         return replyMsg
+
+
+class AsyncNetBotSocket(NetBotSocket, asyncio.DatagramProtocol):
+    """
+    NetBotSocket for robots that use asyncio. sendRecvMessage() is a coroutine and many can be
+    awaited at once, so a robot can have all of its botMsgsPerStep requests in flight together
+    and get every reply in the same server step. For example:
+
+        infoReply, locationReply, scanReply = await asyncio.gather(
+            botSocket.sendRecvMessage({'type': 'getInfoRequest'}),
+            botSocket.sendRecvMessage({'type': 'getLocationRequest'}),
+            botSocket.sendRecvMessage({'type': 'scanRequest', 'startRadians': 0, 'endRadians': math.pi}))
+
+    Outstanding requests are kept by msgID and each one has its own resend timer. Replies are
+    matched to requests by msgID, in whatever order they arrive.
+
+    Once sendRecvMessage() has been called the socket is read by the asyncio event loop, so
+    don't use recvMessage() or recvMessages() after that.
+    """
+
+    def __init__(self, sourceIP, sourcePort, destinationIP='127.0.0.1', destinationPort=20000):
+        super().__init__(sourceIP, sourcePort, destinationIP, destinationPort)
+        self.pending = {}  # {msgID: (future, ip, port), ...} requests waiting for a reply
+        self.transport = None
+        self.loop = None
+        self.starting = None
+
+    async def start(self):
+        """ Start receiving with the running event loop. Called by sendRecvMessage() if needed. """
+        if self.starting is None:
+            self.loop = asyncio.get_running_loop()
+            self.starting = asyncio.ensure_future(self.loop.create_datagram_endpoint(lambda: self, sock=self.s))
+        await self.starting
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            msg, ip, port = self.loadMessage(data, addr[0], addr[1])
+        except NetBotSocketException:
+            return  # isValidMsg() has already logged why
+        except Exception as e:
+            log(str(type(e)) + " " + str(e), "ERROR")
+            return
+
+        request = self.pending.get(msg.get('msgID'))
+        # Replies to requests that were resent can arrive more than once. Only the first is used.
+        if request and request[1] == ip and request[2] == port and not request[0].done():
+            request[0].set_result(msg)
+
+    def close(self):
+        """ Close the socket. Requests still waiting for a reply will time out. """
+        if self.transport and not self.loop.is_closed():
+            self.transport.close()
+        else:
+            self.s.close()
+
+    async def sendRecvMessage(self, msg, destinationIP=None, destinationPort=None,
+                              retries=10, delay=None, delayMultiplier=2):
+        """
+        Same as NetBotSocket.sendRecvMessage() but must be awaited, and other requests can be
+        sent while this one waits for its reply.
+        """
+        await self.start()
+
+        startTime = time.perf_counter()
+        self.sendRecvMessageCalls += 1
+
+        if destinationIP is None:
+            destinationIP = self.destinationIP
+
+        if destinationPort is None:
+            destinationPort = self.destinationPort
+
+        dest = formatIpPort(destinationIP, destinationPort)
+        if delay:
+            nextDelay = delay
+        else:
+            nextDelay = self.getRTO(dest)
+
+        # find a msgID that isn't already waiting for a reply
+        while True:
+            self.msgID = self.msgID + 1
+            if self.msgID > 65000:
+                self.msgID = 0
+            if self.msgID not in self.pending:
+                break
+        msgID = msg['msgID'] = self.msgID
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[msgID] = (future, destinationIP, destinationPort)
+        try:
+            for attempt in range(retries):
+                self.sendMessage(msg, destinationIP, destinationPort)
+                if attempt:
+                    self.sendRecvMessageResends += 1
+                else:
+                    sentAt = time.perf_counter()
+                try:
+                    replyMsg = await asyncio.wait_for(asyncio.shield(future), nextDelay)
+                    if attempt == 0:
+                        # only sent once so we know which send the reply is for.
+                        self.addRTT(dest, time.perf_counter() - sentAt)
+                    break
+                except asyncio.TimeoutError:
+                    nextDelay = nextDelay * delayMultiplier
+                    if not delay:
+                        # dest didn't reply within the RTO so later requests start from the backed off RTO too.
+                        self.backOffRTO(dest, nextDelay)
+            else:
+                log("Raising Exception NetBotSocketException because failed to get valid respose after %s"
+                    " retries with delay = %s and delayMultiplier = %s", "VERBOSE", retries, delay, delayMultiplier)
+                raise NetBotSocketException("Failed to get valid respose.")
+        finally:
+            del self.pending[msgID]
+
+        if replyMsg['type'] == "Error":
+            log("Raising Exception NetBotSocketException because reply message, with correct msgID was of type Error.",
+                "VERBOSE")
+            raise NetBotSocketException("Received Error Message: " + replyMsg['result'])
+
+        del replyMsg['msgID']
+
+        self.sendRecvMessageTime += time.perf_counter() - startTime
+        return replyMsg
+
+
+class SharedNetBotSocket(NetBotSocket):
+    """
+    NetBotSocket for one arena of a multi-arena server (see netbots_server.py -arenas).
+
+    Messages are sent from a UDP socket shared with the server process, so replies come from
+    the server's ip:port as robots expect. Messages are received from a multiprocessing
+    Connection that the server process forwards the arena's messages to as (msgBytes, ip, port).
+    """
+
+    def __init__(self, s, conn):
+        """ s is the server's bound UDP socket and conn is the receiving end of a multiprocessing Pipe. """
+        self.initSocket(s, '127.0.0.1', 20000)
+        self.conn = conn
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def waitForMessage(self, timeout):
+        return self.conn.poll(max(0, timeout))
+
+    def recvBytes(self):
+        if not self.conn.poll():
+            raise NetBotSocketException("Receive buffer empty.")
+        return self.conn.recv()
+
+    def recvMessages(self, maxMessages=64):
+        msgs = []
+        while len(msgs) < maxMessages and self.conn.poll():
+            msgBytes, ip, port = self.conn.recv()
+            try:
+                msgs.append(self.loadMessage(msgBytes, ip, port))
+            except NetBotSocketException:
+                pass  # isValidMsg() has already logged why
+            except Exception as e:
+                log(str(type(e)) + " " + str(e), "ERROR")
+        return msgs
+
+
+"""
+**Shared Memory Transport**
+
+When a robot and the server run on the same computer they can pass msgs through shared memory
+rather than the UDP stack. Each robot using ShmNetBotSocket makes a shared memory segment with
+two ring buffers, one for msgs to the server and one for msgs from it, and puts the segment name
+in the 'shm' field of its joinRequest. A server using ShmNetBotSocket (-shm option) maps the
+segment and says so with the same 'shm' field in the joinReply, which it sends through the ring.
+After that msgs both ways go through the rings. joinRequests and any msg that doesn't fit in a
+ring still go by UDP, as does everything for robots and servers that don't use ShmNetBotSocket.
+
+Msgs are serialized the same way (msgpack or the struct codec) and are checked and counted in the
+stats like UDP msgs. A reader that is about to block sets a flag in the ring and a writer that
+sees it sends an empty UDP datagram to wake it, so nothing goes through the UDP stack while the
+reader is busy. If a wakeup is ever missed the msg is still read when the reader's wait times out
+(sendRecvMessage() retry or the end of the server step).
+
+The server only maps a segment offered by a joinRequest from a loopback address, with a name made
+by shmName() for the port the joinRequest came from, and only keeps it if it is big enough for the
+two rings (see checkShmOffer()). Anything else gets a joinReply without 'shm' and keeps using UDP.
+"""
+
+shmRingSize = 65536  # bytes of msgs each ring can hold. Must be a multiple of 4.
+shmRingHeader = struct.Struct('<QQB')  # bytes ever written (head), bytes ever read (tail), reader sleeping
+shmRingHeaderSize = 64
+
+
+shmSize = 2 * (shmRingHeaderSize + shmRingSize)  # bytes in each robot's segment
+shmNamePattern = re.compile(r'netbots_[0-9]+_([0-9]+)')  # names made by shmName(), group 1 is the port
+
+
+def shmName(port):
+    """ Return name of the shared memory segment this process makes for its socket on port. """
+    return "netbots_" + str(os.getpid()) + "_" + str(port)
+
+
+def checkShmOffer(name, ip, port):
+    """
+    Return None if the server may map shared memory segment name offered by the robot at ip:port,
+    else return why not. Only robots on this computer may offer a segment, and only one made by
+    shmName() for their own port, so a msg can't get the server to map any other segment.
+    """
+    if not ipaddress.ip_address(ip).is_loopback:
+        return "robot is not on a loopback address."
+    m = shmNamePattern.fullmatch(name)
+    if m is None or int(m.group(1)) != port:
+        return "name was not made by shmName() for port " + str(port) + "."
+    return None
+
+
+class ShmRing:
+    """
+    Single writer, single reader ring buffer of msgs in buf (e.g. a SharedMemory buf) at offset.
+    Each msg is a 4 byte length followed by the msg, padded to a multiple of 4 bytes. The writer
+    only moves head and the reader only moves tail, and each does so after copying the msg, so no
+    lock is needed.
+    """
+
+    def __init__(self, buf, offset, size=shmRingSize):
+        self.buf = buf
+        self.header = offset
+        self.data = offset + shmRingHeaderSize
+        self.size = size
+
+    def write(self, b):
+        """ Add msg b to the ring. Returns False, and adds nothing, if there isn't room for b. """
+        head, tail, sleeping = shmRingHeader.unpack_from(self.buf, self.header)
+        n = len(b)
+        used = 4 + ((n + 3) & ~3)
+        if used > self.size - (head - tail):
+            return False
+
+        pos = head % self.size
+        struct.pack_into('<I', self.buf, self.data + pos, n)
+        start = (pos + 4) % self.size
+        first = min(n, self.size - start)
+        self.buf[self.data + start:self.data + start + first] = b[:first]
+        if first < n:
+            # msg wraps around to the start of the ring
+            self.buf[self.data:self.data + n - first] = b[first:]
+
+        struct.pack_into('<Q', self.buf, self.header, head + used)
+        return True
+
+    def read(self):
+        """
+        Remove the oldest msg from the ring and return it as bytes, or None if the ring is empty.
+        If the ring's length prefix or header are corrupt the ring is emptied and None is returned.
+        """
+        head, tail, sleeping = shmRingHeader.unpack_from(self.buf, self.header)
+        if head == tail:
+            return None
+
+        pos = tail % self.size
+        n = struct.unpack_from('<I', self.buf, self.data + pos)[0]
+        if not 0 < head - tail <= self.size or 4 + n > head - tail or n > self.size - 4:
+            # The writer is faulty. Drop whatever is in the ring rather than read past head.
+            log("Shared memory ring has bad length " + str(n) + " with " + str(head - tail) +
+                " bytes used. Dropping contents.", "ERROR")
+            struct.pack_into('<Q', self.buf, self.header + 8, head)
+            return None
+        start = (pos + 4) % self.size
+        first = min(n, self.size - start)
+        b = bytes(self.buf[self.data + start:self.data + start + first])
+        if first < n:
+            b += bytes(self.buf[self.data:self.data + n - first])
+
+        struct.pack_into('<Q', self.buf, self.header + 8, tail + 4 + ((n + 3) & ~3))
+        return b
+
+    def isEmpty(self):
+        head, tail, sleeping = shmRingHeader.unpack_from(self.buf, self.header)
+        return head == tail
+
+    def setSleeping(self, sleeping):
+        """ Reader sets this before it blocks waiting for a msg and clears it after. """
+        self.buf[self.header + 16] = sleeping
+
+    def isSleeping(self):
+        return self.buf[self.header + 16] != 0
+
+
+class ShmLink:
+    """ The shared memory segment, and its two rings, between one robot and the server. """
+
+    def __init__(self, name, ip, port, robot):
+        """
+        If robot is True make a new segment called name, otherwise (server) map the robot's segment.
+        ip and port are the UDP address of the other end.
+        """
+        if robot:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=shmSize)
+            self.shm.buf[:shmSize] = bytes(shmSize)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            if not name.startswith(shmName("")):
+                # The robot owns the segment. Stop this process removing it when it exits.
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+            if self.shm.size < shmSize:
+                self.shm.close()
+                raise NetBotSocketException("Shared memory " + name + " is " + str(self.shm.size) +
+                                            " bytes, rings need " + str(shmSize) + ".")
+
+        toServer = ShmRing(self.shm.buf, 0)
+        toRobot = ShmRing(self.shm.buf, shmRingHeaderSize + shmRingSize)
+        self.sendRing, self.recvRing = (toServer, toRobot) if robot else (toRobot, toServer)
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.owner = robot
+        # Server links are connected when made. Robot links once the joinReply says the server mapped the segment.
+        self.connected = not robot
+
+    def close(self):
+        """ Unmap the segment, and remove it if this end made it. """
+        self.connected = False
+        self.sendRing = self.recvRing = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class ShmNetBotSocket(NetBotSocket):
+    """
+    NetBotSocket that sends msgs through shared memory to robots or a server on the same computer
+    that also use ShmNetBotSocket, and by UDP to everything else. See Shared Memory Transport above.
+    Used by robots the same way as NetBotSocket. AsyncNetBotSocket always uses UDP.
+    """
+
+    def __init__(self, sourceIP, sourcePort, destinationIP='127.0.0.1', destinationPort=20000):
+        super().__init__(sourceIP, sourcePort, destinationIP, destinationPort)
+        self.links = {}  # {ip:port: ShmLink, ...}
+        self.shmSent = 0  # msgs sent through shared memory
+        self.shmWakeups = 0  # empty UDP datagrams sent to wake a reader
+        self.shmFull = 0  # msgs sent by UDP because the ring was full
+        atexit.register(self.close)
+
+    def close(self):
+        """ Close all links then the socket. """
+        for link in self.links.values():
+            link.close()
+        self.links = {}
+        self.s.close()
+
+    def encodeMessage(self, msg, dest):
+        if msg['type'] == 'joinRequest':
+            # robot: offer the server a segment to talk through.
+            if dest not in self.links:
+                ip, port = dest.rsplit(':', 1)
+                name = shmName(self.s.getsockname()[1])
+                self.links[dest] = ShmLink(name, ip, int(port), robot=True)
+            msg['shm'] = self.links[dest].name
+        elif msg['type'] == 'joinReply' and 'shm' in msg:
+            # server: map the robot's segment. A bot that rejoins may have a new one.
+            if dest in self.links:
+                self.links.pop(dest).close()
+            ip, port = dest.rsplit(':', 1)
+            reason = checkShmOffer(msg['shm'], ip, int(port))
+            if reason is None:
+                try:
+                    self.links[dest] = ShmLink(msg['shm'], ip, int(port), robot=False)
+                except Exception as e:
+                    # e.g. bot is in a different container. Tell it to keep using UDP.
+                    reason = str(e)
+            if reason is not None:
+                log("Not using shared memory " + msg['shm'] + " of " + dest + ": " + reason, "WARNING")
+                del msg['shm']
+        return super().encodeMessage(msg, dest)
+
+    def loadMessage(self, msgBytes, ip, port):
+        msg, ip, port = super().loadMessage(msgBytes, ip, port)
+        if msg['type'] == 'joinReply':
+            link = self.links.get(formatIpPort(ip, port))
+            if link:
+                # robot: only send through the segment if the server mapped it.
+                link.connected = msg.get('shm') == link.name
+        return msg, ip, port
+
+    def getStats(self):
+        output = super().getStats()
+        if self.links:
+            output += "\n               === Shared Memory ===" + \
+                "\n                     Links: " + str(len(self.links)) + \
+                "\n             Messages Sent: " + str(self.shmSent) + \
+                "\n              Wakeups Sent: " + str(self.shmWakeups) + \
+                "\n   Sent by UDP (ring full): " + str(self.shmFull) + "\n"
+        return output
+
+    def sendBytes(self, networkbytes, ip, port, dest):
+        link = self.links.get(dest)
+        if link is not None and link.connected:
+            if link.sendRing.write(networkbytes):
+                self.shmSent += 1
+                if link.sendRing.isSleeping():
+                    self.shmWakeups += 1
+                    self.s.sendto(b'', (ip, port))
+                return
+            self.shmFull += 1
+        self.s.sendto(networkbytes, (ip, port))
+
+    def readLinks(self):
+        """ Return (msgBytes, ip, port) of the first msg found in a link, or None if there are none. """
+        for link in self.links.values():
+            b = link.recvRing.read()
+            if b is not None:
+                return b, link.ip, link.port
+        return None
+
+    def setSleeping(self, sleeping):
+        for link in self.links.values():
+            link.recvRing.setSleeping(sleeping)
+
+    def linksEmpty(self):
+        for link in self.links.values():
+            if not link.recvRing.isEmpty():
+                return False
+        return True
+
+    def waitForMessage(self, timeout):
+        if not self.linksEmpty():
+            return True
+        self.setSleeping(1)
+        try:
+            # check again in case a msg was written just before the flag was set.
+            if not self.linksEmpty():
+                return True
+            return super().waitForMessage(timeout)
+        finally:
+            self.setSleeping(0)
+
+    def recvBytes(self):
+        found = self.readLinks()
+        if found:
+            return found
+
+        blocking = self.s.gettimeout() != 0
+        if blocking:
+            self.setSleeping(1)
+        try:
+            found = self.readLinks()
+            if found:
+                return found
+            msgBytes, ip, port = super().recvBytes()
+        finally:
+            if blocking:
+                self.setSleeping(0)
+
+        if not msgBytes:
+            # woken up, the msg is in a link.
+            found = self.readLinks()
+            if found:
+                return found
+            raise NetBotSocketException("Receive buffer empty.")
+        return msgBytes, ip, port
+
+    def recvMessages(self, maxMessages=64):
+        msgs = []
+        for link in self.links.values():
+            while len(msgs) < maxMessages:
+                b = link.recvRing.read()
+                if b is None:
+                    break
+                try:
+                    msgs.append(self.loadMessage(b, link.ip, link.port))
+                except NetBotSocketException:
+                    pass  # isValidMsg() has already logged why
+                except Exception as e:
+                    log(str(type(e)) + " " + str(e), "ERROR")
+
+        if len(msgs) < maxMessages:
+            msgs.extend(super().recvMessages(maxMessages - len(msgs)))
+        return msgs
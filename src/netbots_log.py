@@ -1,12 +1,13 @@
 
-import inspect
-import os
+import atexit
+import sys
 from datetime import datetime
 
 # global printing of debug and info log level messages on/off
 logDebug = False
 logVerbose = False
 logFile = False
+logFileHandle = None  # open logFile, see setLogFile()
 
 
 def setLogLevel(debug=False, verbose=False):
@@ -26,15 +27,46 @@ def setLogLevel(debug=False, verbose=False):
 def setLogFile(filename=False):
     """
     Turn writing to file on or off. Off by default.
+
+    Lines are buffered and written to the file in blocks. The buffer is flushed after any
+    WARNING, ERROR or FAILURE line, when the log file is changed or turned off, and when
+    python exits.
     """
 
-    global logFile
+    global logFile, logFileHandle
+
+    if logFileHandle:
+        logFileHandle.close()
+        logFileHandle = None
 
     logFile = filename
+    if logFile:
+        logFileHandle = open(logFile, "a+", buffering=65536)
     log("logFile set to " + str(logFile), "INFO")
 
 
-def log(msg, level="INFO"):
+def flushLogFile():
+    """ Write any buffered lines to the log file. Called when python exits. """
+    if logFileHandle:
+        logFileHandle.flush()
+
+
+atexit.register(flushLogFile)
+
+
+def logEnabled(level):
+    """
+    Returns True if log() would output msgs of this level. Use it to skip building expensive
+    log msgs, e.g. if logEnabled("DEBUG"): log("Bots: " + str(bots), "DEBUG")
+    """
+    if level == "DEBUG":
+        return logDebug
+    if level == "VERBOSE":
+        return logVerbose
+    return True
+
+
+def log(msg, level="INFO", *args):
     """
     Print msg to standard output in the format: LogLevel Time Function: msg
 
@@ -47,29 +79,29 @@ def log(msg, level="INFO"):
             ERROR: Can not continue as planned.
             FAILURE: program will need to quit or initialize.
 
+    If args are given then msg is a % format string and is only formatted if the msg will be
+    output, e.g. log("Bots in Game: %s", "VERBOSE", bots) does not call str(bots) unless
+    VERBOSE is on.
     """
 
-    global logDebug, logVerbose, logFile
-
     if level == "DEBUG" and logDebug == False:
         return
 
     if level == "VERBOSE" and logVerbose == False:
         return
 
+    if args:
+        msg = msg % args
+
     try:
-        # Get the execution frame of the calling function and use it to determine the calling filename and function name
-        # This will fail if called from a python interactive shell.
-        frame = inspect.stack()[1]
-        module = inspect.getmodule(frame[0])
-        filename = os.path.basename(module.__file__)
-        modulename = module.__name__
-        function = frame[0].f_code.co_name
+        # Get the execution frame of the calling function and use it to determine the calling module and function name
+        frame = sys._getframe(1)
+        modulename = frame.f_globals.get('__name__', '-')
+        function = frame.f_code.co_name
         if function != '<module>':
             function = function + '()'
     except Exception as e:
         modulename = '-'
-        filename = '-'
         function = '-'
 
     time = datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
@@ -78,6 +110,7 @@ def log(msg, level="INFO"):
 
     print(output)
 
-    if logFile:
-        with open(logFile,"a+") as f: 
-            f.write(output + "\n")
+    if logFileHandle:
+        logFileHandle.write(output + "\n")
+        if level in ("WARNING", "ERROR", "FAILURE"):
+            logFileHandle.flush()
@@ -112,7 +112,7 @@ def intersectLineCircle(x1, y1, x2, y2, cx, cy, cradius):
     ix = (D * dy + sgn(dy) * dx * math.sqrt(delta)) / dr**2
     iy = (-1 * D * dx + abs(dy) * math.sqrt(delta)) / dr**2
     if (x1 < ix and ix < x2) or (x1 > ix and ix > x2) or \
-       (y1 < ix and ix < y2) or (y1 > ix and ix > y2):
+       (y1 < iy and iy < y2) or (y1 > iy and iy > y2):
         return True
 
     return False
@@ -0,0 +1,381 @@
+import math
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+############################################################
+# NumPy backend for the per bot phases of netbots_server.step().
+# Enable with the server -backend numpy option.
+#
+# BotArrays keeps the bot fields step() changes in one numpy array
+# per field (struct of arrays) from step to step, so step() does not
+# copy every bot dict into arrays and back each time. Moving bots,
+# wall hits, finding overlaps and explosions are done for all bots at
+# once with the arrays. Only the few bots that actually overlap an
+# obstacle or another bot are copied out as bot dicts so
+# netbots_server can separate them with the same code the python
+# backend uses.
+#
+# The bot dicts in SrvData.bots are kept up to date like this:
+#
+# - health, and requestedSpeed when a bot hits something, are copied
+#   to the bot dict as soon as they change. They change for a few bots
+#   per step and are read all over the server.
+# - x, y, currentSpeed and currentDirection change for every moving bot
+#   every step. They are only copied to the bot dicts when something
+#   needs them, see SrvData.syncBot() and SrvData.syncBots().
+# - requestedSpeed and requestedDirection set by msgs are copied from
+#   the bot dict by netbots_server.processMsg(), see loadRequested().
+#
+# The arrays are (re)loaded from the bot dicts at the first step after
+# initGame() or a bot joining.
+#
+# Results match the python backend within float tolerance. numpy
+# cos/sin may differ from math.cos/math.sin in the last bit so
+# the two backends can slowly drift apart over a long game. When more
+# than two bots pile up, a bot pushed into a third bot is separated
+# from it on the next pass of the collision loop rather than the same
+# pass, so a pile up may end with the bots in slightly different places.
+#############################################################
+
+
+# msgs that can change requestedSpeed or requestedDirection, see BotArrays.loadRequested()
+requestMsgTypes = {'setSpeedRequest', 'setDirectionRequest', 'batchRequest'}
+
+
+def available():
+    """ Returns True if numpy is installed. """
+    return np is not None
+
+
+class BotArrays:
+    """ Bot fields used by step(), one numpy array per field in SrvData.bots order. """
+
+    def __init__(self):
+        self.bots = None  # SrvData.bots the arrays were loaded from. None if they must be loaded before the next step.
+        self.stale = False  # True if x, y, currentSpeed and currentDirection in the bot dicts are older than the arrays.
+        self.fresh = set()  # src of bots that have been synced since the arrays were last changed.
+        self.obstacles = None  # conf['obstacles'] the obstacle arrays were made from.
+
+    def load(self, d):
+        """ Load all the arrays from d.bots and d.classValues. """
+        self.syncDicts()
+        self.bots = d.bots
+        self.srcs = list(d.bots.keys())
+        self.index = {src: i for i, src in enumerate(self.srcs)}
+        self.classes = [bot['class'] for bot in d.bots.values()]
+        self.fresh = set()
+
+        bots = list(d.bots.values())
+        self.x = loadField(bots, 'x')
+        self.y = loadField(bots, 'y')
+        self.speed = loadField(bots, 'currentSpeed')
+        self.direction = loadField(bots, 'currentDirection')
+        self.reqSpeed = loadField(bots, 'requestedSpeed')
+        self.reqDirection = loadField(bots, 'requestedDirection')
+        self.health = loadField(bots, 'health')
+        self.hitSeverity = np.zeros(len(bots))
+
+        self.accRate = self.loadClassValue(d, 'botAccRate')
+        self.minTurnRate = self.loadClassValue(d, 'botMinTurnRate')
+        self.maxTurnRate = self.loadClassValue(d, 'botMaxTurnRate')
+        self.maxSpeed = self.loadClassValue(d, 'botMaxSpeed')
+        self.armor = self.loadClassValue(d, 'botArmor')
+
+    def loadClassValue(self, d, fld):
+        """ Return numpy array of the class value fld for each bot. """
+        return np.array([d.classValues[c][fld] for c in self.classes], dtype=np.float64)
+
+    def invalidate(self):
+        """ Copy the arrays to the bot dicts and load them again at the next step. Called when the bot dicts are reset. """
+        self.syncDicts()
+        self.bots = None
+
+    def syncDicts(self):
+        """ Copy x, y, currentSpeed and currentDirection of every bot to its bot dict, if they have changed. """
+        if not self.stale:
+            return
+        for bot, x, y, speed, direction in zip(self.bots.values(), self.x.tolist(), self.y.tolist(),
+                                               self.speed.tolist(), self.direction.tolist()):
+            bot['x'] = x
+            bot['y'] = y
+            bot['currentSpeed'] = speed
+            bot['currentDirection'] = direction
+        self.stale = False
+
+    def syncBot(self, src):
+        """ Copy x, y, currentSpeed and currentDirection of bot src to its bot dict, if they have changed. """
+        if self.stale and src not in self.fresh:
+            i = self.index.get(src)
+            if i is not None:
+                bot = self.bots[src]
+                bot['x'] = self.x.item(i)
+                bot['y'] = self.y.item(i)
+                bot['currentSpeed'] = self.speed.item(i)
+                bot['currentDirection'] = self.direction.item(i)
+            self.fresh.add(src)
+
+    def loadRequested(self, src):
+        """ Copy requestedSpeed and requestedDirection of bot src from its bot dict. Called after msgs in requestMsgTypes. """
+        i = self.index.get(src) if self.bots is not None else None
+        if i is not None:
+            bot = self.bots[src]
+            self.reqSpeed[i] = bot['requestedSpeed']
+            self.reqDirection[i] = bot['requestedDirection']
+
+    def setHealth(self, src, health):
+        """ Set health of bot src in the arrays and its bot dict. """
+        self.health[self.index[src]] = health
+        self.bots[src]['health'] = health
+
+    def mkBot(self, i):
+        """ Return a bot dict, with the fields the collision code in netbots_server uses, of bot i. """
+        return {
+            'x': float(self.x[i]),
+            'y': float(self.y[i]),
+            'health': float(self.health[i]),
+            'currentSpeed': float(self.speed[i]),
+            'currentDirection': float(self.direction[i]),
+            'class': self.classes[i],
+            'hitSeverity': float(self.hitSeverity[i])
+            }
+
+
+def loadField(bots, fld):
+    """ Return numpy array of bot[fld] for each bot in bots. """
+    return np.array([bot[fld] for bot in bots], dtype=np.float64)
+
+
+def normalizeAngle(a):
+    """ Same as netbots_math.normalizeAngle() for an array of angles in range -2pi to 4pi. """
+    a = np.where(a < 0, a + math.pi * 2, a)
+    return np.where(a >= math.pi * 2, a - math.pi * 2, a)
+
+
+def moveBots(d):
+    """
+    Same as netbots_server.moveBots() for all alive bots. Also loads d.botArrays if needed and
+    resets hitSeverity. Returns {src: health, ...} of the bots that are alive at the start of the step.
+    """
+    if d.botArrays is None:
+        d.botArrays = BotArrays()
+    a = d.botArrays
+    if a.bots is not d.bots or len(a.srcs) != len(d.bots):
+        a.load(d)
+    a.stale = True
+    a.fresh = set()
+    a.hitSeverity = np.zeros(len(a.srcs))
+
+    alive = a.health != 0
+    aliveIndexes = np.flatnonzero(alive)
+    aliveBots = dict(zip([a.srcs[i] for i in aliveIndexes.tolist()], a.health[aliveIndexes].tolist()))
+    if len(aliveIndexes) == 0:
+        return aliveBots
+
+    speed = a.speed
+    reqSpeed = a.reqSpeed
+    direction = a.direction
+    reqDirection = a.reqDirection
+
+    # change speed if needed
+    speed = np.where(speed > reqSpeed, np.maximum(speed - a.accRate, reqSpeed),
+                     np.where(speed < reqSpeed, np.minimum(speed + a.accRate, reqSpeed), speed))
+    speed = np.where(alive, speed, a.speed)
+
+    # change direction if needed. turn instantly if bot is not moving.
+    turning = alive & (direction != reqDirection)
+    instant = turning & (speed == 0)
+    turning = turning & ~instant
+    turnRate = a.minTurnRate + (a.maxTurnRate - a.minTurnRate) * (1 - speed / 100)
+
+    # if turn is negative and does not pass over 0 radians
+    negative = turning & (direction > reqDirection) & (direction - reqDirection <= math.pi)
+    # if turn is negative and passes over 0 radians, so we may need to normalize angle
+    negativeOver0 = turning & ~negative & (reqDirection > direction) & (reqDirection - direction >= math.pi)
+    # if turn is positive and does not pass over 0 radians
+    positive = turning & ~negative & ~negativeOver0 & \
+        (reqDirection > direction) & (reqDirection - direction <= math.pi)
+    # if turn is positive and passes over 0 radians
+    positiveOver0 = turning & ~negative & ~negativeOver0 & ~positive & \
+        (direction > reqDirection) & (direction - reqDirection >= math.pi)
+
+    newDirection = np.where(instant, reqDirection, direction)
+    t = direction - turnRate
+    newDirection = np.where(negative, np.where(t <= reqDirection, reqDirection, t), newDirection)
+    t = normalizeAngle(direction - turnRate)
+    newDirection = np.where(negativeOver0, np.where((t <= reqDirection) & (t >= reqDirection - math.pi),
+                                                    reqDirection, t), newDirection)
+    t = direction + turnRate
+    newDirection = np.where(positive, np.where(reqDirection <= t, reqDirection, t), newDirection)
+    t = normalizeAngle(direction + turnRate)
+    newDirection = np.where(positiveOver0, np.where((t >= reqDirection) & (t <= reqDirection + math.pi),
+                                                    reqDirection, t), newDirection)
+    direction = newDirection
+
+    # move bot
+    moving = alive & (speed != 0)
+    distance = speed / 100.0 * a.maxSpeed
+    a.x = np.where(moving, a.x + distance * np.cos(direction), a.x)
+    a.y = np.where(moving, a.y + distance * np.sin(direction), a.y)
+    a.speed = speed
+    a.direction = direction
+
+    return aliveBots
+
+
+def hitWalls(d):
+    """ Same as netbots_server.hitWalls() """
+    a = d.botArrays
+    if len(a.srcs) == 0:
+        return False
+
+    x = a.x
+    y = a.y
+    radius = d.conf['botRadius']
+    arenaSize = d.conf['arenaSize']
+
+    # Walls are checked in the same order as the python backend so the last wall hit sets the angle.
+    left = x - radius < 0
+    x = np.where(left, radius + 1, x)
+    right = x + radius > arenaSize
+    x = np.where(right, arenaSize - radius - 1, x)
+    bottom = y - radius < 0
+    y = np.where(bottom, radius + 1, y)
+    top = y + radius > arenaSize
+    y = np.where(top, arenaSize - radius - 1, y)
+
+    hit = left | right | bottom | top
+    if not hit.any():
+        return False
+    a.x = x
+    a.y = y
+
+    hitIndexes = np.flatnonzero(hit)
+    angle = np.select([top[hitIndexes], bottom[hitIndexes], right[hitIndexes]],
+                      [math.pi / 2, math.pi * 3 / 2, 0], math.pi)
+    # same as netbots_server.getHitSeverity() without b2
+    hitSeverity = a.speed[hitIndexes] / 100.0 * a.maxSpeed[hitIndexes] / d.conf['botMaxSpeed'] * \
+        np.cos(a.direction[hitIndexes] - angle)
+    hitSeverity = np.maximum(hitSeverity, 0)
+    a.hitSeverity[hitIndexes] = np.maximum(a.hitSeverity[hitIndexes], hitSeverity)
+
+    return bool(hitSeverity.any())
+
+
+def obstacleBots(d):
+    """
+    Return {src: bot, ...} of alive bots that overlap an obstacle, as bot dicts made by BotArrays.mkBot().
+    Copy them back with storeBots() once they are moved.
+    """
+    a = d.botArrays
+    obstacles = d.conf['obstacles']
+    if not obstacles or len(a.srcs) == 0:
+        return {}
+
+    if a.obstacles is not obstacles:
+        a.obstacles = obstacles
+        a.obstacleX = [o['x'] for o in obstacles]
+        a.obstacleY = [o['y'] for o in obstacles]
+        a.obstacleReach = [d.conf['botRadius'] + o['radius'] for o in obstacles]
+
+    # same distance as netbots_server.findOverlapingObstacle()
+    overlaps = np.zeros(len(a.srcs), dtype=bool)
+    for ox, oy, reach in zip(a.obstacleX, a.obstacleY, a.obstacleReach):
+        overlaps |= np.sqrt((ox - a.x)**2 + (oy - a.y)**2) <= reach
+
+    return {a.srcs[i]: a.mkBot(i) for i in np.flatnonzero(overlaps & (a.health != 0)).tolist()}
+
+
+def overlapingBots(d):
+    """
+    Return {src: bot, ...} of alive bots that overlap another alive bot, as bot dicts made by BotArrays.mkBot().
+    Copy them back with storeBots() once they are moved.
+
+    Like netbots_server.mkBotGrid() bots are put in cells one bot diameter wide so only bots in the same
+    or the 8 cells around need to be compared. Bots are sorted by cell and the bots in the 9 cells around
+    each bot are found with np.searchsorted().
+    """
+    a = d.botArrays
+    aliveIndexes = np.flatnonzero(a.health != 0)
+    n = len(aliveIndexes)
+    if n < 2:
+        return {}
+
+    x = a.x[aliveIndexes]
+    y = a.y[aliveIndexes]
+    size = d.conf['botRadius'] * 2
+    col = np.floor_divide(x, size).astype(np.int64)
+    row = np.floor_divide(y, size).astype(np.int64)
+    col -= col.min()
+    row -= row.min()
+    rows = int(row.max()) + 2  # one spare row so row - 1 and row + 1 never reach the next column
+    cell = col * rows + row
+
+    order = np.argsort(cell, kind='stable')
+    sortedCells = cell[order]
+    offsets = np.array([c * rows + r for c in (-1, 0, 1) for r in (-1, 0, 1)], dtype=np.int64)
+    near = (cell[np.newaxis, :] + offsets[:, np.newaxis]).ravel()
+    lo = np.searchsorted(sortedCells, near, 'left')
+    counts = np.searchsorted(sortedCells, near, 'right') - lo
+    total = int(counts.sum())
+
+    # every pair (i, j) of bots in cells next to each other.
+    i = np.repeat(np.tile(np.arange(n), len(offsets)), counts)
+    starts = np.cumsum(counts) - counts
+    j = order[np.repeat(lo - starts, counts) + np.arange(total)]
+    pairs = i != j
+    i = i[pairs]
+    j = j[pairs]
+
+    # same distance as netbots_server.findOverlapingBotInGrid()
+    overlaps = np.zeros(n, dtype=bool)
+    overlaps[i[np.sqrt((x[j] - x[i])**2 + (y[j] - y[i])**2) <= size]] = True
+
+    return {a.srcs[k]: a.mkBot(k) for k in aliveIndexes[overlaps].tolist()}
+
+
+def storeBots(d, bots):
+    """ Copy x, y and hitSeverity of bots, from obstacleBots() or overlapingBots(), back into d.botArrays. """
+    a = d.botArrays
+    for src, bot in bots.items():
+        i = a.index[src]
+        a.x[i] = bot['x']
+        a.y[i] = bot['y']
+        a.hitSeverity[i] = bot['hitSeverity']
+
+
+def hitBots(d):
+    """ Give damage to bots that hit things this step and stop them. Same as the loop in netbots_server.step(). """
+    a = d.botArrays
+    hitIndexes = np.flatnonzero(a.hitSeverity)
+    if len(hitIndexes) == 0:
+        return
+
+    hitSeverity = np.ones(len(hitIndexes)) if d.conf['simpleCollisions'] else a.hitSeverity[hitIndexes]
+    health = np.maximum(0, a.health[hitIndexes] - hitSeverity * d.conf['hitDamage'] * a.armor[hitIndexes])
+    a.health[hitIndexes] = health
+    a.speed[hitIndexes] = 0
+    a.reqSpeed[hitIndexes] = 0
+    for i, h in zip(hitIndexes.tolist(), health.tolist()):
+        bot = a.bots[a.srcs[i]]
+        bot['health'] = h
+        bot['requestedSpeed'] = 0
+
+
+def explodeShell(d, src, shell):
+    """ Same as netbots_server.explodeShell() """
+    a = d.botArrays
+    cv = d.classValues[d.bots[src]['class']]
+    explRadius = cv['explRadius']
+
+    distance = np.sqrt((shell['x'] - a.x)**2 + (shell['y'] - a.y)**2)
+
+    # Damage is applied in bot order, like the python backend, so shellDamage is summed in the same order.
+    for i in np.flatnonzero((a.health > 0) & (distance < explRadius)).tolist():
+        damage = cv['explDamage'] * (1 - float(distance[i]) / explRadius)
+        a.setHealth(a.srcs[i], max(0, float(a.health[i]) - (damage * a.armor[i].item())))
+        # allow recording of inflicting damage that is greater than health of hit robot.
+        # also record damage to oneself.
+        d.bots[src]['shellDamage'] += damage
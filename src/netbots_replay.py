@@ -0,0 +1,93 @@
+import argparse
+import sys
+import time
+
+from netbots_log import log
+from netbots_log import setLogLevel
+import netbots_server as nbsrv
+import netbots_numpy as nbnumpy
+import netbots_inputlog as nbinputlog
+
+"""
+Re-simulate a tournament from a server input log (see netbots_server.py -inputlog) without
+robots, network or sleeping between steps. After each step the state hash is compared to the
+one the server logged so any difference between the original run and the replay is found at
+the step where it happened.
+
+Useful for reproducing a bug seen in a real tournament, and for timing changes to the server
+against exactly the same workload.
+"""
+
+
+def replay(filename, backend=None, stopOnMismatch=True):
+    """
+    Re-simulate all games in input log filename. If backend is None the backend from the log is used.
+    Returns (d, steps, mismatches) where mismatches is list of (gameNumber, gameStep) that did not
+    match the logged state hash.
+    """
+    d = nbsrv.SrvData()
+
+    steps = 0
+    mismatches = []
+    with open(filename, 'rb') as f:
+        for record in nbinputlog.readRecords(f):
+            if record[0] == nbinputlog.MSG:
+                nbsrv.processMsg(d, record[2], record[1])
+            elif record[0] == nbinputlog.STEP:
+                nbsrv.step(d)
+                steps += 1
+                if nbinputlog.stateHash(d) != record[1]:
+                    mismatches.append((d.state['gameNumber'], d.state['gameStep']))
+                    log("State does not match log at game " + str(d.state['gameNumber']) +
+                        " step " + str(d.state['gameStep']), "ERROR")
+                    if stopOnMismatch:
+                        break
+            elif record[0] == nbinputlog.INITGAME:
+                nbsrv.initGame(d)
+            elif record[0] == nbinputlog.BOTSINGAME:
+                d.conf['botsInGame'] = record[1]
+            elif record[0] == nbinputlog.HEADER:
+                d.conf = record[1]['conf']
+                d.starts = record[1]['starts']
+                d.startLocs = record[1]['startLocs']
+                d.state['backend'] = backend if backend else record[1]['backend']
+                log("Replaying log made with seed " + str(record[1]['seed']) + " using " +
+                    d.state['backend'] + " backend.")
+            else:
+                log("Unknown input log record: " + str(record), "ERROR")
+
+    return d, steps, mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('inputLog', metavar='filename', type=str, help='Input log written by server -inputlog.')
+    parser.add_argument('-backend', dest='backend', type=str, choices=['python', 'numpy'],
+                        default=None, help='Override the backend recorded in the log.')
+    parser.add_argument('-keepgoing', dest='keepGoing', action='store_true',
+                        default=False, help='Keep replaying after the first state hash mismatch.')
+    parser.add_argument('-debug', dest='debug', action='store_true',
+                        default=False, help='Print DEBUG level log messages.')
+    parser.add_argument('-verbose', dest='verbose', action='store_true',
+                        default=False, help='Print VERBOSE level log messages. Note, -debug includes -verbose.')
+    args = parser.parse_args()
+
+    setLogLevel(args.debug, args.verbose)
+
+    if args.backend == 'numpy' and not nbnumpy.available():
+        log("-backend numpy requires numpy.", "FAILURE")
+        sys.exit(2)
+
+    startTime = time.perf_counter()
+    d, steps, mismatches = replay(args.inputLog, args.backend, not args.keepGoing)
+    runTime = time.perf_counter() - startTime
+
+    log("Replayed " + str(d.state['gameNumber']) + " games, " + str(steps) + " steps in " + '%.3f' % runTime +
+        " secs (" + '%.1f' % (steps / max(runTime, 0.000001)) + " steps/sec). State hash mismatches: " + str(len(mismatches)))
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
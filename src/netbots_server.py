@@ -6,12 +6,18 @@ import random
 import math
 import itertools
 import json
+import os
+import multiprocessing
+import multiprocessing.connection
 
 from netbots_log import log
 from netbots_log import setLogLevel
 import netbots_ipc as nbipc
 import netbots_srvmsghl as nbmsghl
 import netbots_math as nbmath
+import netbots_numpy as nbnumpy
+import netbots_inputlog as nbinputlog
+import netbots_viewdata as nbviewdata
 
 ########################################################
 # Server Data
@@ -19,153 +25,7 @@ import netbots_math as nbmath
 
 
 class SrvData:
-    srvSocket = None
-
-    conf = {
-        # Static vars (some are settable at start up by server command line switches and then do not change after that.)
-        'serverName': "NetBot Server",
-        'serverVersion': "2.2.0",
-
-        # Game and Tournament
-        'botsInGame': 4,  # Number of bots required to join before game can start.
-        'gamesToPlay': 10,  # Number of games to play before server quits.
-        'stepMax': 1000,  # After this many steps in a game all bots will be killed
-        # Amount of time server targets for each step. Server will sleep if game is running faster than this.
-        'stepSec': 0.05,
-        'startPermutations':  False,  # Use all permutations of each set of random start locations.
-        'simpleCollisions': False,  # Use simple collision system, affected by -hitdamage
-        'scanMaxDistance': 1415,  # Maximum distance a scan can detect a robot.
-
-        # Messaging
-        'dropRate': 11,  # Drop a messages every N messages. Best to use primes.
-        # Number of msgs from a bot that server will respond to each step. Others in Q will be dropped.
-        'botMsgsPerStep': 4,
-        'allowRejoin': True,  # Allows crashed bots to rejoin game in progress.
-        'noViewers': False,  # if True addViewerRequest messages will be rejected. 
-
-        # Sizes
-        # Area is a square with each side = arenaSize units (0,0 is bottom left,
-        # positive x is to right and positive y is up.)
-        'arenaSize': 1000,
-        'botRadius': 25,  # bots are circles with radius botRadius
-        'explRadius': 75,  # Radius of shell explosion. Beyond this radius bots will not take any damage.
-
-        # Speeds and Rates of Change
-        'botMaxSpeed': 5,  # bots distance traveled per step at 100% speed
-        'botAccRate': 2.0,  # Amount in % bot can accelerate (or decelerate) per step
-        'shellSpeed': 40,  # distance traveled by shell per step
-        'botMinTurnRate': math.pi / 6000,  # Amount bot can rotate per turn in radians at 100% speed
-        'botMaxTurnRate': math.pi / 50,  # Amount bot can rotate per turn in radians at 0% speed
-
-        # Damage
-        'hitDamage': 10,  # Damage a bot takes from hitting wall or another bot
-        # Damage bot takes from direct hit from shell. The further from shell explosion will result in less damage.
-        'explDamage': 10,
-        'botArmor': 1.0,  # Damage multiplier
-
-        # Obstacles (robots and shells are stopped by obstacles but obstacles are transparent to scan)
-        'obstacles': [],  # Obstacles of form [{'x':float,'y':float,'radius':float},...]
-        'obstacleRadius': 5,  # Radius of obstacles as % of arenaSize
-
-        # Jam Zones (robots fully inside jam zone are not detected by scan)
-        'jamZones': [],  # Jam Zones of form [{'x':float,'y':float,'radius':float},...]
-
-        # Misc
-        'keepExplosionSteps': 10,  # Number of steps to keep old explosions in explosion dict (only useful to viewers).
-        'maxSecsToJoin': 300,  # Number of secs server will wait for botsInGame bots to join before timeout and quit.
-
-        #Robot Classes (values below override what's above for robots in that class)
-        'allowClasses': False,
-        #Only fields listed in classFields are allowed to be overwritten by classes.
-        'classFields': ('botMaxSpeed', 'botAccRate', 'botMinTurnRate', 'botMaxTurnRate', 'botArmor', 'shellSpeed', 'explDamage', 'explRadius'),
-        'classes': {
-            'default': {
-                # Default class should have no changes.
-                },
-                
-            'heavy': {
-                # Speeds and Rates of Change
-                'botMaxSpeed': 0.7,  # multiplier for bot max speed
-                'botAccRate': 0.55,  # multiplier for bot acceleration rate
-                'botMinTurnRate': 0.923076923,  # multiplier for bot turning rate at 100% speed
-                'botMaxTurnRate': 0.333333333,  # multiplier for bot turning rate at 0% speed
-                'botArmor': 0.862  # multiplier of robot damage taken
-                },
-            
-            'light': {
-                # Speeds and Rates of Change
-                'botMaxSpeed': 2.8,  # multiplier for bot max speed
-                'botAccRate': 1.6,  # multiplier for bot acceleration rate
-                'botMinTurnRate': 1.4,  # multiplier for bot turning rate at 100% speed
-                'botMaxTurnRate': 1.75,  # multiplier for bot turning rate at 0% speed
-                'botArmor': 1.25  # multiplier of robot damage taken
-                },
-                
-            'machinegun': {
-                # Speeds and Rates of Change
-                'botMaxSpeed': 1.4,  # multiplier for bot max speed
-                'botAccRate': 1.2,  # multiplier for bot acceleration rate
-                'botMinTurnRate': 1.2,  # multiplier for bot turning rate at 100% speed
-                'botMaxTurnRate': 1.6,  # multiplier for bot turning rate at 0% speed
-                'botArmor': 0.93,  # multiplier of robot damage taken
-                'shellSpeed': 30,  # multiplier of distance traveled by shell per step
-                'explDamage': 0.237,
-                'explRadius': 1.1
-                },
-                
-            'sniper': {
-                # Speeds and Rates of Change
-                'botMaxSpeed': 1,  # multiplier for bot max speed
-                'botAccRate': 0.7,  # multiplier for bot acceleration rate
-                'botMinTurnRate': 1,  # multiplier for bot turning rate at 100% speed
-                'botMaxTurnRate': 0.8,  # multiplier for bot turning rate at 0% speed
-                'botArmor': 1.1,  # multiplier of robot damage taken
-                'shellSpeed': 3,  # multiplier of distance traveled by shell per step
-                'explDamage': 2.85,
-                'explRadius': 0.4
-                },
-                
-            'turtle': {
-                # Speeds and Rates of Change
-                'botMaxSpeed': 0.5,  # multiplier for bot max speed
-                'botAccRate': 0.15,  # multiplier for bot acceleration rate
-                'botMinTurnRate': 0.6,  # multiplier for bot turning rate at 100% speed
-                'botMaxTurnRate': 0.5,  # multiplier for bot turning rate at 0% speed
-                'botArmor': 0.83,  # multiplier of robot damage taken
-                'shellSpeed': 0.38,  # multiplier of distance traveled by shell per step
-                'explDamage': 2.8,
-                'explRadius': 1.6
-                }
-            }
-        }
-
-    state = {
-        # Dynamic vars (Note, these are not shared with robots so we also store server only conf here.)
-        'gameNumber': 0,
-        'gameStep': 0,
-        'dropNext': 10,  # Drop the next message in N (count down)
-        'dropCount': 0,  # How many messages have been dropped since start up.
-        'serverSteps': 0,  # Number of steps server has processed.
-        'stepTime': 0,  # Total time spent process steps
-        'msgTime': 0,  # Total time spent processing messages
-        'viewerMsgTime': 0,  # Total time spend sending information to the viewer
-        'startTime': time.time(),
-        'explIndex': 0,
-        'sleepTime': 0,
-        'sleepCount': 0,
-        'longStepCount': 0,
-        'tourStartTime': False,
-
-        # Server only conf which we don't want to share with robots
-        'onlyLastSb': False,  # Only print the scoreboard when the server quits, rather than after every game.
-        'jsonScoreboard': False,  # Save json formatted server data to filename before quiting.
-        }
-
-    starts = []  # [ [locIndex, locIndex, ...], [locIndex, locIndex, ...], ...]
-    startLocs = []  # [{'x': x, 'y' y},{'x': x, 'y' y},...]
-    startBots = []  # [src, src, ...]
-
-    bots = {}
+    # Templates used to make new bots, shells, explosions and viewers. These are only ever copied.
     botTemplate = {
         'name': "template",
         'class': "default",
@@ -182,6 +42,7 @@ class SrvData:
         'missedSteps': 0,
         'winHealth': 0,
         'winCount': 0,
+        'subscribeSteps': 0,  # send bot a botState msg every this many steps, 0 == never (see subscribeRequest)
         'last': {
             # Copies of last fire and scan requests. This data is not stored elsewhere
             # and is useful for viewer to display.
@@ -190,7 +51,6 @@ class SrvData:
             }
         }
 
-    shells = {}
     shellTemplate = {
         'x': 500,
         'y': 500,
@@ -198,7 +58,6 @@ class SrvData:
         'distanceRemaining': 100
         }
 
-    explosions = {}
     explosionTemplate = {
         'x': 500,
         'y': 500,
@@ -206,13 +65,212 @@ class SrvData:
         'src': ""  # this is needed by viewer to color this explosion
         }
 
-    viewers = {}
     viewerTemplate = {
         'lastKeepAlive': time.time(),
         'ip': "0.0.0.0",
-        'port': 20011
+        'port': 20011,
+        'version': 1,  # 1 == viewData msgs, 2 == viewFrame msgs (see netbots_viewdata.py)
+        'everyNSteps': 1,  # send viewer a frame at most every this many steps
+        'maxFps': 0,  # send viewer at most this many frames per sec, 0 == no limit
+        'needKeyframe': True  # version 2 only. Viewer has not been sent a keyframe yet.
         }
 
+    def __init__(self):
+        # All game data is per instance so many arenas can run in one process without sharing state.
+        self.srvSocket = None
+
+        self.conf = {
+            # Static vars (some are settable at start up by server command line switches and then do not change after that.)
+            'serverName': "NetBot Server",
+            'serverVersion': "2.2.0",
+
+            # Game and Tournament
+            'botsInGame': 4,  # Number of bots required to join before game can start.
+            'gamesToPlay': 10,  # Number of games to play before server quits.
+            'stepMax': 1000,  # After this many steps in a game all bots will be killed
+            # Amount of time server targets for each step. Server will sleep if game is running faster than this.
+            'stepSec': 0.05,
+            'startPermutations':  False,  # Use all permutations of each set of random start locations.
+            'simpleCollisions': False,  # Use simple collision system, affected by -hitdamage
+            'scanMaxDistance': 1415,  # Maximum distance a scan can detect a robot.
+
+            # Messaging
+            'dropRate': 11,  # Drop a messages every N messages. Best to use primes.
+            # Number of msgs from a bot that server will respond to each step. Others in Q will be dropped.
+            'botMsgsPerStep': 4,
+            'allowRejoin': True,  # Allows crashed bots to rejoin game in progress.
+            'noViewers': False,  # if True addViewerRequest messages will be rejected. 
+            # Step as soon as all alive bots have sent botMsgsPerStep msgs. stepSec becomes the max time to wait for them.
+            'lockstep': False,
+            # A multiScanRequest counts as one msg for each multiScanSlicesPerMsg slices (rounded up) against botMsgsPerStep.
+            'multiScanSlicesPerMsg': 4,
+            # Error replies to dead bots have retryAfter = retryAfterSteps * stepSec, the secs the bot should wait before
+            # sending again. Better still, the bot can send a waitForGameRequest.
+            'retryAfterSteps': 10,
+            # Secs the server holds a waitForGameRequest that has no maxSecs, and the most it holds one that does.
+            'waitForGameSecs': 10,
+            'maxWaitForGameSecs': 60,
+
+            # Sizes
+            # Area is a square with each side = arenaSize units (0,0 is bottom left,
+            # positive x is to right and positive y is up.)
+            'arenaSize': 1000,
+            'botRadius': 25,  # bots are circles with radius botRadius
+            'explRadius': 75,  # Radius of shell explosion. Beyond this radius bots will not take any damage.
+
+            # Speeds and Rates of Change
+            'botMaxSpeed': 5,  # bots distance traveled per step at 100% speed
+            'botAccRate': 2.0,  # Amount in % bot can accelerate (or decelerate) per step
+            'shellSpeed': 40,  # distance traveled by shell per step
+            'botMinTurnRate': math.pi / 6000,  # Amount bot can rotate per turn in radians at 100% speed
+            'botMaxTurnRate': math.pi / 50,  # Amount bot can rotate per turn in radians at 0% speed
+
+            # Damage
+            'hitDamage': 10,  # Damage a bot takes from hitting wall or another bot
+            # Damage bot takes from direct hit from shell. The further from shell explosion will result in less damage.
+            'explDamage': 10,
+            'botArmor': 1.0,  # Damage multiplier
+
+            # Obstacles (robots and shells are stopped by obstacles but obstacles are transparent to scan)
+            'obstacles': [],  # Obstacles of form [{'x':float,'y':float,'radius':float},...]
+            'obstacleRadius': 5,  # Radius of obstacles as % of arenaSize
+
+            # Jam Zones (robots fully inside jam zone are not detected by scan)
+            'jamZones': [],  # Jam Zones of form [{'x':float,'y':float,'radius':float},...]
+
+            # Misc
+            'keepExplosionSteps': 10,  # Number of steps to keep old explosions in explosion dict (only useful to viewers).
+            'maxSecsToJoin': 300,  # Number of secs server will wait for botsInGame bots to join before timeout and quit.
+
+            #Robot Classes (values below override what's above for robots in that class)
+            'allowClasses': False,
+            #Only fields listed in classFields are allowed to be overwritten by classes.
+            'classFields': ('botMaxSpeed', 'botAccRate', 'botMinTurnRate', 'botMaxTurnRate', 'botArmor', 'shellSpeed', 'explDamage', 'explRadius'),
+            'classes': {
+                'default': {
+                    # Default class should have no changes.
+                    },
+
+                'heavy': {
+                    # Speeds and Rates of Change
+                    'botMaxSpeed': 0.7,  # multiplier for bot max speed
+                    'botAccRate': 0.55,  # multiplier for bot acceleration rate
+                    'botMinTurnRate': 0.923076923,  # multiplier for bot turning rate at 100% speed
+                    'botMaxTurnRate': 0.333333333,  # multiplier for bot turning rate at 0% speed
+                    'botArmor': 0.862  # multiplier of robot damage taken
+                    },
+
+                'light': {
+                    # Speeds and Rates of Change
+                    'botMaxSpeed': 2.8,  # multiplier for bot max speed
+                    'botAccRate': 1.6,  # multiplier for bot acceleration rate
+                    'botMinTurnRate': 1.4,  # multiplier for bot turning rate at 100% speed
+                    'botMaxTurnRate': 1.75,  # multiplier for bot turning rate at 0% speed
+                    'botArmor': 1.25  # multiplier of robot damage taken
+                    },
+
+                'machinegun': {
+                    # Speeds and Rates of Change
+                    'botMaxSpeed': 1.4,  # multiplier for bot max speed
+                    'botAccRate': 1.2,  # multiplier for bot acceleration rate
+                    'botMinTurnRate': 1.2,  # multiplier for bot turning rate at 100% speed
+                    'botMaxTurnRate': 1.6,  # multiplier for bot turning rate at 0% speed
+                    'botArmor': 0.93,  # multiplier of robot damage taken
+                    'shellSpeed': 30,  # multiplier of distance traveled by shell per step
+                    'explDamage': 0.237,
+                    'explRadius': 1.1
+                    },
+
+                'sniper': {
+                    # Speeds and Rates of Change
+                    'botMaxSpeed': 1,  # multiplier for bot max speed
+                    'botAccRate': 0.7,  # multiplier for bot acceleration rate
+                    'botMinTurnRate': 1,  # multiplier for bot turning rate at 100% speed
+                    'botMaxTurnRate': 0.8,  # multiplier for bot turning rate at 0% speed
+                    'botArmor': 1.1,  # multiplier of robot damage taken
+                    'shellSpeed': 3,  # multiplier of distance traveled by shell per step
+                    'explDamage': 2.85,
+                    'explRadius': 0.4
+                    },
+
+                'turtle': {
+                    # Speeds and Rates of Change
+                    'botMaxSpeed': 0.5,  # multiplier for bot max speed
+                    'botAccRate': 0.15,  # multiplier for bot acceleration rate
+                    'botMinTurnRate': 0.6,  # multiplier for bot turning rate at 100% speed
+                    'botMaxTurnRate': 0.5,  # multiplier for bot turning rate at 0% speed
+                    'botArmor': 0.83,  # multiplier of robot damage taken
+                    'shellSpeed': 0.38,  # multiplier of distance traveled by shell per step
+                    'explDamage': 2.8,
+                    'explRadius': 1.6
+                    }
+                }
+            }
+
+        self.state = {
+            # Dynamic vars (Note, these are not shared with robots so we also store server only conf here.)
+            'gameNumber': 0,
+            'gameStep': 0,
+            'dropNext': 10,  # Drop the next message in N (count down)
+            'dropCount': 0,  # How many messages have been dropped since start up.
+            'serverSteps': 0,  # Number of steps server has processed.
+            'stepTime': 0,  # Total time spent process steps
+            'msgTime': 0,  # Total time spent processing messages
+            'viewerMsgTime': 0,  # Total time spend sending information to the viewer
+            'viewerSteps': 0,  # Times sendToViwers() has been called, once per server loop. Used for viewer everyNSteps.
+            'viewerFrames': 0,  # Frames (viewData or viewFrame) serialized for viewers.
+            'startTime': time.time(),
+            'explIndex': 0,
+            'sleepTime': 0,
+            'sleepCount': 0,
+            'longStepCount': 0,
+            'lockstepEarlyCount': 0,  # Steps ended early because all alive bots used their msg budget (-lockstep only)
+            'lockstepTimeoutCount': 0,  # Steps ended because stepSec passed before all bots used their budget (-lockstep only)
+            'tourStartTime': False,
+
+            # Server only conf which we don't want to share with robots
+            'onlyLastSb': False,  # Only print the scoreboard when the server quits, rather than after every game.
+            'jsonScoreboard': False,  # Save json formatted server data to filename before quiting.
+            'backend': 'python',  # 'python' or 'numpy'. Which code to use for the per bot phases of step().
+            'arena': 0,  # Index of this arena when server is hosting more than one (-arenas).
+            'shm': False,  # Use shared memory for bots on the same computer that ask for it (-shm).
+            }
+
+        self.deferredMsgs = []  # [(msg, ip, port), ...] msgs over budget held for next step (-lockstep only)
+        self.deferredMsgIDs = set()  # {(src, msgID), ...} of msgs held or answered from deferredMsgs this step
+        self.waitingBots = {}  # {src: (waitForGameRequest msg, time to give up), ...} see answerWaitingBots()
+
+        self.starts = []  # [ [locIndex, locIndex, ...], [locIndex, locIndex, ...], ...]
+        self.startLocs = []  # [{'x': x, 'y' y},{'x': x, 'y' y},...]
+        self.startBots = []  # [src, src, ...]
+
+        self.bots = {}  # {src: copy of botTemplate, ...}
+        self.shells = {}  # {src: copy of shellTemplate, ...}
+        self.explosions = {}  # {explIndex: copy of explosionTemplate, ...}
+        self.viewers = {}  # {src: copy of viewerTemplate, ...}
+        # {(version, everyNSteps, maxFps): {'nextFrameAt': time, 'encoder': ViewEncoder}, ...} see sendToViwers()
+        self.viewStreams = {}
+
+        # {class: {classField: value, ...}, ...} built by mkClassValues(), and again at the start of each game
+        self.classValues = mkClassValues(self)
+        self.obstacleGrid = None  # static grid of conf['obstacles'] built by mkObstacleGrid()
+        self.scanCache = None  # jammed bots and per bot scan indexes for the current step, see nbmsghl.getScanIndex()
+        self.botArrays = None  # bot fields kept in numpy arrays (-backend numpy only), see netbots_numpy.BotArrays
+        self.inputLog = None  # file the input log is written to (-inputlog only), see netbots_inputlog.py
+
+        # Main loop, see startStep() and endStep().
+        self.nextStepAt = 0  # time.perf_counter() the current step should end
+        self.botMsgCount = {}  # {src: count} of msgs received from each src this step
+        self.lockstepWait = False  # True if the current step ends once all alive bots used their msg budget
+
+        # Multi-arena server only (-arenas > 1). These are only used by the process that owns the socket.
+        self.arenas = []  # [{'conn': Connection, 'bots': int}, ...] index is the arena number
+        self.workers = []  # [multiprocessing.Process, ...] each plays some of the arenas, see startArenas()
+        self.arenaSrcs = {}  # {src: arena index, ...} which arena msgs from src are forwarded to
+
+        # Random numbers for layout (obstacles, jam zones and start locations). Seeded by -seed.
+        self.random = random.Random()
+
     def getClassValue(self, fld, c="default"):
         """
         Use this function to get values from SrvData.conf that respect robot class. 
@@ -231,12 +289,28 @@ class SrvData:
         
         return value
 
+    def syncBots(self):
+        """
+        With the numpy backend step() keeps x, y, currentSpeed and currentDirection in self.botArrays
+        and only copies them to self.bots when needed. Call this before reading those fields of every
+        bot outside of step(). Does nothing with the python backend.
+        """
+        if self.botArrays:
+            self.botArrays.syncDicts()
+
+    def syncBot(self, src):
+        """ Same as syncBots() for just bot src. """
+        if self.botArrays:
+            self.botArrays.syncBot(src)
+
 ########################################################
 # Bot Message Processing
 ########################################################
 
 
 def processMsg(d, msg, src):
+    d.syncBot(src)
+
     if msg['type'] == 'joinRequest':
         reply = nbmsghl.joinRequest(d, msg, src)
     elif msg['type'] == 'addViewerRequest':
@@ -245,13 +319,27 @@ def processMsg(d, msg, src):
         reply = nbmsghl.viewKeepAlive(d, msg, src)
     elif src in d.bots:  # all other messages are only allowed from bots that have joined the game
         # if this is a message type suppored by server
-        if hasattr(nbmsghl, msg['type']):
-            reply = getattr(nbmsghl, msg['type'])(d, msg, src)
+        handler = nbmsghl.requestHandlers.get(msg['type'])
+        if handler:
+            reply = handler(d, msg, src)
         else:
             reply = {'type': 'Error', 'result': "Msg type '" + msg['type'] + "' should not be sent to server."}
     else:
         reply = {'type': 'Error', 'result': "Bots that have not joined game may only send joinRequest Msg."}
 
+    # the msg may have changed requestedSpeed or requestedDirection.
+    if d.botArrays and msg['type'] in nbnumpy.requestMsgTypes:
+        d.botArrays.loadRequested(src)
+
+    # tell dead bots when it is worth trying again.
+    if reply and src in d.bots and d.bots[src]['health'] == 0:
+        if reply['type'] == 'Error':
+            reply['retryAfter'] = d.conf['retryAfterSteps'] * d.conf['stepSec']
+        elif reply['type'] == 'batchReply':
+            for subReply in reply['replies']:
+                if subReply['type'] == 'Error':
+                    subReply['retryAfter'] = d.conf['retryAfterSteps'] * d.conf['stepSec']
+
     # if the msg carried a msgId or replyData then copy it to the reply
     if reply:
         if 'msgID' in msg:
@@ -274,79 +362,265 @@ def dropMessage(d):
     return False
 
 
-def recvReplyMsgs(d):
-    # process all messages in socket recv buffer
+recvBatchSize = 64  # Max msgs taken from the socket by each NetBotSocket.recvMessages() call
+
+
+def recvReplyMsgs(d, botMsgCount, msgQ=None):
+    """
+    Process msgQ, a list of (msg, ip, port), followed by all messages in socket recv buffer.
+    Replies are sent in one batch once all the msgs have been processed.
+    botMsgCount is {src: count} of msgs received from each src this step. It is updated so
+    this can be called more than once per step without a bot going over botMsgsPerStep.
+    Msgs from the socket that are resends of a msg held in d.deferredMsgs, or answered from
+    it this step, are dropped so the request is only acted on once.
+    """
     startTime = time.perf_counter()
-    msgQ = []
-    more = True
-    while more:
-        try:
-            msgQ.append(d.srvSocket.recvMessage())
-        except nbipc.NetBotSocketException as e:
-            more = False
-        except Exception as e:
-            log(str(type(e)) + " " + str(e), "ERROR")
-            more = False
+    if msgQ is None:
+        msgQ = []
+    heldCount = len(msgQ)
+    replies = []  # [(reply, ip, port), ...] sent together after all msgs are processed
+    while True:
+        msgs = d.srvSocket.recvMessages(recvBatchSize)
+        msgQ.extend(msgs)
+        if len(msgs) < recvBatchSize:
+            break
 
-    botMsgCount = {}
-    for msg, ip, port in msgQ:
+    for i, (msg, ip, port) in enumerate(msgQ):
 
         src = nbipc.formatIpPort(ip, port)
 
+        if i >= heldCount and d.deferredMsgIDs and (src, msg.get('msgID')) in d.deferredMsgIDs:
+            continue
+
+        # A msg that costs more than a whole step's msgs would never be processed, so it is answered
+        # with an Error that costs one msg.
+        cost = getMsgCost(d, msg)
+        costError = None
+        if cost > d.conf['botMsgsPerStep']:
+            costError = msgCostError(d, msg, cost)
+            cost = 1
+
         # Track src counter and drop msg if we have already proccessed the max msgs for this src this step
         if src in botMsgCount:
-            botMsgCount[src] += 1
+            botMsgCount[src] += cost
         else:
-            botMsgCount[src] = 1
+            botMsgCount[src] = cost
         if botMsgCount[src] > d.conf['botMsgsPerStep']:
+            # In lockstep mode bots may send faster than steps are taken so hold the next
+            # step's worth of msgs rather than dropping them.
+            if d.conf['lockstep'] and botMsgCount[src] <= d.conf['botMsgsPerStep'] * 2:
+                d.deferredMsgs.append((msg, ip, port))
+                if 'msgID' in msg:
+                    d.deferredMsgIDs.add((src, msg['msgID']))
             continue
         
         if dropMessage(d):
             continue
 
-        reply = processMsg(d, msg, src)
+        if costError:
+            reply = costError
+        else:
+            reply = processMsg(d, msg, src)
+        if d.inputLog and msg['type'] not in ('addViewerRequest', 'viewKeepAlive') and \
+                not (reply and reply['type'] == 'Error'):
+            nbinputlog.writeRecord(d.inputLog, [nbinputlog.MSG, src, msg])
         if reply:
             if dropMessage(d):
                 continue
-            try:
-                d.srvSocket.sendMessage(reply, ip, port)
-            except Exception as e:
-                log(str(e), "ERROR")
+            replies.append((reply, ip, port))
+
+    # Replies are made by the server so they don't need to be checked again before sending.
+    d.srvSocket.sendMessages(replies)
+
+    d.state['msgTime'] += time.perf_counter() - startTime
+
+
+def recvStepMsgs(d):
+    """
+    Start counting a new step's msgs. Msgs held over from last step (-lockstep) are handled first,
+    then those in the socket recv buffer.
+    """
+    d.botMsgCount = {}
+    heldMsgs = d.deferredMsgs
+    d.deferredMsgs = []
+    # resends of held msgs that arrive this step are dropped, see recvReplyMsgs()
+    d.deferredMsgIDs = {(nbipc.formatIpPort(ip, port), msg['msgID']) for msg, ip, port in heldMsgs if 'msgID' in msg}
+    recvReplyMsgs(d, d.botMsgCount, heldMsgs)
+
+
+def getMsgCost(d, msg):
+    """ Return how many of a bot's botMsgsPerStep msg uses up. """
+    if msg['type'] == 'multiScanRequest':
+        return math.ceil(len(msg['slices']) / d.conf['multiScanSlicesPerMsg'])
+    if msg['type'] == 'batchRequest':
+        return sum(getMsgCost(d, request) for request in msg['requests'])
+    return 1
+
+
+def msgCostError(d, msg, cost):
+    """ Return the Error reply to msg, which costs more than botMsgsPerStep so can never be processed. """
+    reply = {'type': 'Error', 'result': "Msg type '" + msg['type'] + "' costs " + str(cost) +
+             " msgs, more than the " + str(d.conf['botMsgsPerStep']) + " msgs per step allowed."}
+    if 'msgID' in msg:
+        reply['msgID'] = msg['msgID']
+    if 'replyData' in msg:
+        reply['replyData'] = msg['replyData']
+    return reply
+
+
+def botsUsedMsgBudget(d, botMsgCount):
+    """ Returns True if every alive bot has sent botMsgsPerStep msgs this step. """
+    for src, bot in d.bots.items():
+        if bot['health'] != 0 and botMsgCount.get(src, 0) < d.conf['botMsgsPerStep']:
+            return False
+    return True
+
 
+def countMissedSteps(d, botMsgCount):
     if d.state['gameNumber'] > 0: # Don't count missed steps while waiting for bots to join.
         for src in d.bots:
-            if src not in botMsgCount:
+            # bots waiting for the next game (waitForGameRequest) have nothing to send.
+            if src not in botMsgCount and src not in d.waitingBots:
                 d.bots[src]['missedSteps'] += 1
 
-    d.state['msgTime'] += time.perf_counter() - startTime
+
+def answerWaitingBots(d):
+    """
+    Reply to each held waitForGameRequest (see nbmsghl.waitForGameRequest()) whose bot is now alive
+    in a game, or that has waited its maxSecs. Returns {src: reply, ...} of the replies made.
+    They are sent to the bots if the server has a socket (netbots_engine.Arena has none).
+    """
+    if not d.waitingBots:
+        return {}
+
+    now = time.time()
+    answered = {}
+    replies = []
+    for src, (msg, giveUpAt) in list(d.waitingBots.items()):
+        if d.bots[src]['health'] != 0 or giveUpAt <= now:
+            del d.waitingBots[src]
+            reply = {'type': 'waitForGameReply', 'gameNumber': d.state['gameNumber']}
+            if 'msgID' in msg:
+                reply['msgID'] = msg['msgID']
+            if 'replyData' in msg:
+                reply['replyData'] = msg['replyData']
+            answered[src] = reply
+            if d.srvSocket:
+                ip, port = src.rsplit(':', 1)
+                replies.append((reply, ip, int(port)))
+
+    if replies:
+        d.srvSocket.sendMessages(replies)
+    return answered
+
+
+def sendBotStates(d):
+    """
+    Push a botState msg to each bot that subscribed (subscribeRequest) and is due one after this step.
+    Returns {src: botState, ...}. They are sent to the bots if the server has a socket (netbots_engine.Arena
+    has none).
+    """
+    gameStep = d.state['gameStep']
+    botStates = {}
+    msgs = []
+    for src, bot in d.bots.items():
+        # bots waiting for the next game (waitForGameRequest) already know they are dead.
+        if bot['subscribeSteps'] and gameStep % bot['subscribeSteps'] == 0 and src not in d.waitingBots:
+            d.syncBot(src)
+            botStates[src] = {
+                'type': 'botState',
+                'gameNumber': d.state['gameNumber'],
+                'gameStep': gameStep,
+                'health': bot['health'],
+                'points': bot['points'],
+                'x': bot['x'],
+                'y': bot['y'],
+                'requestedSpeed': bot['requestedSpeed'],
+                'currentSpeed': bot['currentSpeed'],
+                'requestedDirection': bot['requestedDirection'],
+                'currentDirection': bot['currentDirection'],
+                'shellInProgress': src in d.shells
+                }
+            if d.srvSocket:
+                ip, port = src.rsplit(':', 1)
+                msgs.append((botStates[src], ip, int(port)))
+
+    if msgs:
+        d.srvSocket.sendMessages(msgs)
+    return botStates
 
 
 def sendToViwers(d):
+    d.state['viewerSteps'] += 1
     if len(d.viewers) == 0:
         return
 
     startTime = time.perf_counter()
 
     now = time.time()
-    bmsg = d.srvSocket.serialize({
-        'type': 'viewData',
-                'state': d.state,
-                'bots': d.bots,
-                'shells': d.shells,
-                'explosions': d.explosions
-        })
     for src in list(d.viewers.keys()):  # we need a list of keys so we can del from the viewers dict below
-        v = d.viewers[src]
-        if v['lastKeepAlive'] + 10 < now:
+        if d.viewers[src]['lastKeepAlive'] + 10 < now:
             del d.viewers[src]
             log("Viewer " + src + " didn't send keep alive in last 10 secs and was removed.")
+
+    # Viewers with the same version and cadence share a stream of frames. Each frame is only made for the
+    # streams that are due this step, and once for all the viewers in the stream, so a v2 delta is always
+    # from the frame the stream sent before.
+    streams = {}  # {(version, everyNSteps, maxFps): [viewer, ...], ...}
+    for v in d.viewers.values():
+        key = (v['version'], v['everyNSteps'], v['maxFps'])
+        if key in streams:
+            streams[key].append(v)
         else:
+            streams[key] = [v]
+    for key in list(d.viewStreams.keys()):
+        if key not in streams:
+            del d.viewStreams[key]
+
+    bmsg = None
+    for key, viewers in streams.items():
+        version, everyNSteps, maxFps = key
+        stream = d.viewStreams.get(key)
+        if stream is None:
+            stream = d.viewStreams[key] = {'nextFrameAt': now, 'encoder': nbviewdata.ViewEncoder()}
+
+        if d.state['viewerSteps'] % everyNSteps or now < stream['nextFrameAt']:
+            continue
+        if maxFps:
+            # Keep to the schedule, like the server steps, so frames average maxFps.
+            if now - stream['nextFrameAt'] < 1 / maxFps:
+                stream['nextFrameAt'] += 1 / maxFps
+            else:
+                stream['nextFrameAt'] = now + 1 / maxFps
+
+        d.syncBots()
+        if version == 2:
+            keyframe = any(v['needKeyframe'] for v in viewers)
+            frame = stream['encoder'].mkFrame(d, keyframe)
+            bframe = d.srvSocket.serialize(frame)
+            d.state['viewerFrames'] += 1
+        elif bmsg is None:
+            bmsg = d.srvSocket.serialize({
+                'type': 'viewData',
+                        'state': d.state,
+                        'bots': d.bots,
+                        'shells': d.shells,
+                        'explosions': d.explosions
+                })
+            d.state['viewerFrames'] += 1
+
+        for v in viewers:
             try:
                 # sending with a prepacked message makes it faster to send to a lot of viewers.
-                d.srvSocket.sendMessage(bmsg, v['ip'], v['port'], packedAndChecked=True)
+                if version == 2:
+                    d.srvSocket.sendMessage(bframe, v['ip'], v['port'], packedAndChecked=True)
+                    if frame['keyframe']:
+                        v['needKeyframe'] = False
+                else:
+                    d.srvSocket.sendMessage(bmsg, v['ip'], v['port'], packedAndChecked=True)
             except Exception as e:
                 log(str(e), "ERROR")
-                
+
     d.state['viewerMsgTime'] += time.perf_counter() - startTime
 
 ########################################################
@@ -363,12 +637,12 @@ def getHitSeverity(d, b1, a, b2 = None):
     'b2' is the other bot that collied if this is a bot on bot collision.
     '''
 
-    hitSeverity = b1['currentSpeed'] / 100.0 * d.getClassValue('botMaxSpeed', b1['class']) / \
+    hitSeverity = b1['currentSpeed'] / 100.0 * d.classValues[b1['class']]['botMaxSpeed'] / \
                           d.conf['botMaxSpeed'] * math.cos(b1['currentDirection'] - a)
     if b2:
         # This may reduce hitSeverity if b2 is moving away from b1 or
         # increase hitSeverity if b2 moving towards b1.
-        hitSeverity += b2['currentSpeed'] / 100.0 * d.getClassValue('botMaxSpeed', b2['class']) / \
+        hitSeverity += b2['currentSpeed'] / 100.0 * d.classValues[b2['class']]['botMaxSpeed'] / \
                           d.conf['botMaxSpeed'] * math.cos(b2['currentDirection'] - a + math.pi)
     if hitSeverity < 0:
         hitSeverity = 0
@@ -376,6 +650,56 @@ def getHitSeverity(d, b1, a, b2 = None):
     return hitSeverity
 
 
+def gridCell(d, x, y):
+    """ Return the (column, row) of the bot grid cell containing (x,y). Cells are one bot diameter wide. """
+    size = d.conf['botRadius'] * 2
+    return (int(x // size), int(y // size))
+
+
+def mkBotGrid(d, bots, keys):
+    """
+    Return a uniform grid of bots: {(column, row): [key, ...], ...}
+    Bots with health == 0 are left out. Because cells are one bot diameter wide a bot can only
+    overlap bots in its own cell or the 8 cells around it.
+    """
+    grid = {}
+    for k in keys:
+        bot = bots[k]
+        if 'health' not in bot or bot['health'] != 0:
+            cell = gridCell(d, bot['x'], bot['y'])
+            if cell in grid:
+                grid[cell].append(k)
+            else:
+                grid[cell] = [k]
+    return grid
+
+
+def moveBotInGrid(d, grid, k, bot, oldCell):
+    """ Move key k of bot to the correct grid cell after bot has moved away from oldCell. """
+    cell = gridCell(d, bot['x'], bot['y'])
+    if cell != oldCell:
+        grid[oldCell].remove(k)
+        if cell in grid:
+            grid[cell].append(k)
+        else:
+            grid[cell] = [k]
+
+
+def findOverlapingBotInGrid(d, bots, grid, k):
+    """ Return key of a bot in grid that overlaps bot k, else return None """
+    bot = bots[k]
+    col, row = gridCell(d, bot['x'], bot['y'])
+    for c in range(col - 1, col + 2):
+        for r in range(row - 1, row + 2):
+            if (c, r) in grid:
+                for k2 in grid[(c, r)]:
+                    if k2 != k:
+                        bot2 = bots[k2]
+                        if nbmath.distance(bot['x'], bot['y'], bot2['x'], bot2['y']) <= d.conf['botRadius'] * 2:
+                            return k2
+    return None
+
+
 def findOverlapingBots(d, bots):
     """
     bots is a dict/list of bot locations: {key:{'x': x,'y': y}, ...}
@@ -387,18 +711,72 @@ def findOverlapingBots(d, bots):
     except AttributeError:
         keys = range(len(bots))
 
-    for i in range(0, len(keys) - 1):
-        boti = bots[keys[i]]
-        if 'health' not in boti or boti['health'] != 0:
-            for j in range(i + 1, len(keys)):
-                botj = bots[keys[j]]
-                if 'health' not in botj or botj['health'] != 0:
-                    if nbmath.distance(boti['x'], boti['y'], botj['x'], botj['y']) <= d.conf['botRadius'] * 2:
-                        return [keys[i], keys[j]]
+    grid = mkBotGrid(d, bots, keys)
+    for cell in grid.values():
+        for k in cell:
+            k2 = findOverlapingBotInGrid(d, bots, grid, k)
+            if k2 is not None:
+                return [k, k2]
 
     return False
 
 
+def mkObstacleGrid(d):
+    """
+    Return a uniform grid of obstacles: {'obstacles': list, 'size': cellSize, 'cells': {(column, row): [index, ...], ...}}
+    Each obstacle index is added to every cell its bounding box touches, so a bot or shell path
+    touching an obstacle always shares at least one cell with it. Obstacles never move so this only
+    needs to be built once.
+    """
+    obstacles = d.conf['obstacles']
+    size = d.conf['botRadius'] * 2
+    for o in obstacles:
+        size = max(size, o['radius'] * 2)
+
+    cells = {}
+    for i, o in enumerate(obstacles):
+        for c in range(int((o['x'] - o['radius']) // size), int((o['x'] + o['radius']) // size) + 1):
+            for r in range(int((o['y'] - o['radius']) // size), int((o['y'] + o['radius']) // size) + 1):
+                if (c, r) in cells:
+                    cells[(c, r)].append(i)
+                else:
+                    cells[(c, r)] = [i]
+
+    return {'obstacles': obstacles, 'size': size, 'cells': cells}
+
+
+def findObstaclesInBox(d, minX, minY, maxX, maxY):
+    """
+    Return list of obstacles that may touch the box (minX, minY) to (maxX, maxY), in the same order
+    as conf['obstacles']. The obstacle grid is (re)built if conf['obstacles'] has been replaced.
+    """
+    grid = d.obstacleGrid
+    if grid is None or grid['obstacles'] is not d.conf['obstacles']:
+        grid = d.obstacleGrid = mkObstacleGrid(d)
+
+    cells = grid['cells']
+    if not cells:
+        return []
+
+    size = grid['size']
+    found = set()
+    for c in range(int(minX // size), int(maxX // size) + 1):
+        for r in range(int(minY // size), int(maxY // size) + 1):
+            if (c, r) in cells:
+                found.update(cells[(c, r)])
+
+    return [grid['obstacles'][i] for i in sorted(found)]
+
+
+def findOverlapingObstacle(d, bot):
+    """ Return the first obstacle that overlaps bot, else return None """
+    radius = d.conf['botRadius']
+    for obstacle in findObstaclesInBox(d, bot['x'] - radius, bot['y'] - radius, bot['x'] + radius, bot['y'] + radius):
+        if nbmath.distance(bot['x'], bot['y'], obstacle['x'], obstacle['y']) <= radius + obstacle['radius']:
+            return obstacle
+    return None
+
+
 def findOverlapingBotsAndObstacles(d, bots):
     """
     bots is a dict/list of bot locations: {key:{'x': x,'y': y}, ...}
@@ -414,10 +792,9 @@ def findOverlapingBotsAndObstacles(d, bots):
     for k in keys:
         bot = bots[k]
         if 'health' not in bot or bot['health'] != 0:
-            for obstacle in d.conf['obstacles']:
-                if nbmath.distance(bot['x'], bot['y'], obstacle['x'], obstacle['y']) <= \
-                        d.conf['botRadius'] + obstacle['radius']:
-                    return [k, obstacle]
+            obstacle = findOverlapingObstacle(d, bot)
+            if obstacle is not None:
+                return [k, obstacle]
 
     return False
 
@@ -435,8 +812,8 @@ def mkObstacles(d, n):
         while overlaps:
             attempts += 1
             new = {
-                'x': random.random() * (d.conf['arenaSize'] - rad * 8.1) + rad * 4.1,
-                'y': random.random() * (d.conf['arenaSize'] - rad * 8.1) + rad * 4.1,
+                'x': d.random.random() * (d.conf['arenaSize'] - rad * 8.1) + rad * 4.1,
+                'y': d.random.random() * (d.conf['arenaSize'] - rad * 8.1) + rad * 4.1,
                 'radius': rad
                 }
             overlaps = False
@@ -465,8 +842,8 @@ def mkJamZones(d, n):
 
     for i in range(n):
         jamZones.append({
-            'x': random.random() * d.conf['arenaSize'],
-            'y': random.random() * d.conf['arenaSize'],
+            'x': d.random.random() * d.conf['arenaSize'],
+            'y': d.random.random() * d.conf['arenaSize'],
             'radius': rad
             })
 
@@ -482,8 +859,8 @@ def mkStartLocations(d):
             startLocs = []
             for i in range(d.conf['botsInGame']):
                 loc = {}
-                loc['x'] = random.random() * (d.conf['arenaSize'] * 0.8) + (d.conf['arenaSize'] * 0.1)
-                loc['y'] = random.random() * (d.conf['arenaSize'] * 0.8) + (d.conf['arenaSize'] * 0.1)
+                loc['x'] = d.random.random() * (d.conf['arenaSize'] * 0.8) + (d.conf['arenaSize'] * 0.1)
+                loc['y'] = d.random.random() * (d.conf['arenaSize'] * 0.8) + (d.conf['arenaSize'] * 0.1)
                 startLocs.append(loc)
 
             botsOverlap = findOverlapingBots(d, startLocs)
@@ -506,7 +883,20 @@ def mkStartLocations(d):
         else:
             d.starts.append(list(locIndexes))
 
-    random.shuffle(d.starts)
+    d.random.shuffle(d.starts)
+
+
+def mkClassValues(d):
+    """
+    Return {class: {classField: value, ...}, ...} with the result of getClassValue() for every
+    class and class field so step() can look values up directly rather than resolving them on every use.
+    """
+    classValues = {}
+    for c in d.conf['classes']:
+        classValues[c] = {}
+        for fld in d.conf['classFields']:
+            classValues[c][fld] = d.getClassValue(fld, c)
+    return classValues
 
 
 def initGame(d):
@@ -517,6 +907,10 @@ def initGame(d):
     log("Starting Game " + str(d.state['gameNumber']))
 
     d.state['gameStep'] = 0
+
+    d.classValues = mkClassValues(d)
+    if d.botArrays:
+        d.botArrays.invalidate()
     
     """
     for each bot
@@ -542,28 +936,18 @@ def initGame(d):
     d.explosions = {}
 
 
-def step(d):
-    startTime = time.perf_counter()
-
-    d.state['gameStep'] += 1
-    d.state['serverSteps'] += 1
-
-    # for each bot that is alive, copy health to so we know what it was at the start of the step.
-    aliveBots = {}
-    for src, bot in d.bots.items():
-        if bot['health'] != 0:
-            aliveBots[src] = bot['health']
-
-    # for all bots that are alive
+def moveBots(d, aliveBots):
+    """ Change speed and direction of all bots in aliveBots towards their requested values and move them. """
     for src, bot in d.bots.items():
         if src in aliveBots:
+            cv = d.classValues[bot['class']]
             # change speed if needed
             if bot['currentSpeed'] > bot['requestedSpeed']:
-                bot['currentSpeed'] -= d.getClassValue('botAccRate', bot['class'])
+                bot['currentSpeed'] -= cv['botAccRate']
                 if bot['currentSpeed'] < bot['requestedSpeed']:
                     bot['currentSpeed'] = bot['requestedSpeed']
             elif bot['currentSpeed'] < bot['requestedSpeed']:
-                bot['currentSpeed'] += d.getClassValue('botAccRate', bot['class'])
+                bot['currentSpeed'] += cv['botAccRate']
                 if bot['currentSpeed'] > bot['requestedSpeed']:
                     bot['currentSpeed'] = bot['requestedSpeed']
 
@@ -574,9 +958,8 @@ def step(d):
                     bot['currentDirection'] = bot['requestedDirection']
                 else:
                     # how much can we turn at the speed we are going?
-                    turnRate = d.getClassValue('botMinTurnRate', bot['class']) \
-                        + (d.getClassValue('botMaxTurnRate', bot['class']) -
-                           d.getClassValue('botMinTurnRate', bot['class'])) \
+                    turnRate = cv['botMinTurnRate'] \
+                        + (cv['botMaxTurnRate'] - cv['botMinTurnRate']) \
                         * (1 - bot['currentSpeed'] / 100)
 
                     # if turn is negative and does not pass over 0 radians
@@ -610,48 +993,69 @@ def step(d):
             if bot['currentSpeed'] != 0:
                 bot['x'], bot['y'] = nbmath.project(bot['x'], bot['y'],
                                         bot['currentDirection'],
-                                        bot['currentSpeed'] / 100.0 * d.getClassValue('botMaxSpeed', bot['class']))
-
-    # set starting hitSeverity to 0 for all robots. hitSeverity == 0 means robot did not 
-    # hit anything this step.
-    for src, bot in d.bots.items():
-        bot['hitSeverity'] = 0.0
-
-    # do until we get one clean pass where no bot hitting wall, obstacle or other bot.
-    foundOverlap = True
-    while foundOverlap:
-        foundOverlap = False
+                                        bot['currentSpeed'] / 100.0 * cv['botMaxSpeed'])
 
-        # detect if bots hit walls. if they, did move them so they are just barely not touching,
-        for src, bot in d.bots.items():
-            hitSeverity = 0
-            if bot['x'] - d.conf['botRadius'] < 0:
-                # hit left side
-                bot['x'] = d.conf['botRadius'] + 1
-                hitSeverity = getHitSeverity(d, bot, math.pi)
-            if bot['x'] + d.conf['botRadius'] > d.conf['arenaSize']:
-                # hit right side
-                bot['x'] = d.conf['arenaSize'] - d.conf['botRadius'] - 1
-                hitSeverity = getHitSeverity(d, bot, 0)
-            if bot['y'] - d.conf['botRadius'] < 0:
-                # hit bottom side
-                bot['y'] = d.conf['botRadius'] + 1
-                hitSeverity = getHitSeverity(d, bot, math.pi * 3 / 2)
-            if bot['y'] + d.conf['botRadius'] > d.conf['arenaSize']:
-                # hit top side
-                bot['y'] = d.conf['arenaSize'] - d.conf['botRadius'] - 1
-                hitSeverity = getHitSeverity(d, bot, math.pi/2)
-    
-            if hitSeverity:
-                foundOverlap = True
-                bot['hitSeverity'] = max(bot['hitSeverity'], hitSeverity)
 
-        # detect if bots hit obstacles, if the did move them so they are just barely not touching,
-        overlap = findOverlapingBotsAndObstacles(d, d.bots)
-        while overlap:
-            foundOverlap = True
-            b = d.bots[overlap[0]]
-            o = overlap[1]
+def hitWalls(d):
+    """
+    Move bots that are past a wall so they are just barely not touching it and record hitSeverity.
+    Returns True if any bot hit a wall.
+    """
+    hitWall = False
+    for src, bot in d.bots.items():
+        hitSeverity = 0
+        if bot['x'] - d.conf['botRadius'] < 0:
+            # hit left side
+            bot['x'] = d.conf['botRadius'] + 1
+            hitSeverity = getHitSeverity(d, bot, math.pi)
+        if bot['x'] + d.conf['botRadius'] > d.conf['arenaSize']:
+            # hit right side
+            bot['x'] = d.conf['arenaSize'] - d.conf['botRadius'] - 1
+            hitSeverity = getHitSeverity(d, bot, 0)
+        if bot['y'] - d.conf['botRadius'] < 0:
+            # hit bottom side
+            bot['y'] = d.conf['botRadius'] + 1
+            hitSeverity = getHitSeverity(d, bot, math.pi * 3 / 2)
+        if bot['y'] + d.conf['botRadius'] > d.conf['arenaSize']:
+            # hit top side
+            bot['y'] = d.conf['arenaSize'] - d.conf['botRadius'] - 1
+            hitSeverity = getHitSeverity(d, bot, math.pi/2)
+
+        if hitSeverity:
+            hitWall = True
+            bot['hitSeverity'] = max(bot['hitSeverity'], hitSeverity)
+
+    return hitWall
+
+
+def explodeShell(d, src, shell):
+    """ Apply damage to alive bots within explRadius of shell fired by bot src. """
+    cv = d.classValues[d.bots[src]['class']]
+    explRadius = cv['explRadius']
+    for k, bot in d.bots.items():
+        if bot['health'] > 0:
+            distance = nbmath.distance(bot['x'], bot['y'], shell['x'], shell['y'])
+            if distance < explRadius:
+                damage = cv['explDamage'] * (1 - distance / explRadius)
+                bot['health'] = max(0, bot['health'] - (damage * d.classValues[bot['class']]['botArmor']))
+                # allow recording of inflicting damage that is greater than health of hit robot.
+                # also record damage to oneself.
+                d.bots[src]['shellDamage'] += damage
+
+
+def pushBotsOffObstacles(d, bots):
+    """
+    Move alive bots in bots, {key: bot, ...}, that overlap an obstacle so they are just barely not touching
+    and record hitSeverity. Returns True if any bot was moved.
+    """
+    moved = False
+    # Obstacles don't move so moving a bot can't make other bots overlap an obstacle.
+    for b in bots.values():
+        if b['health'] == 0:
+            continue
+        o = findOverlapingObstacle(d, b)
+        while o is not None:
+            moved = True
             # find angle to move bot directly away from obstacle
             a = nbmath.angle(o['x'], o['y'], b['x'], b['y'])
             # find min distance to move bot so it don't touch (plus 0.5 for safety).
@@ -661,76 +1065,154 @@ def step(d):
             # record damage
             hitSeverity = getHitSeverity(d, b, a + math.pi)
             b['hitSeverity'] = max(b['hitSeverity'], hitSeverity)
-            # check for more bots overlapping
-            overlap = findOverlapingBotsAndObstacles(d, d.bots)
-                    
-        # detect if bots hit other bots, if the did move them so they are just barely not touching,
-        overlap = findOverlapingBots(d, d.bots)
-        while overlap:
+            # check for bot overlapping another obstacle
+            o = findOverlapingObstacle(d, b)
+    return moved
+
+
+def separateBots(d, bots):
+    """
+    Move alive bots in bots, {key: bot, ...}, that overlap each other so they are just barely not touching
+    and record hitSeverity. Returns True if any bot was moved.
+    """
+    moved = False
+    # Only the two bots just moved can have a new overlap, so only they need to be checked again.
+    grid = mkBotGrid(d, bots, bots.keys())
+    toCheck = [k for k in bots if bots[k]['health'] != 0]
+    i = 0
+    while i < len(toCheck):
+        k1 = toCheck[i]
+        i += 1
+        k2 = findOverlapingBotInGrid(d, bots, grid, k1)
+        if k2 is None:
+            continue
+        moved = True
+        b1 = bots[k1]
+        b2 = bots[k2]
+        b1Cell = gridCell(d, b1['x'], b1['y'])
+        b2Cell = gridCell(d, b2['x'], b2['y'])
+        # find angle to move bot directly away from each other
+        a = nbmath.angle(b1['x'], b1['y'], b2['x'], b2['y'])
+        # find min distance to move each bot so they don't touch (plus 0.5 for saftly).
+        between = nbmath.distance(b1['x'], b1['y'], b2['x'], b2['y'])
+        distance = between / 2 - (between - d.conf['botRadius']) + 0.5
+        # move bots
+        b1['x'], b1['y'] = nbmath.project(b1['x'], b1['y'], a + math.pi, distance)
+        b2['x'], b2['y'] = nbmath.project(b2['x'], b2['y'], a, distance)
+        moveBotInGrid(d, grid, k1, b1, b1Cell)
+        moveBotInGrid(d, grid, k2, b2, b2Cell)
+        # record damage
+        hitSeverity = getHitSeverity(d, b1, a, b2)
+        b1['hitSeverity'] = max(b1['hitSeverity'], hitSeverity)
+        b2['hitSeverity'] = max(b2['hitSeverity'], hitSeverity)
+        # check moved bots for more overlaps
+        toCheck.append(k1)
+        toCheck.append(k2)
+    return moved
+
+
+def step(d):
+    startTime = time.perf_counter()
+
+    d.state['gameStep'] += 1
+    d.state['serverSteps'] += 1
+
+    numpyBackend = d.state['backend'] == 'numpy'
+
+    if numpyBackend:
+        aliveBots = nbnumpy.moveBots(d)
+    else:
+        # for each bot that is alive, copy health to so we know what it was at the start of the step.
+        aliveBots = {}
+        for src, bot in d.bots.items():
+            if bot['health'] != 0:
+                aliveBots[src] = bot['health']
+
+        moveBots(d, aliveBots)
+
+        # set starting hitSeverity to 0 for all robots. hitSeverity == 0 means robot did not
+        # hit anything this step.
+        for src, bot in d.bots.items():
+            bot['hitSeverity'] = 0.0
+
+    # do until we get one clean pass where no bot hitting wall, obstacle or other bot.
+    foundOverlap = True
+    while foundOverlap:
+        foundOverlap = False
+
+        # detect if bots hit walls. if they, did move them so they are just barely not touching,
+        if numpyBackend:
+            hitWall = nbnumpy.hitWalls(d)
+        else:
+            hitWall = hitWalls(d)
+        if hitWall:
             foundOverlap = True
-            b1 = d.bots[overlap[0]]
-            b2 = d.bots[overlap[1]]
-            # find angle to move bot directly away from each other
-            a = nbmath.angle(b1['x'], b1['y'], b2['x'], b2['y'])
-            # find min distance to move each bot so they don't touch (plus 0.5 for saftly).
-            between = nbmath.distance(b1['x'], b1['y'], b2['x'], b2['y'])
-            distance = between / 2 - (between - d.conf['botRadius']) + 0.5
-            # move bots
-            b1['x'], b1['y'] = nbmath.project(b1['x'], b1['y'], a + math.pi, distance)
-            b2['x'], b2['y'] = nbmath.project(b2['x'], b2['y'], a, distance)
-            # record damage
-            hitSeverity = getHitSeverity(d, b1, a, b2)
-            b1['hitSeverity'] = max(b1['hitSeverity'], hitSeverity)
-            b2['hitSeverity'] = max(b2['hitSeverity'], hitSeverity)
-            # check for more bots overlapping
-            overlap = findOverlapingBots(d, d.bots)
+
+        # detect if bots hit obstacles or other bots, if the did move them so they are just barely not touching.
+        # The numpy backend finds the few bots that overlap something with its arrays and only those are
+        # moved here, as bot dicts that are copied back into the arrays.
+        if numpyBackend:
+            bots = nbnumpy.obstacleBots(d)
+            if pushBotsOffObstacles(d, bots):
+                foundOverlap = True
+            nbnumpy.storeBots(d, bots)
+            bots = nbnumpy.overlapingBots(d)
+            if separateBots(d, bots):
+                foundOverlap = True
+            nbnumpy.storeBots(d, bots)
+        else:
+            if pushBotsOffObstacles(d, d.bots):
+                foundOverlap = True
+            if separateBots(d, d.bots):
+                foundOverlap = True
 
     # give damage (only once this step) to bots that hit things. Also stop them.
-    for src, bot in d.bots.items():
-        if bot['hitSeverity']:
-            if d.conf['simpleCollisions']:
-                bot['hitSeverity'] = 1
-            bot['health'] = max(0, bot['health'] - bot['hitSeverity'] * d.conf['hitDamage'] * d.getClassValue('botArmor', bot['class']))
-            bot['currentSpeed'] = 0
-            bot['requestedSpeed'] = 0
-        del bot['hitSeverity']
+    if numpyBackend:
+        nbnumpy.hitBots(d)
+    else:
+        for src, bot in d.bots.items():
+            if bot['hitSeverity']:
+                if d.conf['simpleCollisions']:
+                    bot['hitSeverity'] = 1
+                bot['health'] = max(0, bot['health'] - bot['hitSeverity'] * d.conf['hitDamage'] * d.classValues[bot['class']]['botArmor'])
+                bot['currentSpeed'] = 0
+                bot['requestedSpeed'] = 0
+            del bot['hitSeverity']
 
     # for all shells
     for src in list(d.shells.keys()):
         shell = d.shells[src]
+        cv = d.classValues[d.bots[src]['class']]
+        explRadius = cv['explRadius']
 
         # remember shells start point before moving
         oldx = shell['x']
         oldy = shell['y']
 
         # move shell
-        distance = min(d.getClassValue('shellSpeed', d.bots[src]['class']), shell['distanceRemaining'])
+        distance = min(cv['shellSpeed'], shell['distanceRemaining'])
         shell['x'], shell['y'] = nbmath.project(shell['x'], shell['y'], shell['direction'], distance)
         shell['distanceRemaining'] -= distance
 
         # did shell hit an obstacle?
         shellHitObstacle = False
-        for o in d.conf['obstacles']:
+        for o in findObstaclesInBox(d, min(oldx, shell['x']), min(oldy, shell['y']), max(oldx, shell['x']), max(oldy, shell['y'])):
             if nbmath.intersectLineCircle(oldx, oldy, shell['x'], shell['y'], o['x'], o['y'], o['radius']):
                 shellHitObstacle = True
+                break
 
         # if did not hit an obstacle and shell's explosion would touch inside of arena
         if not shellHitObstacle and \
-           (shell['x'] > d.getClassValue('explRadius', d.bots[src]['class']) * -1 and shell['x'] < d.conf['arenaSize'] + d.getClassValue('explRadius', d.bots[src]['class']) and
-                shell['y'] > d.getClassValue('explRadius', d.bots[src]['class']) * -1 and shell['y'] < d.conf['arenaSize'] + d.getClassValue('explRadius', d.bots[src]['class'])):
+           (shell['x'] > explRadius * -1 and shell['x'] < d.conf['arenaSize'] + explRadius and
+                shell['y'] > explRadius * -1 and shell['y'] < d.conf['arenaSize'] + explRadius):
 
             # if shell has reached it destination then explode.
             if shell['distanceRemaining'] <= 0:
                 # apply damage to bots.
-                for k, bot in d.bots.items():
-                    if bot['health'] > 0:
-                        distance = nbmath.distance(bot['x'], bot['y'], shell['x'], shell['y'])
-                        if distance < d.getClassValue('explRadius', d.bots[src]['class']):
-                            damage = d.getClassValue('explDamage', d.bots[src]['class']) * (1 - distance / d.getClassValue('explRadius', d.bots[src]['class']))
-                            bot['health'] = max(0, bot['health'] - (damage * d.getClassValue('botArmor', bot['class'])))
-                            # allow recording of inflicting damage that is greater than health of hit robot.
-                            # also record damage to oneself.
-                            d.bots[src]['shellDamage'] += damage
+                if numpyBackend:
+                    nbnumpy.explodeShell(d, src, shell)
+                else:
+                    explodeShell(d, src, shell)
 
                 # store the explosion so viewers can display it. we can't use src as index because it is possible for two explosions
                 # from same bot to exist (but not likly).
@@ -773,6 +1255,8 @@ def step(d):
         log("Game reached stepMax with more than one bot alive. Killing all bots.")
         for src in aliveBots:
             d.bots[src]['health'] = 0
+            if numpyBackend:
+                d.botArrays.setHealth(src, 0)
 
     # Assign points to bots that died this turn
     for src in list(aliveBots.keys()):
@@ -786,6 +1270,8 @@ def step(d):
         d.bots[src]['winHealth'] += d.bots[src]['health']
         d.bots[src]['winCount'] += 1
         d.bots[src]['health'] = 0
+        if numpyBackend:
+            d.botArrays.setHealth(src, 0)
         d.bots[src]['points'] += 10  # last robot (winner)
         del aliveBots[src]
 
@@ -809,6 +1295,7 @@ def logScoreboard(d):
         "\n                      Run Time: " + '%.3f' % (time.time() - d.state['startTime']) + " secs." +\
         "\nTime Processing Robot Messages: " + '%.3f' % (d.state['msgTime']) + " secs." +\
         "\n  Time Sending Viewer Messages: " + '%.3f' % (d.state['viewerMsgTime']) + " secs." +\
+        "\n                 Viewer Frames: " + str(d.state['viewerFrames']) +\
         "\n                   Messages In: " + str(totalRecv) +\
         "\n                  Messages Out: " + str(totalSent) +\
         "\n              Messages Dropped: " + str(d.state['dropCount']) +\
@@ -818,6 +1305,8 @@ def logScoreboard(d):
         "\n                 Time Sleeping: " + '%.3f' % (float(d.state['sleepTime'])) + " secs." +\
         "\n            Average Sleep Time: " + '%.6f' % (float(d.state['sleepTime']) / max(1, d.state['sleepCount'])) + " secs." +\
         "\n     Steps Slower Than stepSec: " + str(d.state['longStepCount']) + f" ({float(d.state['longStepCount']) / float(max(1,d.state['serverSteps'])) * 100.0:>4.2f}%)" +\
+        "\n          Lockstep Steps Early: " + str(d.state['lockstepEarlyCount']) +\
+        "\n        Lockstep Steps Timeout: " + str(d.state['lockstepTimeoutCount']) +\
         "\n\n" +\
         f"  {' ':>16}" +\
         f"  {'---- Score -----':>16}" +\
@@ -837,16 +1326,26 @@ def logScoreboard(d):
         f"  {'IP:Port':<21}" +\
         "\n ------------------------------------------------------------------------------------------------------------------"
 
-    botSort = sorted(d.bots, key=lambda b: d.bots[b]['points'], reverse=True)
+    output += scoreboardRows(d.bots, d.state['serverSteps'])
+
+    output += "\n ------------------------------------------------------------------------------------------------------------------\n\n"
+
+    log(output)
+
+
+def scoreboardRows(bots, serverSteps):
+    """ Return the scoreboard line for each bot in bots, most points first. """
+    output = ""
+    botSort = sorted(bots, key=lambda b: bots[b]['points'], reverse=True)
 
     totalPoints = 0.0
     for src in botSort:
-        totalPoints += d.bots[src]['points']
+        totalPoints += bots[src]['points']
     if totalPoints == 0:
         totalPoints = 1.0
 
     for src in botSort:
-        bot = d.bots[src]
+        bot = bots[src]
         output += "\n" +\
             f"  {bot['name']:>16}" +\
             f"  {bot['points']:>10}" +\
@@ -856,18 +1355,17 @@ def logScoreboard(d):
             f"  {bot['firedCount']:>7}" +\
             f"  {float(bot['shellDamage']) / max(1,bot['firedCount']):>10.2f}" +\
             f"  {float(bot['shellDamage']):>10.2f}" +\
-            f"  {float(bot['missedSteps'])/max(1,d.state['serverSteps'])*100.0:>4.1f}" +\
+            f"  {float(bot['missedSteps'])/max(1,serverSteps)*100.0:>4.1f}" +\
             f"  {src:<21}"
 
-    output += "\n ------------------------------------------------------------------------------------------------------------------\n\n"
-
-    log(output)
+    return output
 
 def jsonScoreboard(d):
     if d.state['jsonScoreboard']:
         d.state['tourEndTime'] = time.time()
         d.state['tourTime'] = d.state['tourEndTime'] - d.state['tourStartTime']
         d.state['longStepPercent'] = float(d.state['longStepCount']) / float(max(1,d.state['serverSteps'])) * 100.0
+        d.syncBots()
         with open(d.state['jsonScoreboard'],"w") as f: 
             f.write(json.dumps({'conf': d.conf,'state': d.state, 'bots': d.bots}))
 
@@ -891,20 +1389,398 @@ class Range(argparse.Action):
         setattr(namespace, self.dest, value)
         
 
+# [SrvData, ...] arenas still playing in this worker process, None if this is not a worker (see runArenas()).
+workerArenas = None
+
+
 def quit(signal=None, frame=None):
     global d
-    log(d.srvSocket.getStats())
-    logScoreboard(d)
+    if workerArenas is not None:
+        # arenas in this worker process that have not ended yet.
+        for arena in workerArenas:
+            endArena(arena)
+    elif d.workers:
+        # Each arena logs its own stats and scoreboard when it ends.
+        for worker in d.workers:
+            worker.join()
+    else:
+        endArena(d)
     log("Quiting", "INFO")
     exit()
 
 
+def endArena(d):
+    """ Log the stats and scoreboard of d and close its input log, and its pipe if it is one of many arenas. """
+    if d.srvSocket:
+        log(d.srvSocket.getStats())
+        logScoreboard(d)
+        if isinstance(d.srvSocket, nbipc.SharedNetBotSocket):
+            # the router stops forwarding msgs to an arena once its pipe is closed, see routeMsgs()
+            d.srvSocket.conn.close()
+    if d.inputLog:
+        d.inputLog.close()
+        d.inputLog = None
+
+
+def startStep(d):
+    """
+    Take a step, or start the next game, then answer the msgs waiting. Returns False, having done
+    nothing else, once all the games have been played or there are not enough bots to play.
+    """
+    aliveBots = 0
+    for src, bot in d.bots.items():
+        if bot['health'] != 0:
+            aliveBots += 1
+
+    # only count slow steps if we actually process a step this time around.
+    countSlowStep = False
+
+    if aliveBots > 0:  # if there is an ongoing game
+        countSlowStep = True
+        step(d)
+        if d.inputLog:
+            nbinputlog.writeRecord(d.inputLog, [nbinputlog.STEP, nbinputlog.stateHash(d)])
+        sendBotStates(d)
+    elif len(d.bots) == d.conf['botsInGame']:  # if we have enough bots to start playing
+        if not d.state['tourStartTime']:
+            d.state['tourStartTime'] = time.time()
+
+        if d.conf['gamesToPlay'] != d.state['gameNumber']:
+            if not d.state['onlyLastSb']:
+                logScoreboard(d)
+            initGame(d)
+            if d.inputLog:
+                nbinputlog.writeRecord(d.inputLog, [nbinputlog.INITGAME])
+        else:
+            log("All games have been played.")
+            jsonScoreboard(d)
+            return False
+    elif d.conf['maxSecsToJoin'] < float(time.time() - d.state['startTime']): 
+        log("Not enough bots joined game before max seconds to join (" + str(d.conf['maxSecsToJoin']) + " secs).", "ERROR")
+        if len(d.bots) >= 2:
+            d.conf['botsInGame'] = len(d.bots)
+            if d.inputLog:
+                nbinputlog.writeRecord(d.inputLog, [nbinputlog.BOTSINGAME, d.conf['botsInGame']])
+            log("Starting game with only " + str(d.conf['botsInGame']) + " bots.", "WARNING")
+        else:
+            log("Cannot start game with less than 2 bots. Exiting.", "FAILURE")
+            return False
+
+    answerWaitingBots(d)
+
+    recvStepMsgs(d)
+
+    sendToViwers(d)
+
+    d.lockstepWait = d.conf['lockstep'] and countSlowStep
+    ptime = time.perf_counter()
+    if ptime < d.nextStepAt:
+        d.state['sleepCount'] += 1
+    elif countSlowStep and not d.lockstepWait:
+        d.state['longStepCount'] += 1
+        log("Server running slower than " + str(d.conf['stepSec']) + " sec/step.", "VERBOSE")
+    return True
+
+
+def stepDone(d, ptime):
+    """
+    Returns True if the current step should end at ptime: stepSec has passed or, in lockstep mode,
+    every alive bot has used its msg budget.
+    """
+    return ptime >= d.nextStepAt or (d.lockstepWait and botsUsedMsgBudget(d, d.botMsgCount))
+
+
+def endStep(d, ptime):
+    """ Finish the current step, which ended at ptime, and set when the next one should end. """
+    if d.lockstepWait:
+        if ptime < d.nextStepAt:
+            d.state['lockstepEarlyCount'] += 1
+        else:
+            d.state['lockstepTimeoutCount'] += 1
+
+    countMissedSteps(d, d.botMsgCount)
+
+    if not d.lockstepWait and 0 <= ptime - d.nextStepAt < d.conf['stepSec']:
+        # Keep to the schedule so the small delay waking up from waitForMessage() doesn't add up.
+        d.nextStepAt += d.conf['stepSec']
+    else:
+        d.nextStepAt = ptime + d.conf['stepSec']
+
+
+def runGames(d):
+    """ Play d.conf['gamesToPlay'] games with bots that join over d.srvSocket. Calls quit() when done. """
+    d.nextStepAt = time.perf_counter() + d.conf['stepSec']
+    while startStep(d):
+        # Wait for the next step. Rather than busy waiting, block until a msg arrives and answer it right
+        # away (still respecting botMsgsPerStep). In lockstep mode stop waiting as soon as every alive bot
+        # has used its msg budget.
+        ptime = time.perf_counter()
+        while not stepDone(d, ptime):
+            msgReady = d.srvSocket.waitForMessage(d.nextStepAt - ptime)
+            waitEnd = time.perf_counter()
+            d.state['sleepTime'] += waitEnd - ptime
+            if msgReady:
+                recvReplyMsgs(d, d.botMsgCount)
+            ptime = time.perf_counter()
+        endStep(d, ptime)
+
+    quit()
+
+
+def runArenaGames(arenas):
+    """
+    Play the games of all of arenas, a list of SrvData that each have a SharedNetBotSocket, in
+    this process. Each arena keeps its own step times. Arenas are removed from the list as they
+    end, so the list holds the arenas still playing.
+    """
+    now = time.perf_counter()
+    for arena in arenas:
+        arena.nextStepAt = now + arena.conf['stepSec']
+    due = list(arenas)
+    while arenas:
+        for arena in due:
+            if not startStep(arena):
+                arenas.remove(arena)
+                endArena(arena)
+        if not arenas:
+            break
+
+        # Wait until the next step is due in any arena. Msgs are answered by their arena as they arrive.
+        ptime = time.perf_counter()
+        conns = {arena.srvSocket.conn: arena for arena in arenas}
+        if any(stepDone(arena, ptime) for arena in arenas):
+            timeout = 0  # lockstep arena whose bots have already used their msg budget.
+        else:
+            timeout = max(0, min(arena.nextStepAt for arena in arenas) - ptime)
+        ready = multiprocessing.connection.wait(list(conns), timeout)
+        waitEnd = time.perf_counter()
+        for arena in arenas:
+            arena.state['sleepTime'] += waitEnd - ptime  # every arena was idle while the worker waited.
+        for conn in ready:
+            recvReplyMsgs(conns[conn], conns[conn].botMsgCount)
+
+        ptime = time.perf_counter()
+        due = []
+        for arena in arenas:
+            if stepDone(arena, ptime):
+                endStep(arena, ptime)
+                due.append(arena)
+
+
+def startInputLog(d, filename, seed):
+    """ Open input log filename and write the header record. """
+    d.inputLog = nbinputlog.openInputLog(filename)
+    nbinputlog.writeRecord(d.inputLog, [nbinputlog.HEADER, {
+        'conf': d.conf,
+        'starts': d.starts,
+        'startLocs': d.startLocs,
+        'seed': seed,
+        'backend': d.state['backend']
+        }])
+
+########################################################
+# Multi-Arena Server
+########################################################
+
+
+def arenaFilename(filename, arena):
+    """ Return filename with the arena number added before the extension. eg. results.json -> results-2.json """
+    root, ext = os.path.splitext(filename)
+    return root + "-" + str(arena) + ext
+
+
+def runArenas(arenas, s, inputLog):
+    """
+    Worker process for some of the arenas. arenas is [(arenaData, conn, seed), ...]. Plays each
+    arena's games with the msgs forwarded to it over its conn.
+    """
+    global workerArenas  # global so quit() can access them.
+    workerArenas = []
+    signal.signal(signal.SIGINT, quit)
+    for arenaData, conn, seed in arenas:
+        arenaData.srvSocket = nbipc.SharedNetBotSocket(s, conn)
+        if inputLog:
+            startInputLog(arenaData, arenaFilename(inputLog, arenaData.state['arena']), seed)
+        workerArenas.append(arenaData)
+    runArenaGames(workerArenas)
+    quit()
+
+
+def startArenas(d, args):
+    """
+    Start a worker process for each cpu (or each arena if there are fewer arenas) and give each
+    worker every n'th of the args.arenas arenas to play.
+    """
+    workers = min(args.arenas, os.cpu_count() or 1)
+    d.arenas = [None] * args.arenas
+    for w in range(workers):
+        arenas = []
+        for i in range(w, args.arenas, workers):
+            a = SrvData()
+            seed = None if args.seed is None else args.seed + i
+            a.random.seed(seed)
+            configure(a, args)
+            a.conf['serverName'] = args.serverName + " (arena " + str(i) + ")"
+            a.state['arena'] = i
+            if args.jsonScoreboard:
+                a.state['jsonScoreboard'] = arenaFilename(args.jsonScoreboard, i)
+
+            recvConn, sendConn = multiprocessing.Pipe(duplex=False)
+            arenas.append((a, recvConn, seed))
+            d.arenas[i] = {'conn': sendConn, 'bots': 0}
+
+        p = multiprocessing.Process(target=runArenas, args=(arenas, d.srvSocket.s, args.inputLog))
+        p.start()
+        d.workers.append(p)
+        # Only the worker may hold the receiving ends, so a send fails once the worker closes one.
+        # Workers started later don't inherit them either.
+        for a, recvConn, seed in arenas:
+            recvConn.close()
+
+    if args.arenaMap:
+        with open(args.arenaMap) as f:
+            for src, arena in json.load(f).items():
+                d.arenaSrcs[src] = arena
+                d.arenas[arena]['bots'] += 1
+
+    log("Started " + str(len(d.arenas)) + " arenas in " + str(len(d.workers)) + " worker processes.")
+
+
+def pickArena(d, msgBytes, ip, port):
+    """
+    Return the arena index the msg from a src not yet in any arena should go to, or None if the
+    msg is not a joinRequest or addViewerRequest. The src is added to d.arenaSrcs. Bots are not
+    put in arenas that have ended (conn is None, see routeMsgs()).
+    """
+    try:
+        msg = nbipc.deserialize(msgBytes)
+    except Exception as e:
+        log(str(type(e)) + " " + str(e), "ERROR")
+        return None
+    if not nbipc.isValidMsg(msg):
+        return None
+
+    src = nbipc.formatIpPort(ip, port)
+    if msg['type'] in ('joinRequest', 'addViewerRequest'):
+        if 'arena' in msg:
+            arena = msg['arena']
+            if arena >= len(d.arenas) or d.arenas[arena]['conn'] is None:
+                reply = {'type': 'Error', 'result': "Arena " + str(arena) + " does not exist or has ended. Server has " +
+                         str(len(d.arenas)) + " arenas."}
+                if 'msgID' in msg:
+                    reply['msgID'] = msg['msgID']
+                d.srvSocket.sendMessage(reply, ip, port)
+                return None
+        elif msg['type'] == 'joinRequest':
+            # fill arenas in order, a bot that doesn't fit in any arena gets a game full error from arena 0.
+            arena = 0
+            for i, a in enumerate(d.arenas):
+                if a['conn'] is not None and a['bots'] < d.conf['botsInGame']:
+                    arena = i
+                    break
+        else:
+            arena = 0
+
+        d.arenaSrcs[src] = arena
+        if msg['type'] == 'joinRequest':
+            d.arenas[arena]['bots'] += 1
+        return arena
+
+    # d has no bots so this is the same error an arena would give.
+    reply = processMsg(d, msg, src)
+    if reply:
+        d.srvSocket.sendMessage(reply, ip, port)
+    return None
+
+
+def routeMsgs(d):
+    """ Forward all msgs in the socket recv buffer to the arena worker of their src. """
+    while True:
+        try:
+            msgBytes, ip, port = d.srvSocket.recvBytes()
+        except nbipc.NetBotSocketException:
+            return
+
+        src = nbipc.formatIpPort(ip, port)
+        if src in d.arenaSrcs:
+            arena = d.arenaSrcs[src]
+        else:
+            arena = pickArena(d, msgBytes, ip, port)
+            if arena is None:
+                continue
+
+        conn = d.arenas[arena]['conn']
+        if conn is None:
+            continue
+        try:
+            conn.send((msgBytes, ip, port))
+        except OSError:
+            # arena has played all its games and closed its pipe. Drop its srcs so their msgs
+            # are handled like those of any src not in an arena.
+            log("Arena " + str(arena) + " has ended. No longer forwarding msgs to it.", "INFO")
+            conn.close()
+            d.arenas[arena]['conn'] = None
+            for arenaSrc in [other for other, a in d.arenaSrcs.items() if a == arena]:
+                del d.arenaSrcs[arenaSrc]
+
+
+def routeArenas(d):
+    """ Forward msgs to arenas until all arena workers have quit. """
+    running = [worker.sentinel for worker in d.workers]
+    while running:
+        for ready in multiprocessing.connection.wait([d.srvSocket] + running):
+            if ready is d.srvSocket:
+                routeMsgs(d)
+            else:
+                running.remove(ready)
+
+    log("All arenas have quit.")
+    quit()
+
+
+def configure(d, args):
+    """ Set d.conf and d.state from command line args and lay out the arena with d.random. """
+    d.conf['serverName'] = args.serverName
+    d.conf['gamesToPlay'] = args.gamesToPlay
+    d.conf['botsInGame'] = args.botsInGame
+    d.conf['stepSec'] = args.stepSec
+    d.conf['lockstep'] = args.lockstep
+    d.conf['stepMax'] = args.stepMax
+    d.conf['dropRate'] = args.dropRate
+    d.state['dropNext'] = args.dropRate
+    d.conf['botMsgsPerStep'] = args.botMsgsPerStep
+    d.conf['multiScanSlicesPerMsg'] = args.multiScanSlicesPerMsg
+    d.conf['maxWaitForGameSecs'] = args.maxWaitForGameSecs
+    d.conf['waitForGameSecs'] = min(d.conf['waitForGameSecs'], args.maxWaitForGameSecs)
+    d.conf['arenaSize'] = args.arenaSize
+    d.conf['botRadius'] = args.botRadius
+    d.conf['explRadius'] = args.explRadius
+    d.conf['botMaxSpeed'] = args.botMaxSpeed
+    d.conf['botAccRate'] = args.botAccRate
+    d.conf['shellSpeed'] = args.shellSpeed
+    d.conf['hitDamage'] = args.hitDamage
+    d.conf['explDamage'] = args.explDamage
+    d.conf['obstacleRadius'] = args.obstacleRadius
+    d.conf['obstacles'] = mkObstacles(d, args.obstacles)
+    d.conf['jamZones'] = mkJamZones(d, args.jamZones)
+    d.conf['allowClasses'] = args.allowClasses
+    d.conf['simpleCollisions'] = args.simpleCollisions
+    d.conf['startPermutations'] = args.startPermutations
+    d.conf['scanMaxDistance'] = args.scanMaxDistance
+    d.conf['noViewers'] = args.noViewers
+    d.conf['maxSecsToJoin'] = args.maxSecsToJoin
+    d.state['onlyLastSb'] = args.onlyLastSb
+    d.state['jsonScoreboard'] = args.jsonScoreboard
+    d.state['backend'] = args.backend
+    d.state['shm'] = args.shm
+
+    mkStartLocations(d)
+
+
 def main():
     global d  # d is global so quit() can access it.
     d = SrvData()
 
-    random.seed()
-
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('-ip', metavar='Server_IP', dest='serverIP', type=nbipc.argParseCheckIPFormat,
                         default='127.0.0.1', help='My IP Address')
@@ -918,12 +1794,18 @@ def main():
                         default=4, help='Number of bots required to join before game can start.')
     parser.add_argument('-stepsec', metavar='sec', dest='stepSec', type=float,
                         default=0.05, help='How many seconds between server steps.')
+    parser.add_argument('-lockstep', dest='lockstep', action='store_true',
+                        default=False, help='Step as soon as all alive bots have sent -msgperstep msgs, waiting at most -stepsec.')
     parser.add_argument('-stepmax', metavar='int', dest='stepMax', type=int,
                         default=1000, help='Max steps in one game.')
     parser.add_argument('-droprate', metavar='int', dest='dropRate', type=int,
                         default=11, help='Drop over nth message, best to use primes. 0 == no drop.')
     parser.add_argument('-msgperstep', metavar='int', dest='botMsgsPerStep', type=int,
                         default=4, help='Number of msgs from a bot that server will respond to each step.')
+    parser.add_argument('-multiscanslices', dest='multiScanSlicesPerMsg', type=int, min=1, max=16, action=Range,
+                        default=4, help='Number of multiScanRequest slices that count as one msg against -msgperstep.')
+    parser.add_argument('-maxwaitforgame', dest='maxWaitForGameSecs', type=float, min=0, max=60, action=Range,
+                        default=60, help='Max secs a waitForGameRequest is held before the server replies.')
     parser.add_argument('-arenasize', dest='arenaSize', type=int, min=100, max=32767, action=Range,
                         default=1000, help='Size of arena.')
     parser.add_argument('-botradius', metavar='int', dest='botRadius', type=int,
@@ -962,6 +1844,18 @@ def main():
                         default=False, help='Only print the scoreboard when the server quits.')
     parser.add_argument('-jsonsb', metavar='filename', dest='jsonScoreboard', type=str,
                         default=False, help='Save json formatted server data to filename before quiting.')
+    parser.add_argument('-backend', dest='backend', type=str, choices=['python', 'numpy'],
+                        default='python', help='Keep bots in numpy arrays to move them, find collisions and explode shells. Faster with hundreds of bots, slower with a few. Requires numpy.')
+    parser.add_argument('-seed', metavar='int', dest='seed', type=int,
+                        default=None, help='Seed for obstacle, jam zone and start location layout. Same seed gives same layout.')
+    parser.add_argument('-inputlog', metavar='filename', dest='inputLog', type=str,
+                        default=None, help='Log accepted bot msgs and step state hashes to filename so games can be re-simulated with netbots_replay.py.')
+    parser.add_argument('-arenas', dest='arenas', type=int, min=1, max=256, action=Range,
+                        default=1, help='Number of games to host at once, played by one worker process per cpu. Bots pick an arena with the joinRequest arena field or are put in the first arena with room.')
+    parser.add_argument('-arenamap', metavar='filename', dest='arenaMap', type=str,
+                        default=None, help='JSON file of {"ip:port": arena, ...} for bots that should be put in a given arena (-arenas only).')
+    parser.add_argument('-shm', dest='shm', action='store_true',
+                        default=False, help='Send msgs through shared memory to bots on this computer that use -shm. Not with -arenas.')
     parser.add_argument('-debug', dest='debug', action='store_true',
                         default=False, help='Print DEBUG level log messages.')
     parser.add_argument('-verbose', dest='verbose', action='store_true',
@@ -969,35 +1863,8 @@ def main():
     args = parser.parse_args()
 
     setLogLevel(args.debug, args.verbose)
-    d.conf['serverName'] = args.serverName
-    d.conf['gamesToPlay'] = args.gamesToPlay
-    d.conf['botsInGame'] = args.botsInGame
-    d.conf['stepSec'] = args.stepSec
-    d.conf['stepMax'] = args.stepMax
-    d.conf['dropRate'] = args.dropRate
-    d.state['dropNext'] = args.dropRate
-    d.conf['botMsgsPerStep'] = args.botMsgsPerStep
-    d.conf['arenaSize'] = args.arenaSize
-    d.conf['botRadius'] = args.botRadius
-    d.conf['explRadius'] = args.explRadius
-    d.conf['botMaxSpeed'] = args.botMaxSpeed
-    d.conf['botAccRate'] = args.botAccRate
-    d.conf['shellSpeed'] = args.shellSpeed
-    d.conf['hitDamage'] = args.hitDamage
-    d.conf['explDamage'] = args.explDamage
-    d.conf['obstacleRadius'] = args.obstacleRadius
-    d.conf['obstacles'] = mkObstacles(d, args.obstacles)
-    d.conf['jamZones'] = mkJamZones(d, args.jamZones)
-    d.conf['allowClasses'] = args.allowClasses
-    d.conf['simpleCollisions'] = args.simpleCollisions
-    d.conf['startPermutations'] = args.startPermutations
-    d.conf['scanMaxDistance'] = args.scanMaxDistance
-    d.conf['noViewers'] = args.noViewers
-    d.conf['maxSecsToJoin'] = args.maxSecsToJoin
-    d.state['onlyLastSb'] = args.onlyLastSb
-    d.state['jsonScoreboard'] = args.jsonScoreboard
-
-    mkStartLocations(d)
+    d.random.seed(args.seed)
+    configure(d, args)
 
     log("Server Name: " + d.conf['serverName'])
     log("Server Version: " + d.conf['serverVersion'])
@@ -1005,61 +1872,30 @@ def main():
 
     log("Server Configuration: " + str(d.conf), "VERBOSE")
 
+    if d.state['backend'] == 'numpy' and not nbnumpy.available():
+        log("-backend numpy requires numpy. Install numpy or use -backend python.", "FAILURE")
+        quit()
+
+    if args.shm and args.arenas > 1:
+        log("-shm can't be used with -arenas.", "FAILURE")
+        quit()
+
     try:
-        d.srvSocket = nbipc.NetBotSocket(args.serverIP, args.serverPort)
+        if args.shm:
+            d.srvSocket = nbipc.ShmNetBotSocket(args.serverIP, args.serverPort)
+        else:
+            d.srvSocket = nbipc.NetBotSocket(args.serverIP, args.serverPort)
     except Exception as e:
         log(str(e), "FAILURE")
         quit()
 
-    nextStepAt = time.perf_counter() + d.conf['stepSec']
-    while True:
-        aliveBots = 0
-        for src, bot in d.bots.items():
-            if bot['health'] != 0:
-                aliveBots += 1
-
-        # only count slow steps if we actually process a step this time around.
-        countSlowStep = False
-
-        if aliveBots > 0:  # if there is an ongoing game
-            countSlowStep = True
-            step(d)
-        elif len(d.bots) == d.conf['botsInGame']:  # if we have enough bots to start playing
-            if not d.state['tourStartTime']:
-                d.state['tourStartTime'] = time.time()
-
-            if d.conf['gamesToPlay'] != d.state['gameNumber']:
-                if not d.state['onlyLastSb']:
-                    logScoreboard(d)
-                initGame(d)
-            else:
-                log("All games have been played.")
-                jsonScoreboard(d)
-                quit()
-        elif d.conf['maxSecsToJoin'] < float(time.time() - d.state['startTime']): 
-            log("Not enough bots joined game before max seconds to join (" + str(d.conf['maxSecsToJoin']) + " secs).", "ERROR")
-            if len(d.bots) >= 2:
-                d.conf['botsInGame'] = len(d.bots)
-                log("Starting game with only " + str(d.conf['botsInGame']) + " bots.", "WARNING")
-            else:
-                log("Cannot start game with less than 2 bots. Exiting.", "FAILURE")
-                quit()
-
-        recvReplyMsgs(d)
-
-        sendToViwers(d)
-
-        ptime = time.perf_counter()
-        if ptime < nextStepAt:
-            d.state['sleepCount'] += 1
-            d.state['sleepTime'] += nextStepAt - ptime
-            while ptime < nextStepAt:
-                ptime = time.perf_counter()
-        elif countSlowStep:
-            d.state['longStepCount'] += 1
-            log("Server running slower than " + str(d.conf['stepSec']) + " sec/step.", "VERBOSE")
-
-        nextStepAt = ptime + d.conf['stepSec']
+    if args.arenas > 1:
+        startArenas(d, args)
+        routeArenas(d)
+    else:
+        if args.inputLog:
+            startInputLog(d, args.inputLog, args.seed)
+        runGames(d)
 
 
 if __name__ == "__main__":
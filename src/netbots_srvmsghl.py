@@ -1,6 +1,8 @@
 import time
 import re
 import copy
+import bisect
+import math
 
 from netbots_log import log
 import netbots_math as nbmath
@@ -35,10 +37,17 @@ def joinRequest(d, msg, src):
         result = "OK"
         log("Bot joined game: " + d.bots[src]['name'] + " (" + src + ")")
 
-    log("Bots in Game: " + str(d.bots), "VERBOSE")
+    log("Bots in Game: %s", "VERBOSE", d.bots)
 
     if result == "OK":
-        return {'type': "joinReply", 'conf': d.conf}
+        reply = {'type': "joinReply", 'conf': d.conf}
+        # agree to the struct codec if the bot asked for it (see netbots_ipc.StructDef)
+        if msg.get('codec') == 'struct':
+            reply['codec'] = 'struct'
+        # offer to use the bot's shared memory segment if the server was started with -shm (see netbots_ipc.ShmNetBotSocket)
+        if 'shm' in msg and d.state['shm']:
+            reply['shm'] = msg['shm']
+        return reply
     else:
         return {'type': 'Error', 'result': result}
 
@@ -139,30 +148,103 @@ def fireCanonRequest(d, msg, src):
         }
 
 
+scanBlockSize = 16  # number of distances summarized by each block minimum in a scan index.
+
+
+def findJammedBots(d):
+    """ Return set of src of bots that are fully inside a jam zone and so can't be detected by scan. """
+    jammed = set()
+    for src, bot in d.bots.items():
+        for jz in d.conf['jamZones']:
+            if nbmath.distance(bot['x'], bot['y'], jz['x'], jz['y']) + d.conf['botRadius'] < jz['radius']:
+                jammed.add(src)
+                break
+    return jammed
+
+
+def getScanIndex(d, src):
+    """
+    Return scan index of what bot src can detect this step: {'angles': [], 'distances': [], 'blockMins': []}
+    angles (sorted) and distances are of every other alive, not jammed bot within scanMaxDistance.
+    blockMins[i] is min(distances[i * scanBlockSize:(i + 1) * scanBlockSize]).
+
+    Bots only move or die in step() and initGame() so the jammed set and indexes are cached
+    until gameNumber or gameStep changes.
+    """
+    stepKey = (d.state['gameNumber'], d.state['gameStep'])
+    if d.scanCache is None or d.scanCache['step'] != stepKey:
+        d.syncBots()
+        d.scanCache = {'step': stepKey, 'jammed': findJammedBots(d), 'indexes': {}}
+
+    indexes = d.scanCache['indexes']
+    if src not in indexes:
+        jammed = d.scanCache['jammed']
+        bot = d.bots[src]
+        x = bot['x']
+        y = bot['y']
+        scanMaxDistance = d.conf['scanMaxDistance']
+        found = []
+        for src2, bot2 in d.bots.items():
+            if src != src2 and bot2['health'] != 0 and src2 not in jammed:
+                # same as nbmath.distance() and nbmath.angle() without the calls, this is run for every pair of bots.
+                dx = bot2['x'] - x
+                dy = bot2['y'] - y
+                dis = math.sqrt(dx**2 + dy**2)
+                if dis <= scanMaxDistance and dis != 0:
+                    a = math.atan2(dy, dx)
+                    if a < 0:
+                        a = nbmath.normalizeAngle(a)
+                    found.append((a, dis))
+        found.sort()
+        distances = [dis for a, dis in found]
+        indexes[src] = {
+            'angles': [a for a, dis in found],
+            'distances': distances,
+            'blockMins': [min(distances[i:i + scanBlockSize]) for i in range(0, len(distances), scanBlockSize)]
+            }
+
+    return indexes[src]
+
+
+def minScanDistance(index, lo, hi):
+    """ Return min of index['distances'][lo:hi], or 0 if lo >= hi. """
+    if lo >= hi:
+        return 0
+
+    distances = index['distances']
+    firstBlock = -(-lo // scanBlockSize)
+    lastBlock = hi // scanBlockSize
+    if firstBlock >= lastBlock:
+        return min(distances[lo:hi])
+
+    return min(min(distances[lo:firstBlock * scanBlockSize], default=float('inf')),
+               min(index['blockMins'][firstBlock:lastBlock]),
+               min(distances[lastBlock * scanBlockSize:hi], default=float('inf')))
+
+
+def scanDistance(d, src, startRadians, endRadians):
+    """
+    Return distance to the nearest bot that bot src can detect between startRadians and
+    counter clockwise to endRadians, or 0 if there is none. Same angle rules as nbmath.contains().
+    """
+    index = getScanIndex(d, src)
+    angles = index['angles']
+    if startRadians >= endRadians:  # if we are scanning clockwise over 0 radians.
+        before0 = minScanDistance(index, bisect.bisect_left(angles, startRadians), len(angles))
+        after0 = minScanDistance(index, 0, bisect.bisect_right(angles, endRadians))
+        if before0 == 0 or after0 == 0:
+            return max(before0, after0)
+        return min(before0, after0)
+
+    return minScanDistance(index, bisect.bisect_left(angles, startRadians), bisect.bisect_right(angles, endRadians))
+
+
 def scanRequest(d, msg, src):
     if d.bots[src]['health'] == 0:
         return {'type': 'Error', 'result': "Can't process ScanRequest when health == 0"}
     else:
-        distance = 0
-        bot = d.bots[src]
-        for src2, bot2 in d.bots.items():
-            if src != src2 and bot2['health'] != 0:
-                # don't detect bot2 if it's fully inside a jam Zone.
-                jammed = False
-                for jz in d.conf['jamZones']:
-                    if nbmath.distance(bot2['x'], bot2['y'], jz['x'], jz['y']) + d.conf['botRadius'] < jz['radius']:
-                        jammed = True
-
-                if not jammed:
-                    dis = nbmath.contains(bot['x'], bot['y'], msg['startRadians'],
-                                          msg['endRadians'], bot2['x'], bot2['y'])
-                    
-                    if dis <= d.conf['scanMaxDistance'] and dis != 0:
-                        if distance == 0:
-                            distance = dis
-                        elif dis < distance:
-                            distance = dis
-        
+        distance = scanDistance(d, src, msg['startRadians'], msg['endRadians'])
+
         d.bots[src]['last']['scanRequest'] = {'startRadians': msg['startRadians'], 'endRadians': msg['endRadians']}
 
         return {
@@ -171,6 +253,62 @@ def scanRequest(d, msg, src):
         }
 
 
+def multiScanRequest(d, msg, src):
+    if d.bots[src]['health'] == 0:
+        return {'type': 'Error', 'result': "Can't process multiScanRequest when health == 0"}
+
+    for slice in msg['slices']:
+        if not isinstance(slice, (list, tuple)) or len(slice) != 2 or \
+                not all(isinstance(a, (int, float)) and 0 <= a <= math.pi * 2 for a in slice):
+            return {'type': 'Error', 'result': "multiScanRequest slices must be [startRadians, endRadians] with each between 0 and 2pi."}
+
+    distances = [scanDistance(d, src, slice[0], slice[1]) for slice in msg['slices']]
+
+    # viewer can only show one scan per bot so show the last slice.
+    d.bots[src]['last']['scanRequest'] = {'startRadians': msg['slices'][-1][0], 'endRadians': msg['slices'][-1][1]}
+
+    return {
+        'type': "multiScanReply",
+        'distances': distances
+    }
+
+
+def batchRequest(d, msg, src):
+    # Sub-requests are answered in order, exactly as if each had been sent on its own. An Error reply
+    # to one of them goes in replies like any other reply and does not stop the rest.
+    replies = []
+    for request in msg['requests']:
+        reply = requestHandlers[request['type']](d, request, src)
+        if 'msgID' in request:
+            reply['msgID'] = request['msgID']
+        if 'replyData' in request:
+            reply['replyData'] = request['replyData']
+        replies.append(reply)
+
+    return {
+        'type': "batchReply",
+        'replies': replies
+    }
+
+
+def subscribeRequest(d, msg, src):
+    # The server pushes a botState msg to this bot after every everyNSteps steps, see netbots_server.sendBotStates()
+    d.bots[src]['subscribeSteps'] = msg['everyNSteps']
+    return {'type': "subscribeReply"}
+
+
+def waitForGameRequest(d, msg, src):
+    if d.bots[src]['health'] != 0:
+        # bot is already playing in a game.
+        return {'type': "waitForGameReply", 'gameNumber': d.state['gameNumber']}
+
+    # Hold the msg without replying. netbots_server.answerWaitingBots() replies once the next game
+    # starts or maxSecs have passed. A resent request replaces the one being held.
+    maxSecs = min(msg.get('maxSecs', d.conf['waitForGameSecs']), d.conf['maxWaitForGameSecs'])
+    d.waitingBots[src] = (msg, time.time() + maxSecs)
+    return None
+
+
 def addViewerRequest(d, msg, src):
     if d.conf['noViewers']:
         return {'type': 'Error', 'result': "Viewers are not allowed to join."}
@@ -185,7 +323,11 @@ def addViewerRequest(d, msg, src):
         d.viewers[src] = {
             'lastKeepAlive': time.time(),
             'ip': ipPort[0],
-            'port': int(ipPort[1])
+            'port': int(ipPort[1]),
+            'version': msg.get('version', 1),
+            'everyNSteps': msg.get('everyNSteps', 1),
+            'maxFps': msg.get('maxFps', 0),
+            'needKeyframe': True
         }
         log("Viewer started watching game: " + src)
 
@@ -199,3 +341,10 @@ def viewKeepAlive(d, msg, src):
     if src in d.viewers:
         d.viewers[src]['lastKeepAlive'] = time.time()
     return None
+
+
+# {msg type: handler, ...} for the msgs bots that have joined may send, see netbots_server.processMsg()
+requestHandlers = {f.__name__: f for f in (
+    getInfoRequest, getLocationRequest, getSpeedRequest, setSpeedRequest, getDirectionRequest, setDirectionRequest,
+    getCanonRequest, fireCanonRequest, scanRequest, multiScanRequest, batchRequest, subscribeRequest,
+    waitForGameRequest, joinRequest, addViewerRequest, viewKeepAlive)}
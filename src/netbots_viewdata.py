@@ -0,0 +1,207 @@
+from operator import itemgetter
+
+############################################################
+# viewData v2: keyframes and deltas for viewers.
+#
+# A v1 viewer gets a viewData msg with all of d.state, d.bots,
+# d.shells and d.explosions every step. A viewer that asks for
+# version 2 in its addViewerRequest gets viewFrame msgs instead,
+# with just what the viewer draws:
+#
+# - Numbers are sent as fixed point ints, e.g. x = 123.456 is sent
+#   as round(123.456 * posScale) = 1235. Small ints are 1 to 3
+#   bytes in msgpack, a float is 9.
+# - Every keyframeEvery frames (and when a new viewer needs one) the
+#   frame is a keyframe with every bot and explosion. Other frames
+#   only have the bot field groups that changed since the frame
+#   before, the new explosions and the bots and explosions that are
+#   gone. Shells move every step so all shells are in every frame.
+#
+# Bot fields are sent in groups that tend to change together (see
+# botGroups) so finding what changed is one compare per group rather
+# than per field. Bots are [mask, value, value, ...] where bit i of
+# mask is set if the values of group i are included. Shells are
+# [x, y, direction] and explosions are [x, y, src].
+#
+# ViewDecoder rebuilds the same dicts a v1 viewData has so the
+# viewer draws both the same way. If a frame is lost the decoder
+# skips deltas until the next keyframe.
+#############################################################
+
+posScale = 10  # x and y to 0.1
+angleScale = 10000  # radians to 0.0001
+pctScale = 10  # health, speed and shellDamage to 0.1
+
+keyframeEvery = 50  # frames
+
+botGroups = (
+    ('name', 'class'),
+    ('health', 'points', 'firedCount', 'shellDamage'),
+    ('x', 'y', 'currentSpeed', 'currentDirection'),
+    ('requestedSpeed', 'requestedDirection', 'fireDirection', 'scanStart', 'scanEnd'),
+    )
+groupBits = tuple(1 << i for i in range(len(botGroups)))
+allBotGroups = sum(groupBits)
+
+getIdentity = itemgetter('name', 'class')
+getScore = itemgetter('health', 'points', 'firedCount', 'shellDamage')
+getMotion = itemgetter('x', 'y', 'currentSpeed', 'currentDirection')
+getRequested = itemgetter('requestedSpeed', 'requestedDirection')
+getScan = itemgetter('startRadians', 'endRadians')
+
+
+def rawBot(bot):
+    """ Return tuple of the bot's botGroups, each a tuple of the bot's values (not quantized). """
+    last = bot['last']
+    return (getIdentity(bot), getScore(bot), getMotion(bot),
+            getRequested(bot) + (last['fireCanonRequest']['direction'],) + getScan(last['scanRequest']))
+
+
+def quantizeScore(group):
+    health, points, firedCount, shellDamage = group
+    return round(health * pctScale), points, firedCount, round(shellDamage * pctScale)
+
+
+def quantizeMotion(group):
+    x, y, currentSpeed, currentDirection = group
+    return round(x * posScale), round(y * posScale), round(currentSpeed * pctScale), round(currentDirection * angleScale)
+
+
+def quantizeRequested(group):
+    requestedSpeed, requestedDirection, fireDirection, scanStart, scanEnd = group
+    return (round(requestedSpeed * pctScale), round(requestedDirection * angleScale), round(fireDirection * angleScale),
+            round(scanStart * angleScale), round(scanEnd * angleScale))
+
+
+groupQuantizers = (tuple, quantizeScore, quantizeMotion, quantizeRequested)  # one for each of botGroups
+
+
+def mkBot(q):
+    """ Return bot dict, with the fields the viewer uses, from q, the bot's quantized botGroups. """
+    (name, botClass), (health, points, firedCount, shellDamage), (x, y, currentSpeed, currentDirection), \
+        (requestedSpeed, requestedDirection, fireDirection, scanStart, scanEnd) = q
+    return {
+        'name': name,
+        'class': botClass,
+        'health': health / pctScale,
+        'x': x / posScale,
+        'y': y / posScale,
+        'currentSpeed': currentSpeed / pctScale,
+        'requestedSpeed': requestedSpeed / pctScale,
+        'currentDirection': currentDirection / angleScale,
+        'requestedDirection': requestedDirection / angleScale,
+        'points': points,
+        'firedCount': firedCount,
+        'shellDamage': shellDamage / pctScale,
+        'last': {
+            'fireCanonRequest': {'direction': fireDirection / angleScale},
+            'scanRequest': {'startRadians': scanStart / angleScale, 'endRadians': scanEnd / angleScale},
+            }
+        }
+
+
+class ViewEncoder:
+    """ Makes the viewFrame msgs for one stream of frames. Each frame is a delta from the one before. """
+
+    def __init__(self):
+        self.frame = -1  # frame 0, the first, is a keyframe
+        self.bots = {}  # {src: rawBot() tuple in last frame, ...}
+        self.explosions = set()  # keys of explosions in last frame
+
+    def mkFrame(self, d, keyframe=False):
+        """ Return viewFrame msg for the current state of d. A keyframe is made if keyframe is True or it is time for one. """
+        self.frame += 1
+        keyframe = keyframe or self.frame % keyframeEvery == 0
+
+        bots = {}
+        prevBots = self.bots
+        for src, bot in d.bots.items():
+            # Changes are found with the raw values, which is much faster than quantizing them all first.
+            raw = rawBot(bot)
+            prev = prevBots.get(src)
+            if keyframe or prev is None:
+                changed = bots[src] = [allBotGroups]
+                for quantize, group in zip(groupQuantizers, raw):
+                    changed.extend(quantize(group))
+            elif raw != prev:
+                mask = 0
+                changed = bots[src] = [mask]
+                for bit, quantize, group, prevGroup in zip(groupBits, groupQuantizers, raw, prev):
+                    if group != prevGroup:
+                        mask += bit
+                        changed.extend(quantize(group))
+                changed[0] = mask
+            prevBots[src] = raw
+        goneBots = [src for src in prevBots if src not in d.bots]
+        for src in goneBots:
+            del prevBots[src]
+
+        explosions = {}
+        for k, expl in d.explosions.items():
+            if keyframe or k not in self.explosions:
+                explosions[k] = [round(expl['x'] * posScale), round(expl['y'] * posScale), expl['src']]
+        goneExplosions = [k for k in self.explosions if k not in d.explosions]
+        self.explosions = set(d.explosions)
+
+        return {
+            'type': 'viewFrame',
+            'frame': self.frame,
+            'keyframe': keyframe,
+            'gameNumber': d.state['gameNumber'],
+            'gameStep': d.state['gameStep'],
+            'bots': bots,
+            'shells': {src: [round(shell['x'] * posScale), round(shell['y'] * posScale),
+                             round(shell['direction'] * angleScale)] for src, shell in d.shells.items()},
+            'explosions': explosions,
+            'goneBots': [] if keyframe else goneBots,
+            'goneExplosions': [] if keyframe else goneExplosions
+            }
+
+
+class ViewDecoder:
+    """ Rebuilds viewData from viewFrame msgs made by a ViewEncoder. """
+
+    def __init__(self):
+        self.frame = None  # None until the first keyframe
+        self.bots = {}  # {src: [group, ...] in botGroups order, ...}
+        self.explosions = {}  # {key: {'x': x, 'y': y, 'src': src}, ...}
+
+    def applyFrame(self, msg):
+        """
+        Apply viewFrame msg and return a v1 style viewData msg of the whole state. Returns None if
+        msg is a delta that can't be applied because a frame was missed, until the next keyframe.
+        """
+        if msg['keyframe']:
+            self.bots = {}
+            self.explosions = {}
+        elif self.frame is None or msg['frame'] != self.frame + 1:
+            self.frame = None
+            return None
+        self.frame = msg['frame']
+
+        for src, changed in msg['bots'].items():
+            groups = self.bots.get(src)
+            if groups is None:
+                groups = self.bots[src] = [None] * len(botGroups)
+            mask = changed[0]
+            n = 1
+            for i, fields in enumerate(botGroups):
+                if mask & groupBits[i]:
+                    groups[i] = changed[n:n + len(fields)]
+                    n += len(fields)
+        for src in msg['goneBots']:
+            self.bots.pop(src, None)
+
+        for k, (x, y, src) in msg['explosions'].items():
+            self.explosions[k] = {'x': x / posScale, 'y': y / posScale, 'src': src}
+        for k in msg['goneExplosions']:
+            self.explosions.pop(k, None)
+
+        return {
+            'type': 'viewData',
+            'state': {'gameNumber': msg['gameNumber'], 'gameStep': msg['gameStep']},
+            'bots': {src: mkBot(groups) for src, groups in self.bots.items()},
+            'shells': {src: {'x': x / posScale, 'y': y / posScale, 'direction': direction / angleScale}
+                       for src, (x, y, direction) in msg['shells'].items()},
+            'explosions': dict(self.explosions)
+            }
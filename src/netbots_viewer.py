@@ -10,6 +10,7 @@ from netbots_log import setLogLevel
 from netbots_server import SrvData
 import netbots_ipc as nbipc
 import netbots_math as nbmath
+import netbots_viewdata as nbviewdata
 
 
 class ViewerData():
@@ -41,6 +42,8 @@ class ViewerData():
     srvIP = None
     srvPort = None
     conf = None
+    frameSec = 0.05  # secs between frames from server
+    viewDecoder = nbviewdata.ViewDecoder()
     
     replayData = []
     playingData = []
@@ -73,14 +76,20 @@ def checkForUpdates(d):
     try:
         # keep getting messages until we get the last one and then an exception is thrown.
         while True:
-            msg, ip, port = d.viewerSocket.recvMessage()
-            
+            newMsg, ip, port = d.viewerSocket.recvMessage()
+            if newMsg['type'] == 'viewFrame':
+                # rebuild the full viewData from the keyframe/delta (see netbots_viewdata.py)
+                newMsg = d.viewDecoder.applyFrame(newMsg)
+                if newMsg is None:
+                    continue  # missed a frame, wait for the next keyframe.
+            msg = newMsg
+
             d.replayData.append(msg)
             while len(d.replayData) > d.replaySaveSteps / d.replaySaveEveryNth:
                 d.replayData.pop(0)
     except nbipc.NetBotSocketException as e:
         # if message type is Error and we have not got good data for 100 steps then quit
-        if msg['type'] == 'Error' and d.lastViewData + d.conf['stepSec'] * 100 < time.time():
+        if msg['type'] == 'Error' and d.lastViewData + d.frameSec * 100 < time.time():
             # We didn't get anything from the buffer or it was an invalid message.
             d.canvas.itemconfigure(d.bigMsg, text="Server stopped sending data.")
     except Exception as e:
@@ -337,8 +346,8 @@ def checkForUpdates(d):
 
     # normal wait
     else:
-        # Wait two steps before updating screen.
-        wakeat = int(d.conf['stepSec'] * 1000)
+        # Wait one frame before updating screen.
+        wakeat = max(1, int(d.frameSec * 1000))
 
     d.window.after(wakeat, checkForUpdates, d)
 
@@ -443,6 +452,8 @@ def main():
                         default=20000, help='Server port number')
     parser.add_argument('-randcolors', dest='randomColors', action='store_true',
                         default=False, help='Randomizes bot colors in viewer')
+    parser.add_argument('-maxfps', metavar='float', dest='maxFps', type=float,
+                        default=30, help='Most frames per second the server should send. 0 == one every step.')
     parser.add_argument('-debug', dest='debug', action='store_true',
                         default=False, help='Print DEBUG level log messages.')
     parser.add_argument('-verbose', dest='verbose', action='store_true',
@@ -456,7 +467,19 @@ def main():
 
     try:
         d.viewerSocket = nbipc.NetBotSocket(args.myIP, args.myPort, d.srvIP, d.srvPort)
-        reply = d.viewerSocket.sendRecvMessage({'type': 'addViewerRequest'}, retries=60, delay=1, delayMultiplier=1)
+        msg = {'type': 'addViewerRequest', 'version': 2}
+        if args.maxFps:
+            msg['maxFps'] = args.maxFps
+        try:
+            reply = d.viewerSocket.sendRecvMessage(msg, retries=10, delay=1, delayMultiplier=1)
+            # no point checking for frames more often than the server sends them.
+            d.frameSec = max(reply['conf']['stepSec'], 1 / args.maxFps if args.maxFps else 0)
+        except nbipc.NetBotSocketException as e:
+            # Older servers reply with an Error, or drop the msg, if it has version or maxFps. They send
+            # viewData every step, which checkForUpdates() takes as well as viewFrames.
+            log("Server did not accept version 2 view data (" + str(e) + "). Asking for version 1.", "WARNING")
+            reply = d.viewerSocket.sendRecvMessage({'type': 'addViewerRequest'}, retries=60, delay=1, delayMultiplier=1)
+            d.frameSec = reply['conf']['stepSec']
         d.conf = reply['conf']
         log("Server Configuration: " + str(d.conf), "VERBOSE")
     except Exception as e:
@@ -1,6 +1,14 @@
 import os
 import sys
 import math
+import random
+import copy
+import tempfile
+import threading
+import multiprocessing
+import time
+import asyncio
+from multiprocessing import shared_memory
 
 # include the netbot src directory in sys.path so we can import modules from it.
 robotpath = os.path.dirname(os.path.abspath(__file__))
@@ -9,7 +17,13 @@ sys.path.insert(0, srcpath)
 
 import netbots_server as nbsrv
 import netbots_ipc as nbipc
+import netbots_srvmsghl as nbmsghl
 import netbots_math as nbmath
+import netbots_numpy as nbnumpy
+import netbots_inputlog as nbinputlog
+import netbots_replay as nbreplay
+import netbots_engine as nbengine
+import netbots_viewdata as nbviewdata
 from netbots_log import setLogLevel
 from netbots_log import log
 
@@ -84,8 +98,1191 @@ def testHitSeverity():
     if round(nbsrv.getHitSeverity(d,b1, math.pi, b2),8) != round(0,8):
         log("test 19 failed","ERROR")
 
+def testFindOverlapingBots():
+    d = nbsrv.SrvData()
+    random.seed(1)
+
+    for t in range(200):
+        bots = []
+        for i in range(20):
+            bots.append({'x': random.random() * 600, 'y': random.random() * 600})
+
+        overlap = False
+        for i in range(len(bots)):
+            for j in range(i + 1, len(bots)):
+                if nbmath.distance(bots[i]['x'], bots[i]['y'], bots[j]['x'], bots[j]['y']) <= d.conf['botRadius'] * 2:
+                    overlap = True
+
+        found = nbsrv.findOverlapingBots(d, bots)
+        if bool(found) != overlap:
+            log("test 1 failed on layout " + str(t), "ERROR")
+        if found and nbmath.distance(bots[found[0]]['x'], bots[found[0]]['y'],
+                                     bots[found[1]]['x'], bots[found[1]]['y']) > d.conf['botRadius'] * 2:
+            log("test 2 failed on layout " + str(t), "ERROR")
+
+
+def testStepSeparatesBots():
+    d = nbsrv.SrvData()
+    random.seed(2)
+
+    for i in range(100):
+        bot = copy.deepcopy(d.botTemplate)
+        bot['health'] = 100
+        bot['x'] = random.random() * d.conf['arenaSize']
+        bot['y'] = random.random() * d.conf['arenaSize']
+        d.bots[i] = bot
+
+    nbsrv.step(d)
+
+    alive = [b for b in d.bots.values() if b['health'] != 0]
+    for i in range(len(alive)):
+        for j in range(i + 1, len(alive)):
+            if nbmath.distance(alive[i]['x'], alive[i]['y'], alive[j]['x'], alive[j]['y']) <= d.conf['botRadius'] * 2:
+                log("test 1 failed", "ERROR")
+                return
+
+
+def testObstacleGrid():
+    d = nbsrv.SrvData()
+    random.seed(4)
+    d.random.seed(4)
+    d.conf['obstacleRadius'] = 2
+    d.conf['obstacles'] = nbsrv.mkObstacles(d, 20)
+
+    for i in range(2000):
+        bot = {'x': random.random() * d.conf['arenaSize'], 'y': random.random() * d.conf['arenaSize']}
+        expected = None
+        for o in d.conf['obstacles']:
+            if nbmath.distance(bot['x'], bot['y'], o['x'], o['y']) <= d.conf['botRadius'] + o['radius']:
+                expected = o
+                break
+        if nbsrv.findOverlapingObstacle(d, bot) is not expected:
+            log("test 1 failed. bot: " + str(bot), "ERROR")
+            break
+
+    for i in range(2000):
+        x1 = random.random() * d.conf['arenaSize']
+        y1 = random.random() * d.conf['arenaSize']
+        x2, y2 = nbmath.project(x1, y1, random.random() * math.pi * 2, d.conf['shellSpeed'])
+        near = nbsrv.findObstaclesInBox(d, min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+        for o in d.conf['obstacles']:
+            if nbmath.intersectLineCircle(x1, y1, x2, y2, o['x'], o['y'], o['radius']) and o not in near:
+                log("test 2 failed. shell: " + str((x1, y1, x2, y2)) + " obstacle: " + str(o), "ERROR")
+                break
+
+
+def testScanRequest():
+    d = nbsrv.SrvData()
+    random.seed(5)
+    d.random.seed(5)
+    d.conf['jamZones'] = nbsrv.mkJamZones(d, 10)
+    d.conf['scanMaxDistance'] = 700
+
+    for i in range(60):
+        bot = copy.deepcopy(d.botTemplate)
+        bot['health'] = random.choice([0, 100, 100])
+        bot['x'] = random.random() * d.conf['arenaSize']
+        bot['y'] = random.random() * d.conf['arenaSize']
+        d.bots[i] = bot
+
+    for step in range(3):
+        d.state['gameStep'] += 1
+        for src, bot in d.bots.items():
+            bot['x'] = random.random() * d.conf['arenaSize']
+            bot['y'] = random.random() * d.conf['arenaSize']
+
+        for i in range(500):
+            src = random.choice([src for src in d.bots if d.bots[src]['health'] != 0])
+            startRadians = random.choice([0, math.pi, random.random() * math.pi * 2])
+            endRadians = random.choice([startRadians, random.random() * math.pi * 2, math.pi * 2])
+
+            # check every bot the slow way
+            expected = 0
+            bot = d.bots[src]
+            for src2, bot2 in d.bots.items():
+                if src != src2 and bot2['health'] != 0:
+                    jammed = False
+                    for jz in d.conf['jamZones']:
+                        if nbmath.distance(bot2['x'], bot2['y'], jz['x'], jz['y']) + d.conf['botRadius'] < jz['radius']:
+                            jammed = True
+                    if not jammed:
+                        dis = nbmath.contains(bot['x'], bot['y'], startRadians, endRadians, bot2['x'], bot2['y'])
+                        if dis <= d.conf['scanMaxDistance'] and dis != 0 and (expected == 0 or dis < expected):
+                            expected = dis
+
+            reply = nbmsghl.scanRequest(d, {'type': 'scanRequest', 'startRadians': startRadians, 'endRadians': endRadians}, src)
+            if reply['distance'] != expected:
+                log("test 1 failed. scan from " + str(src) + " " + str((startRadians, endRadians)) + " got " +
+                    str(reply['distance']) + " expected " + str(expected), "ERROR")
+                return
+
+        # multiScanRequest must give the same distances as one scanRequest per slice.
+        src = random.choice([src for src in d.bots if d.bots[src]['health'] != 0])
+        slices = [[math.pi * i / 8, math.pi * (i + 1) / 8] for i in range(16)]
+        reply = nbmsghl.multiScanRequest(d, {'type': 'multiScanRequest', 'slices': slices}, src)
+        for slice, distance in zip(slices, reply['distances']):
+            scanReply = nbmsghl.scanRequest(d, {'type': 'scanRequest', 'startRadians': slice[0], 'endRadians': slice[1]}, src)
+            if scanReply['distance'] != distance:
+                log("test 2 failed. multiScan slice " + str(slice) + " got " + str(distance) +
+                    " expected " + str(scanReply['distance']), "ERROR")
+                return
+
+
+def testBatchRequest():
+    d = nbsrv.SrvData()
+    d.conf['botsInGame'] = 2
+    nbsrv.processMsg(d, {'type': 'joinRequest', 'name': 'a'}, '127.0.0.1:1')
+    nbsrv.processMsg(d, {'type': 'joinRequest', 'name': 'b'}, '127.0.0.1:2')
+    nbsrv.mkStartLocations(d)
+    nbsrv.initGame(d)
+
+    requests = [{'type': 'getInfoRequest', 'replyData': 'info'},
+                {'type': 'setSpeedRequest', 'requestedSpeed': 50},
+                {'type': 'getSpeedRequest'},
+                {'type': 'multiScanRequest', 'slices': [[0, math.pi], [math.pi, math.pi * 2]]},
+                {'type': 'getLocationRequest'}]
+    msg = {'type': 'batchRequest', 'requests': requests, 'msgID': 7}
+    # each sub-request counts against botMsgsPerStep as if it was sent on its own.
+    if nbsrv.getMsgCost(d, msg) != 5:
+        log("test 1 failed. batchRequest cost " + str(nbsrv.getMsgCost(d, msg)), "ERROR")
+
+    reply = nbsrv.processMsg(d, msg, '127.0.0.1:1')
+    expected = [nbsrv.processMsg(d, request, '127.0.0.1:1') for request in requests]
+    if reply != {'type': 'batchReply', 'replies': expected, 'msgID': 7} or not nbipc.isValidMsg(reply) or \
+            d.bots['127.0.0.1:1']['requestedSpeed'] != 50:
+        log("test 2 failed. got " + str(reply) + " expected " + str(expected), "ERROR")
+
+    # an Error for one sub-request does not stop the others.
+    d.bots['127.0.0.1:1']['health'] = 0
+    reply = nbsrv.processMsg(d, msg, '127.0.0.1:1')
+    if [r['type'] for r in reply['replies']] != ['getInfoReply', 'Error', 'Error', 'Error', 'Error']:
+        log("test 3 failed. got " + str(reply), "ERROR")
+
+    # a batch that costs more than botMsgsPerStep could never be processed so it gets an Error, and
+    # only uses one of the bot's msgs.
+    d = nbsrv.SrvData()
+    d.srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    botSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    botPort = botSocket.s.getsockname()[1]
+    nbsrv.processMsg(d, {'type': 'joinRequest', 'name': 'a'}, nbipc.formatIpPort('127.0.0.1', botPort))
+    botMsgCount = {}
+    nbsrv.recvReplyMsgs(d, botMsgCount, [(msg, '127.0.0.1', botPort),
+                                         ({'type': 'getInfoRequest', 'msgID': 8}, '127.0.0.1', botPort)])
+    botSocket.waitForMessage(1)
+    time.sleep(0.05)
+    got = [reply for reply, ip, port in botSocket.recvMessages()]
+    if [(r['type'], r['msgID']) for r in got] != [('Error', 7), ('getInfoReply', 8)] or \
+            botMsgCount[nbipc.formatIpPort('127.0.0.1', botPort)] != 2:
+        log("test 4 failed. got " + str(got) + " botMsgCount " + str(botMsgCount), "ERROR")
+    botSocket.s.close()
+    d.srvSocket.s.close()
+
+    # same in an Arena.
+    got = []
+    arena = nbengine.Arena(seed=1)
+    arena.addRobot("batcher", lambda replies: got.append(replies) or [msg, {'type': 'getInfoRequest'}])
+    arena.addRobot("idle", lambda replies: [])
+    arena.playRobots()
+    arena.playRobots()
+    if [r['type'] for r in got[1]] != ['Error', 'getInfoReply']:
+        log("test 5 failed. got " + str(got[1]), "ERROR")
+
+
+def testSubscribeRequest():
+    d = nbsrv.SrvData()
+    d.srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    botSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    src = nbipc.formatIpPort('127.0.0.1', botSocket.s.getsockname()[1])
+    d.conf['botsInGame'] = 2
+    nbsrv.processMsg(d, {'type': 'joinRequest', 'name': 'a'}, src)
+    nbsrv.processMsg(d, {'type': 'joinRequest', 'name': 'b'}, '127.0.0.1:2')
+    nbsrv.mkStartLocations(d)
+    nbsrv.initGame(d)
+
+    reply = nbsrv.processMsg(d, {'type': 'subscribeRequest', 'everyNSteps': 2}, src)
+    got = []
+    for step in range(4):
+        nbsrv.step(d)
+        nbsrv.sendBotStates(d)
+        got.append(botSocket.recvBotState(0.2))
+
+    bot = d.bots[src]
+    if reply != {'type': 'subscribeReply'} or got[0] is not None or got[2] is not None or \
+            got[3] != {'type': 'botState', 'gameNumber': 1, 'gameStep': 4, 'health': bot['health'],
+                       'points': bot['points'], 'x': bot['x'], 'y': bot['y'],
+                       'requestedSpeed': bot['requestedSpeed'], 'currentSpeed': bot['currentSpeed'],
+                       'requestedDirection': bot['requestedDirection'], 'currentDirection': bot['currentDirection'],
+                       'shellInProgress': False}:
+        log("test 1 failed. got " + str(got), "ERROR")
+
+    # a robot that fell behind gets the newest state.
+    nbsrv.processMsg(d, {'type': 'subscribeRequest', 'everyNSteps': 1}, src)
+    for step in range(3):
+        nbsrv.step(d)
+        nbsrv.sendBotStates(d)
+    time.sleep(0.05)
+    botState = botSocket.recvBotState(0.2)
+    if not botState or botState['gameStep'] != 7 or botSocket.recvBotState(0.05) is not None:
+        log("test 2 failed. got " + str(botState), "ERROR")
+
+    nbsrv.processMsg(d, {'type': 'subscribeRequest', 'everyNSteps': 0}, src)
+    nbsrv.step(d)
+    nbsrv.sendBotStates(d)
+    if botSocket.recvBotState(0.05) is not None:
+        log("test 3 failed. botState sent after unsubscribe.", "ERROR")
+
+    botSocket.s.close()
+    d.srvSocket.s.close()
+
+
+def testWaitForGameRequest():
+    d = nbsrv.SrvData()
+    d.srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    botSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    src = nbipc.formatIpPort('127.0.0.1', botSocket.s.getsockname()[1])
+    d.conf['botsInGame'] = 2
+    nbsrv.processMsg(d, {'type': 'joinRequest', 'name': 'a'}, src)
+    nbsrv.processMsg(d, {'type': 'joinRequest', 'name': 'b'}, '127.0.0.1:2')
+    nbsrv.mkStartLocations(d)
+
+    # dead bots get told when to try again.
+    reply = nbsrv.processMsg(d, {'type': 'setSpeedRequest', 'requestedSpeed': 10}, src)
+    if reply.get('retryAfter') != d.conf['retryAfterSteps'] * d.conf['stepSec'] or not nbipc.isValidMsg(reply):
+        log("test 1 failed. got " + str(reply), "ERROR")
+
+    # request is held until the game starts.
+    reply = nbsrv.processMsg(d, {'type': 'waitForGameRequest', 'msgID': 9}, src)
+    nbsrv.answerWaitingBots(d)
+    if reply is not None or botSocket.waitForMessage(0.05):
+        log("test 2 failed. waitForGameRequest was answered before game started. got " + str(reply), "ERROR")
+    nbsrv.initGame(d)
+    nbsrv.answerWaitingBots(d)
+    botSocket.waitForMessage(1)
+    msgs = [msg for msg, ip, port in botSocket.recvMessages()]
+    if msgs != [{'type': 'waitForGameReply', 'gameNumber': 1, 'msgID': 9}] or d.waitingBots:
+        log("test 3 failed. got " + str(msgs), "ERROR")
+
+    # alive bots are answered at once, and dead ones after maxSecs.
+    reply = nbsrv.processMsg(d, {'type': 'waitForGameRequest'}, src)
+    d.bots[src]['health'] = 0
+    held = nbsrv.processMsg(d, {'type': 'waitForGameRequest', 'maxSecs': 0}, src)
+    nbsrv.answerWaitingBots(d)
+    botSocket.waitForMessage(1)
+    msgs = [msg for msg, ip, port in botSocket.recvMessages()]
+    if reply != {'type': 'waitForGameReply', 'gameNumber': 1} or held is not None or \
+            msgs != [{'type': 'waitForGameReply', 'gameNumber': 1}]:
+        log("test 4 failed. got " + str(reply) + " " + str(held) + " " + str(msgs), "ERROR")
+
+    # so do Errors in a batchReply.
+    reply = nbsrv.processMsg(d, {'type': 'batchRequest', 'requests': [
+        {'type': 'getInfoRequest'}, {'type': 'setSpeedRequest', 'requestedSpeed': 10}]}, src)
+    if 'retryAfter' in reply['replies'][0] or \
+            reply['replies'][1].get('retryAfter') != d.conf['retryAfterSteps'] * d.conf['stepSec']:
+        log("test 5 failed. got " + str(reply), "ERROR")
+
+    # maxSecs defaults to conf['waitForGameSecs'] and is at most conf['maxWaitForGameSecs'].
+    d.conf['maxWaitForGameSecs'] = 20
+    now = time.time()
+    nbsrv.processMsg(d, {'type': 'waitForGameRequest'}, src)
+    waitDefault = d.waitingBots[src][1] - now
+    nbsrv.processMsg(d, {'type': 'waitForGameRequest', 'maxSecs': 60}, src)
+    waitMax = d.waitingBots[src][1] - now
+    if not (d.conf['waitForGameSecs'] <= waitDefault < d.conf['waitForGameSecs'] + 1 and 20 <= waitMax < 21):
+        log("test 6 failed. held for " + str(waitDefault) + " and " + str(waitMax) + " secs.", "ERROR")
+
+    botSocket.s.close()
+    d.srvSocket.s.close()
+
+
+def testLockstepResends():
+    d = nbsrv.SrvData()
+    d.srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    srvPort = d.srvSocket.s.getsockname()[1]
+    botSocket = nbipc.NetBotSocket('127.0.0.1', 0, '127.0.0.1', srvPort)
+    botPort = botSocket.s.getsockname()[1]
+    d.conf['lockstep'] = True
+    d.conf['botMsgsPerStep'] = 1
+
+    processed = []
+    processMsg = nbsrv.processMsg
+    nbsrv.processMsg = lambda d, msg, src: processed.append(msg['msgID'])
+    try:
+        # msg 2 is over budget so it is held for the next step.
+        nbsrv.recvStepMsgs(d)
+        nbsrv.recvReplyMsgs(d, d.botMsgCount, [({'type': 'getInfoRequest', 'msgID': 1}, '127.0.0.1', botPort),
+                                               ({'type': 'getInfoRequest', 'msgID': 2}, '127.0.0.1', botPort)])
+        # resends of msg 2 while it is held, and after it has been answered, are dropped.
+        botSocket.sendMessage({'type': 'getInfoRequest', 'msgID': 2})
+        d.srvSocket.waitForMessage(1)
+        nbsrv.recvReplyMsgs(d, d.botMsgCount)
+        nbsrv.recvStepMsgs(d)
+        botSocket.sendMessage({'type': 'getInfoRequest', 'msgID': 2})
+        botSocket.sendMessage({'type': 'getInfoRequest', 'msgID': 3})
+        d.srvSocket.waitForMessage(1)
+        time.sleep(0.05)
+        nbsrv.recvReplyMsgs(d, d.botMsgCount)
+    finally:
+        nbsrv.processMsg = processMsg
+
+    if processed != [1, 2] or [msg['msgID'] for msg, ip, port in d.deferredMsgs] != [3]:
+        log("test 1 failed. processed " + str(processed) + " held " + str(d.deferredMsgs), "ERROR")
+
+    botSocket.s.close()
+    d.srvSocket.s.close()
+
+
+def testViewFrames():
+    d = nbsrv.SrvData()
+    d.srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    v1Socket = nbipc.NetBotSocket('127.0.0.1', 0)
+    v2Socket = nbipc.NetBotSocket('127.0.0.1', 0)
+    d.conf['botsInGame'] = 3
+    for i in range(3):
+        nbsrv.processMsg(d, {'type': 'joinRequest', 'name': 'bot' + str(i)}, '127.0.0.1:' + str(i + 1))
+    nbsrv.mkStartLocations(d)
+    nbsrv.initGame(d)
+    for port, version in ((v1Socket.s.getsockname()[1], 1), (v2Socket.s.getsockname()[1], 2)):
+        nbsrv.processMsg(d, {'type': 'addViewerRequest', 'version': version}, nbipc.formatIpPort('127.0.0.1', port))
+
+    def close(viewData, bots):
+        for src, bot in bots.items():
+            for fld in ('x', 'y', 'health', 'currentSpeed', 'currentDirection', 'requestedDirection', 'shellDamage'):
+                if abs(viewData['bots'][src][fld] - bot[fld]) > 0.05:
+                    return False
+            scan = viewData['bots'][src]['last']['scanRequest']
+            if abs(scan['endRadians'] - bot['last']['scanRequest']['endRadians']) > 0.0001:
+                return False
+        return set(viewData['bots']) == set(bots)
+
+    # each viewer gets the version it asked for, and the v2 frame rebuilds to the same state.
+    decoder = nbviewdata.ViewDecoder()
+    nbsrv.sendToViwers(d)
+    v1Msg = v1Socket.recvMessage()[0]
+    frame = v2Socket.recvMessage()[0]
+    viewData = decoder.applyFrame(frame)
+    if v1Msg['type'] != 'viewData' or frame['type'] != 'viewFrame' or not frame['keyframe'] or \
+            not close(viewData, d.bots) or viewData['state']['gameNumber'] != 1:
+        log("test 1 failed. frame " + str(frame), "ERROR")
+
+    # only what changed is in a delta.
+    encoder = d.viewStreams[(2, 1, 0)]['encoder']
+    bot = d.bots['127.0.0.1:2']
+    bot['x'] += 10.01
+    bot['last']['scanRequest'] = {'startRadians': 1, 'endRadians': 1.5}
+    d.shells['127.0.0.1:2'] = {'x': 10, 'y': 20, 'direction': 3, 'distanceRemaining': 50}
+    d.explosions[7] = {'x': 40, 'y': 50, 'stepsAgo': 0, 'src': '127.0.0.1:1'}
+    del d.bots['127.0.0.1:3']
+    frame = encoder.mkFrame(d)
+    viewData = decoder.applyFrame(nbipc.deserialize(nbipc.serialize(frame)))
+    if nbipc.isValidMsg(frame) is not True or frame['keyframe'] or list(frame['bots']) != ['127.0.0.1:2'] or \
+            frame['bots']['127.0.0.1:2'][0] != 12 or frame['goneBots'] != ['127.0.0.1:3'] or not close(viewData, d.bots) or \
+            viewData['shells']['127.0.0.1:2'] != {'x': 10, 'y': 20, 'direction': 3} or \
+            viewData['explosions'] != {7: {'x': 40, 'y': 50, 'src': '127.0.0.1:1'}}:
+        log("test 2 failed. frame " + str(frame) + " viewData " + str(viewData), "ERROR")
+
+    # after a missed frame deltas are skipped until the next keyframe.
+    del d.explosions[7]
+    encoder.mkFrame(d)
+    frame = encoder.mkFrame(d)
+    skipped = decoder.applyFrame(frame)
+    frames = [encoder.mkFrame(d) for i in range(nbviewdata.keyframeEvery)]
+    viewData = [decoder.applyFrame(f) for f in frames]
+    keyAt = [f['keyframe'] for f in frames].index(True)
+    if skipped is not None or frame['goneExplosions'] or viewData[keyAt - 1] is not None or \
+            not close(viewData[keyAt], d.bots) or viewData[keyAt]['explosions'] or not close(viewData[-1], d.bots):
+        log("test 3 failed. keyframe at " + str(keyAt) + " viewData " + str(viewData[keyAt]), "ERROR")
+
+    d.srvSocket.s.close()
+    v1Socket.s.close()
+    v2Socket.s.close()
+
+
+def testViewerCadence():
+    d = nbsrv.SrvData()
+    d.srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    nbsrv.processMsg(d, {'type': 'joinRequest', 'name': 'bot'}, '127.0.0.1:1')
+    sockets = []
+    for msg in ({}, {'everyNSteps': 3}, {'everyNSteps': 3, 'version': 2}, {'everyNSteps': 3, 'version': 2},
+                {'maxFps': 10, 'version': 2}):
+        msg['type'] = 'addViewerRequest'
+        viewerSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+        nbsrv.processMsg(d, msg, nbipc.formatIpPort('127.0.0.1', viewerSocket.s.getsockname()[1]))
+        sockets.append(viewerSocket)
+
+    # each viewer gets its own cadence, and frames are only made for the viewers that are due.
+    startTime = time.time()
+    for i in range(12):
+        nbsrv.sendToViwers(d)
+        time.sleep(0.025)
+    runTime = time.time() - startTime
+    time.sleep(0.05)
+    counts = [len(viewerSocket.recvMessages()) for viewerSocket in sockets]
+    if counts[:4] != [12, 4, 4, 4] or not 2 <= counts[4] <= runTime * 10 + 1 or \
+            d.state['viewerFrames'] != 12 + 4 + counts[4] or len(d.viewStreams) != 4:
+        log("test 1 failed. counts " + str(counts) + " frames " + str(d.state['viewerFrames']), "ERROR")
+
+    # viewers sharing a stream get the same frames, so the deltas work for both. A stream
+    # with no viewers left is dropped.
+    nbsrv.processMsg(d, {'type': 'addViewerRequest', 'everyNSteps': 7}, '127.0.0.1:9')
+    nbsrv.sendToViwers(d)
+    streams = len(d.viewStreams)
+    del d.viewers['127.0.0.1:9']
+    for i in range(3):
+        nbsrv.sendToViwers(d)
+    time.sleep(0.05)
+    frames = sockets[2].recvMessages()
+    if streams != 5 or len(d.viewStreams) != 4 or len(frames) != 1 or frames != sockets[3].recvMessages():
+        log("test 2 failed. streams " + str(d.viewStreams) + " frames " + str(frames), "ERROR")
+
+    d.srvSocket.s.close()
+    for viewerSocket in sockets:
+        viewerSocket.s.close()
+
+
+def testReplay():
+    # play a short game directly against the handlers while writing an input log, then replay it.
+    d = nbsrv.SrvData()
+    d.starts = [[0, 1]]
+    d.startLocs = [{'x': 200, 'y': 200}, {'x': 800, 'y': 800}]
+    d.conf['botsInGame'] = 2
+    random.seed(6)
+
+    filename = os.path.join(tempfile.mkdtemp(), "test.nblog")
+    f = nbinputlog.openInputLog(filename)
+    nbinputlog.writeRecord(f, [nbinputlog.HEADER, {'conf': d.conf, 'starts': d.starts, 'startLocs': d.startLocs,
+                                                   'seed': None, 'backend': 'python'}])
+
+    def send(msg, src):
+        nbsrv.processMsg(d, msg, src)
+        nbinputlog.writeRecord(f, [nbinputlog.MSG, src, msg])
+
+    send({'type': 'joinRequest', 'name': 'a'}, '127.0.0.1:1')
+    send({'type': 'joinRequest', 'name': 'b'}, '127.0.0.1:2')
+    nbsrv.initGame(d)
+    nbinputlog.writeRecord(f, [nbinputlog.INITGAME])
+    for step in range(50):
+        for src in d.bots:
+            send({'type': 'setSpeedRequest', 'requestedSpeed': random.random() * 100}, src)
+            send({'type': 'setDirectionRequest', 'requestedDirection': random.random() * math.pi * 2}, src)
+            send({'type': 'fireCanonRequest', 'direction': random.random() * math.pi * 2, 'distance': 100}, src)
+        nbsrv.step(d)
+        nbinputlog.writeRecord(f, [nbinputlog.STEP, nbinputlog.stateHash(d)])
+    f.close()
+
+    d2, steps, mismatches = nbreplay.replay(filename)
+    if steps != 50 or mismatches:
+        log("test 1 failed. steps: " + str(steps) + " mismatches: " + str(mismatches), "ERROR")
+
+    # any change to bots must change the state hash so replays that don't match are caught.
+    h = nbinputlog.stateHash(d2)
+    d2.bots['127.0.0.1:1']['x'] += 0.000001
+    if nbinputlog.stateHash(d2) == h:
+        log("test 2 failed. state hash did not change.", "ERROR")
+
+
+def testArena():
+    class Robot:
+        def __init__(self):
+            self.calls = 0
+            self.lastRequests = None
+
+        def play(self, replies):
+            if self.calls == 0 and (len(replies) != 1 or replies[0]['type'] != 'joinReply'):
+                log("test 1 failed. first replies: " + str(replies), "ERROR")
+            if self.lastRequests and any(reply['type'] not in ('Error', request['type'].replace('Request', 'Reply'))
+                                         for reply, request in zip(replies, self.lastRequests)):
+                log("test 2 failed. replies " + str(replies) + " don't match requests " + str(self.lastRequests), "ERROR")
+            self.calls += 1
+            self.lastRequests = [{'type': 'getInfoRequest'},
+                                 {'type': 'setSpeedRequest', 'requestedSpeed': 100},
+                                 {'type': 'setDirectionRequest', 'requestedDirection': random.random() * math.pi * 2},
+                                 {'type': 'fireCanonRequest', 'direction': random.random() * math.pi * 2, 'distance': 100}]
+            return self.lastRequests
+
+    arenas = []
+    for i in range(2):
+        arena = nbengine.Arena(seed=1, conf={'stepMax': 200})
+        for j in range(3):
+            arena.addRobot("robot " + str(j), Robot())
+        arenas.append(arena)
+
+    bots = arenas[0].run(games=2)
+    if arenas[0].d.state['gameNumber'] != 2 or arenas[1].d.state['gameNumber'] != 0:
+        log("test 3 failed. games played: " + str(arenas[0].d.state['gameNumber']) + " " +
+            str(arenas[1].d.state['gameNumber']), "ERROR")
+    if any(bot['firedCount'] == 0 for bot in bots.values()):
+        log("test 4 failed. robot requests were not processed: " + str(bots), "ERROR")
+
+    bots = arenas[0].run(games=1)
+    if arenas[0].d.state['gameNumber'] != 3:
+        log("test 5 failed. games played: " + str(arenas[0].d.state['gameNumber']), "ERROR")
+
+    # a held waitForGameRequest keeps its place and the robot isn't called until it is answered.
+    def waiter(replies):
+        if waiterSrc in arena.d.waitingBots:
+            log("test 6 failed. robot called while its waitForGameRequest was held.", "ERROR")
+        if replies and replies[0]['type'] == 'waitForGameReply':
+            waits.append(replies)
+        if any('retryAfter' in reply for reply in replies):
+            return [{'type': 'waitForGameRequest'}, {'type': 'getInfoRequest'}]
+        return [{'type': 'setSpeedRequest', 'requestedSpeed': 0}]
+
+    def killer(replies):
+        # kill waiter part way through each game.
+        if replies[0]['type'] == 'getInfoReply' and replies[0]['gameStep'] == 10:
+            arena.d.bots[waiterSrc]['health'] = 0
+        return [{'type': 'getInfoRequest'}]
+
+    waits = []
+    arena = nbengine.Arena(seed=1, conf={'stepMax': 50})
+    waiterSrc = arena.addRobot("waiter", waiter)
+    arena.addRobot("killer", killer)
+    arena.addRobot("robot", Robot())
+    arena.run(games=3)
+    # the wait in the last game is still held when run() returns.
+    if len(waits) != 2 or any(len(replies) != 2 or replies[1]['type'] != 'getInfoReply' for replies in waits):
+        log("test 7 failed. replies after waiting: " + str(waits), "ERROR")
+
+    # robots that subscribe get a botState after their replies.
+    def subscriber(replies):
+        if replies[0]['type'] == 'joinReply':
+            return [{'type': 'subscribeRequest', 'everyNSteps': 2}]
+        states.append([(reply['type'], reply.get('gameStep')) for reply in replies])
+        return [{'type': 'getInfoRequest'}]
+
+    states = []
+    arena = nbengine.Arena(seed=1, conf={'stepMax': 6})
+    arena.addRobot("subscriber", subscriber)
+    arena.addRobot("robot", Robot())
+    arena.run(games=1)
+    if states[:4] != [[('subscribeReply', None)], [('getInfoReply', 1), ('botState', 2)],
+                      [('getInfoReply', 2)], [('getInfoReply', 3), ('botState', 4)]]:
+        log("test 8 failed. replies " + str(states), "ERROR")
+
+
+def testArenasInThreads():
+    # arenas in threads must not share state, so each must give the same result as when run alone.
+    def robot(seed):
+        r = random.Random(seed)
+        return lambda replies: [{'type': 'setSpeedRequest', 'requestedSpeed': 100},
+                                {'type': 'setDirectionRequest', 'requestedDirection': r.random() * math.pi * 2},
+                                {'type': 'fireCanonRequest', 'direction': r.random() * math.pi * 2, 'distance': 150}]
+
+    def play(seed, results):
+        arena = nbengine.Arena(seed=seed, conf={'stepMax': 300}, obstacles=2)
+        for i in range(4):
+            arena.addRobot("robot " + str(i), robot(seed * 10 + i))
+        bots = arena.run(games=2)
+        results[seed] = [(bot['points'], bot['x'], bot['y'], bot['shellDamage']) for bot in bots.values()]
+
+    alone = {}
+    for seed in range(4):
+        play(seed, alone)
+
+    together = {}
+    threads = [threading.Thread(target=play, args=(seed, together)) for seed in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if alone != together:
+        log("test 1 failed. alone: " + str(alone) + " together: " + str(together), "ERROR")
+
+
+def testPickArena():
+    d = nbsrv.SrvData()
+    d.conf['botsInGame'] = 2
+    d.srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    d.arenas = [{'conn': multiprocessing.Pipe(duplex=False)[1], 'bots': 0} for i in range(3)]
+
+    def pick(port, msg):
+        return nbsrv.pickArena(d, nbipc.serialize(msg), '127.0.0.1', port)
+
+    # bots without an arena fill arenas in order.
+    got = [pick(port, {'type': 'joinRequest', 'name': "bot"}) for port in (1, 2, 3)]
+    if got != [0, 0, 1]:
+        log("test 1 failed. got " + str(got), "ERROR")
+
+    if pick(4, {'type': 'joinRequest', 'name': "bot", 'arena': 2}) != 2 or d.arenas[2]['bots'] != 1:
+        log("test 2 failed. " + str(d.arenas), "ERROR")
+
+    # arena that does not exist, and msgs other than joins, are not forwarded.
+    if pick(5, {'type': 'joinRequest', 'name': "bot", 'arena': 3}) is not None or \
+            pick(6, {'type': 'getInfoRequest'}) is not None:
+        log("test 3 failed.", "ERROR")
+
+    if pick(7, {'type': 'addViewerRequest'}) != 0:
+        log("test 4 failed.", "ERROR")
+
+    expected = {'127.0.0.1:1': 0, '127.0.0.1:2': 0, '127.0.0.1:3': 1, '127.0.0.1:4': 2, '127.0.0.1:7': 0}
+    if d.arenaSrcs != expected:
+        log("test 5 failed. arenaSrcs " + str(d.arenaSrcs), "ERROR")
+
+    if nbsrv.arenaFilename("dir/results.json", 3) != "dir/results-3.json":
+        log("test 6 failed. got " + nbsrv.arenaFilename("dir/results.json", 3), "ERROR")
+
+    # arenas that have ended are skipped.
+    d.arenas[1]['conn'] = None
+    if pick(8, {'type': 'joinRequest', 'name': "bot"}) != 2 or \
+            pick(9, {'type': 'joinRequest', 'name': "bot", 'arena': 1}) is not None:
+        log("test 7 failed. " + str(d.arenas), "ERROR")
+
+
+def testRunArenaGames():
+    # two arenas played by one worker, with msgs forwarded over a pipe each.
+    srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    botSockets = [nbipc.NetBotSocket('127.0.0.1', 0) for i in range(4)]
+    arenas = []
+    conns = []
+    for i in range(2):
+        a = nbsrv.SrvData()
+        a.conf['botsInGame'] = 2
+        a.conf['gamesToPlay'] = 1
+        a.conf['stepMax'] = 10 + i * 10
+        a.conf['stepSec'] = 0.002
+        a.conf['dropRate'] = 0
+        a.state['onlyLastSb'] = True
+        nbsrv.mkStartLocations(a)
+        recvConn, sendConn = multiprocessing.Pipe(duplex=False)
+        a.srvSocket = nbipc.SharedNetBotSocket(srvSocket.s, recvConn)
+        arenas.append(a)
+        conns.append(sendConn)
+
+    # a SharedNetBotSocket has everything a NetBotSocket has.
+    a.srvSocket.addRTT('a', 0.1)
+    if round(a.srvSocket.getRTO('a'), 8) != 0.3 or a.srvSocket.recvBotState() is not None:
+        log("test 1 failed. rtt " + str(a.srvSocket.rtt), "ERROR")
+
+    for i, botSocket in enumerate(botSockets):
+        msgBytes = nbipc.serialize({'type': 'joinRequest', 'name': 'bot' + str(i)})
+        conns[i // 2].send((msgBytes, '127.0.0.1', botSocket.s.getsockname()[1]))
+
+    playing = list(arenas)
+    nbsrv.runArenaGames(playing)
+    if playing or [a.state['gameNumber'] for a in arenas] != [1, 1] or \
+            [a.state['serverSteps'] for a in arenas] != [10, 20]:
+        log("test 2 failed. " + str([a.state for a in arenas]), "ERROR")
+    for botSocket in botSockets:
+        msgs = botSocket.recvMessages()
+        if len(msgs) != 1 or msgs[0][0]['type'] != 'joinReply':
+            log("test 3 failed. got " + str(msgs), "ERROR")
+
+    # an arena that has ended closes its pipe. The router then drops its srcs rather than filling
+    # the pipe and blocking, and the arenas still playing get their msgs.
+    d = nbsrv.SrvData()
+    d.srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    routerPort = d.srvSocket.s.getsockname()[1]
+    recvConn, sendConn = multiprocessing.Pipe(duplex=False)
+    d.arenas = [{'conn': conns[0], 'bots': 2}, {'conn': sendConn, 'bots': 1}]
+    srcs = [nbipc.formatIpPort('127.0.0.1', botSocket.s.getsockname()[1]) for botSocket in botSockets[1:3]]
+    d.arenaSrcs = {srcs[0]: 0, srcs[1]: 1}
+    for i in range(20):
+        for j in range(50):
+            botSockets[1].sendMessage({'type': 'getInfoRequest', 'replyData': 'x' * 500}, '127.0.0.1', routerPort)
+        nbsrv.routeMsgs(d)
+    botSockets[2].sendMessage({'type': 'getInfoRequest'}, '127.0.0.1', routerPort)
+    d.srvSocket.waitForMessage(1)
+    nbsrv.routeMsgs(d)
+    if d.arenas[0]['conn'] is not None or d.arenaSrcs != {srcs[1]: 1} or not recvConn.poll(1) or \
+            recvConn.recv()[2] != botSockets[2].s.getsockname()[1]:
+        log("test 4 failed. arenas " + str(d.arenas) + " arenaSrcs " + str(d.arenaSrcs), "ERROR")
+
+    for botSocket in botSockets:
+        botSocket.s.close()
+    srvSocket.s.close()
+    d.srvSocket.s.close()
+
+
+def testIsValidMsg():
+    valid = [
+        {'type': 'getInfoRequest'},
+        {'type': 'getInfoRequest', 'msgID': 5, 'replyData': [1, 2]},
+        {'type': 'joinRequest', 'name': "bot", 'class': "heavy"},
+        {'type': 'setSpeedRequest', 'requestedSpeed': 100},
+        {'type': 'scanRequest', 'startRadians': 0, 'endRadians': 6.2},
+        {'type': 'getCanonReply', 'shellInProgress': True},
+        {'type': 'multiScanRequest', 'slices': [[0, 1]] * 16},
+        {'type': 'batchRequest', 'requests': [{'type': 'getInfoRequest'}, {'type': 'setSpeedRequest', 'requestedSpeed': 5}]},
+        {'type': 'batchReply', 'replies': [{'type': 'setSpeedReply'}, {'type': 'Error', 'result': "dead"}]},
+        {'type': 'viewData', 'state': {}, 'bots': {}, 'shells': {}, 'explosions': {}},
+        ]
+    invalid = [
+        ['getInfoRequest'],
+        {'name': "bot"},
+        {'type': 'noSuchRequest'},
+        {'type': ['getInfoRequest']},
+        {'type': 'joinRequest'},  # missing required field
+        {'type': 'joinRequest', 'name': ""},  # str too short
+        {'type': 'joinRequest', 'name': "bot", 'class_o': "heavy"},  # optional field with '_o' suffix
+        {'type': 'getInfoRequest', 'extra': 1},
+        {'type': 'setSpeedRequest', 'requestedSpeed': 101},  # out of range
+        {'type': 'setSpeedRequest', 'requestedSpeed': "100"},  # wrong type
+        {'type': 'getCanonReply', 'shellInProgress': 1},
+        {'type': 'multiScanRequest', 'slices': [[0, 1]] * 17},  # list too long
+        {'type': 'batchRequest', 'requests': []},
+        {'type': 'batchRequest', 'requests': [{'type': 'setSpeedRequest'}]},  # sub-request is not valid
+        {'type': 'batchRequest', 'requests': [{'type': 'joinRequest', 'name': "bot"}]},  # can't be batched
+        {'type': 'batchRequest', 'requests': [{'type': 'batchRequest', 'requests': [{'type': 'getInfoRequest'}]}]},
+        {'type': 'batchRequest', 'requests': [{'type': 'getInfoReply', 'gameNumber': 1, 'gameStep': 1,
+                                               'health': 1, 'points': 1}]},
+        {'type': 'batchReply', 'replies': [{'type': 'joinReply', 'conf': {}}]},
+        {'type': 'batchRequest', 'requests': [{'type': 'waitForGameRequest'}]},  # has no reply to batch
+        ]
+
+    # invalid msgs log errors so catch them rather than print them.
+    logged = []
+    nbipc.log = lambda msg, level="INFO", *args: logged.append(level)
+    try:
+        for msg in valid:
+            if not nbipc.isValidMsg(msg):
+                logged.append("valid msg failed: " + str(msg))
+        for msg in invalid:
+            before = len(logged)
+            if nbipc.isValidMsg(msg):
+                logged.append("invalid msg passed: " + str(msg))
+            elif len(logged) == before:
+                logged.append("invalid msg logged nothing: " + str(msg))
+    finally:
+        nbipc.log = log
+
+    problems = [entry for entry in logged if entry not in ("ERROR", "WARNING")]
+    if problems:
+        log("test 1 failed. " + str(problems), "ERROR")
+
+
+def testStructCodec():
+    msgs = [
+        {'type': 'getInfoRequest', 'msgID': 0},
+        {'type': 'getInfoReply', 'gameNumber': 3, 'gameStep': 999, 'health': 12.345, 'points': 20, 'msgID': 65000},
+        {'type': 'getLocationReply', 'x': 123.456789, 'y': 0.1, 'msgID': 7},
+        {'type': 'setSpeedRequest', 'requestedSpeed': 50.5, 'msgID': 8},
+        {'type': 'scanRequest', 'startRadians': 0.1, 'endRadians': 6.2, 'msgID': 9},
+        {'type': 'fireCanonRequest', 'direction': 1.5, 'distance': 300.25, 'msgID': 10},
+        ]
+    for msg in msgs:
+        b = nbipc.serializeStruct(msg)
+        if b is None or b[0] != nbipc.STRUCT_MARKER or nbipc.deserialize(b) != msg:
+            log("test 1 failed. msg " + str(msg) + " bytes " + str(b), "ERROR")
+
+    # msgs the layout can't hold fall back to msgpack
+    for msg in [{'type': 'getInfoRequest'},
+                {'type': 'getInfoRequest', 'msgID': 1, 'replyData': "x"},
+                {'type': 'getInfoRequest', 'msgID': 70000},
+                {'type': 'getInfoReply', 'gameNumber': 3, 'gameStep': 9, 'health': 1, 'points': 2.5, 'msgID': 1},
+                {'type': 'Error', 'result': "no", 'msgID': 1}]:
+        if nbipc.serializeStruct(msg) is not None:
+            log("test 2 failed. msg " + str(msg), "ERROR")
+
+    # negotiate the codec over real sockets, then check which format goes over the wire.
+    srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    srvPort = srvSocket.s.getsockname()[1]
+    for codec, expectStruct in (('struct', True), ('msgpack', False)):
+        d = nbsrv.SrvData()
+        botSocket = nbipc.NetBotSocket('127.0.0.1', 0, '127.0.0.1', srvPort)
+        botSocket.sendMessage({'type': 'joinRequest', 'name': "bot", 'codec': codec, 'msgID': 1})
+        srvSocket.waitForMessage(1)
+        msg, ip, port = srvSocket.recvMessage()
+        srvSocket.sendMessage(nbsrv.processMsg(d, msg, nbipc.formatIpPort(ip, port)), ip, port)
+        botSocket.waitForMessage(1)
+        joinReply, ip, port = botSocket.recvMessage()
+        if (joinReply.get('codec') == 'struct') != expectStruct:
+            log("test 3 failed. codec " + codec + " joinReply " + str(joinReply), "ERROR")
+
+        botSocket.sendMessage({'type': 'getInfoRequest', 'msgID': 2})
+        srvSocket.waitForMessage(1)
+        b, ip, port = srvSocket.recvBytes()
+        if (b[0] == nbipc.STRUCT_MARKER) != expectStruct:
+            log("test 4 failed. codec " + codec + " sent " + str(b), "ERROR")
+        botSocket.s.close()
+    srvSocket.s.close()
+
+
+def testRecvMessages():
+    srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    srvPort = srvSocket.s.getsockname()[1]
+    botSocket = nbipc.NetBotSocket('127.0.0.1', 0, '127.0.0.1', srvPort)
+
+    if srvSocket.recvMessages() != []:
+        log("test 1 failed. empty buffer did not return []", "ERROR")
+
+    sent = [{'type': 'getInfoRequest', 'msgID': i} for i in range(5)]
+    for msg in sent[:2]:
+        botSocket.sendMessage(msg)
+    # invalid msgs are skipped rather than ending the batch.
+    botSocket.s.sendto(nbipc.serialize({'type': 'noSuchRequest'}), ('127.0.0.1', srvPort))
+    botSocket.s.sendto(b'\xc1\xff', ('127.0.0.1', srvPort))
+    for msg in sent[2:]:
+        botSocket.sendMessage(msg)
+    srvSocket.waitForMessage(1)
+    time.sleep(0.05)
+
+    logged = []
+    nbipc.log = lambda msg, level="INFO", *args: logged.append(level)
+    try:
+        got = srvSocket.recvMessages(4) + srvSocket.recvMessages(4)
+    finally:
+        nbipc.log = log
+
+    if [msg for msg, ip, port in got] != sent or logged.count("ERROR") != 2:
+        log("test 2 failed. got " + str(got) + " logged " + str(logged), "ERROR")
+    if got and nbipc.formatIpPort(got[0][1], got[0][2]) != nbipc.formatIpPort('127.0.0.1', botSocket.s.getsockname()[1]):
+        log("test 3 failed. got " + str(got[0]), "ERROR")
+    botSocket.s.close()
+    srvSocket.s.close()
+
+
+def testSendMessages():
+    srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    botSockets = [nbipc.NetBotSocket('127.0.0.1', 0) for i in range(2)]
+    ports = [b.s.getsockname()[1] for b in botSockets]
+
+    replies = [({'type': 'setSpeedReply', 'msgID': 1}, '127.0.0.1', ports[0]),
+               ({'type': 'getInfoReply', 'gameNumber': 1, 'gameStep': 2, 'health': 100, 'points': 0, 'msgID': 2},
+                '127.0.0.1', ports[1]),
+               ({'type': 'setSpeedReply', 'msgID': 3}, '127.0.0.1', 0),  # can't be sent
+               ({'type': 'setSpeedReply', 'msgID': 4}, '127.0.0.1', ports[0])]
+    logged = []
+    nbipc.log = lambda msg, level="INFO", *args: logged.append(level)
+    try:
+        srvSocket.sendMessages(replies)
+    finally:
+        nbipc.log = log
+
+    got = []
+    for b in botSockets:
+        b.waitForMessage(1)
+        time.sleep(0.05)
+        got.append([msg['msgID'] for msg, ip, port in b.recvMessages()])
+    if got != [[1, 4], [2]] or logged.count("ERROR") != 1:
+        log("test 1 failed. got " + str(got) + " logged " + str(logged), "ERROR")
+
+    dest = nbipc.formatIpPort('127.0.0.1', ports[0])
+    if srvSocket.sent.get(dest) != 2 or srvSocket.sendTypes[dest] != {'setSpeedReply': 2}:
+        log("test 2 failed. sent " + str(srvSocket.sent) + " sendTypes " + str(srvSocket.sendTypes), "ERROR")
+
+    for b in botSockets:
+        b.s.close()
+    srvSocket.s.close()
+
+
+def testAsyncNetBotSocket():
+    srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    srvPort = srvSocket.s.getsockname()[1]
+    botSocket = nbipc.AsyncNetBotSocket('127.0.0.1', 0, '127.0.0.1', srvPort)
+    botSocket.setDelay(0.05)
+
+    # Reply to all 4 requests at once, in reverse order, and only after the dropped one is resent.
+    def serve():
+        requests = {}
+        dropped = False
+        endTime = time.perf_counter() + 5
+        while len(requests) < 4 and time.perf_counter() < endTime:
+            srvSocket.waitForMessage(0.1)
+            for msg, ip, port in srvSocket.recvMessages():
+                if msg['type'] == 'getSpeedRequest' and not dropped:
+                    dropped = True
+                    continue
+                requests[msg['msgID']] = (msg, ip, port)
+        for msg, ip, port in reversed(list(requests.values())):
+            reply = {'type': msg['type'][:-7] + 'Reply', 'msgID': msg['msgID']}
+            if msg['type'] == 'getLocationRequest':
+                reply.update({'x': 1, 'y': 2})
+            elif msg['type'] == 'getSpeedRequest':
+                reply.update({'requestedSpeed': 3, 'currentSpeed': 4})
+            elif msg['type'] == 'getDirectionRequest':
+                reply.update({'requestedDirection': 0, 'currentDirection': 0})
+            else:
+                reply = {'type': 'Error', 'result': 'test error', 'msgID': msg['msgID']}
+            srvSocket.sendMessage(reply, ip, port)
+            # a second copy of the same reply must be ignored.
+            srvSocket.sendMessage(reply, ip, port)
+
+    async def requestAll():
+        return await asyncio.gather(
+            botSocket.sendRecvMessage({'type': 'getLocationRequest'}),
+            botSocket.sendRecvMessage({'type': 'getSpeedRequest'}),
+            botSocket.sendRecvMessage({'type': 'getDirectionRequest'}),
+            botSocket.sendRecvMessage({'type': 'setSpeedRequest', 'requestedSpeed': 50}),
+            return_exceptions=True)
+
+    srvThread = threading.Thread(target=serve)
+    srvThread.start()
+    try:
+        got = asyncio.run(requestAll())
+    finally:
+        srvThread.join()
+        botSocket.close()
+        srvSocket.s.close()
+
+    if got[:3] != [{'type': 'getLocationReply', 'x': 1, 'y': 2},
+                   {'type': 'getSpeedReply', 'requestedSpeed': 3, 'currentSpeed': 4},
+                   {'type': 'getDirectionReply', 'requestedDirection': 0, 'currentDirection': 0}]:
+        log("test 1 failed. got " + str(got), "ERROR")
+    if not isinstance(got[3], nbipc.NetBotSocketException):
+        log("test 2 failed. Error reply did not raise exception. got " + str(got[3]), "ERROR")
+    if botSocket.sendRecvMessageResends < 1 or botSocket.pending:
+        log("test 3 failed. resends " + str(botSocket.sendRecvMessageResends) +
+            " pending " + str(botSocket.pending), "ERROR")
+
+
+def testRetransmitTimeout():
+    botSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    if botSocket.getRTO('a') != botSocket.sendrecvDelay:
+        log("test 1 failed. RTO before any RTT measured: " + str(botSocket.getRTO('a')), "ERROR")
+
+    botSocket.addRTT('a', 0.1)
+    botSocket.addRTT('a', 0.1)
+    botSocket.addRTT('b', 100)
+    botSocket.addRTT('c', 0.001)
+    if [round(v, 8) for v in botSocket.rtt['a']] != [0.1, 0.0375, 0.25] or botSocket.getRTO('b') != nbipc.maxRTO or \
+            botSocket.getRTO('c') != nbipc.minRTO:
+        log("test 2 failed. rtt " + str(botSocket.rtt), "ERROR")
+
+    # a backed off RTO is kept, even before any RTT is measured, until the next RTT is measured.
+    botSocket.backOffRTO('d', 0.4)
+    botSocket.backOffRTO('a', 0.5)
+    botSocket.backOffRTO('b', 10)
+    rto = [botSocket.getRTO('d'), botSocket.getRTO('a'), botSocket.getRTO('b')]
+    botSocket.addRTT('d', 0.001)
+    botSocket.addRTT('a', 0.1)
+    if rto != [0.4, 0.5, nbipc.maxRTO] or botSocket.getRTO('d') != nbipc.minRTO or round(botSocket.getRTO('a'), 8) != 0.2125:
+        log("test 3 failed. rto " + str(rto) + " rtt " + str(botSocket.rtt), "ERROR")
+    botSocket.s.close()
+
+    # replies to requests that were resent are not measured.
+    srvSocket = nbipc.NetBotSocket('127.0.0.1', 0)
+    srvPort = srvSocket.s.getsockname()[1]
+    botSocket = nbipc.NetBotSocket('127.0.0.1', 0, '127.0.0.1', srvPort)
+    botSocket.setDelay(0.05)
+
+    def serve():
+        for i in range(5):
+            srvSocket.waitForMessage(1)
+            msg, ip, port = srvSocket.recvMessage()
+            if i == 2:
+                continue  # drop this one so it is resent
+            srvSocket.sendMessage({'type': 'setSpeedReply', 'msgID': msg['msgID']}, ip, port)
+
+    srvThread = threading.Thread(target=serve)
+    srvThread.start()
+    dest = nbipc.formatIpPort('127.0.0.1', srvPort)
+    rto = []
+    try:
+        for i in range(4):
+            botSocket.sendRecvMessage({'type': 'setSpeedRequest', 'requestedSpeed': 1})
+            rto.append(botSocket.getRTO(dest))
+    finally:
+        srvThread.join()
+
+    # RTO never goes below minRTO. After the resend it stays doubled until the next RTT is measured.
+    if botSocket.rttStats[dest]['count'] != 3 or botSocket.sendRecvMessageResends != 1 or \
+            rto != [nbipc.minRTO, nbipc.minRTO, nbipc.minRTO * 2, nbipc.minRTO] or \
+            "Round Trip Times" not in botSocket.getStats():
+        log("test 4 failed. rttStats " + str(botSocket.rttStats) + " rtt " + str(botSocket.rtt) + " rto " + str(rto), "ERROR")
+    botSocket.s.close()
+    srvSocket.s.close()
+
+
+def testShmNetBotSocket():
+    # ring keeps msgs in order across the wrap around and refuses msgs that don't fit.
+    ring = nbipc.ShmRing(bytearray(nbipc.shmRingHeaderSize + 64), 0, 64)
+    sent = []
+    got = []
+    for i in range(20):
+        b = bytes([i]) * (i % 7 + 1)
+        if ring.write(b):
+            sent.append(b)
+        else:
+            got.append(ring.read())
+    while not ring.isEmpty():
+        got.append(ring.read())
+    if got != sent or ring.read() is not None or ring.write(bytes(61)) or len(sent) < 12:
+        log("test 1 failed. sent " + str(sent) + " got " + str(got), "ERROR")
+
+    # a bad length prefix, past the msgs written or bigger than the ring, empties the ring
+    # rather than moving tail past head.
+    logged = []
+    nbipc.log = lambda msg, level="INFO", *args: logged.append(level)
+    try:
+        for badLen in (40, 1000):
+            ring.write(b'abc')
+            head, tail, sleeping = nbipc.shmRingHeader.unpack_from(ring.buf, ring.header)
+            ring.buf[ring.data + tail % ring.size:ring.data + tail % ring.size + 4] = badLen.to_bytes(4, 'little')
+            if ring.read() is not None or not ring.isEmpty() or not ring.write(b'def') or ring.read() != b'def':
+                log("test 2 failed. ring was not reset after bad length " + str(badLen), "ERROR")
+    finally:
+        nbipc.log = log
+    if logged != ["ERROR", "ERROR"]:
+        log("test 2 failed. logged " + str(logged), "ERROR")
+
+    # bot joins a -shm server, then msgs go through shared memory both ways.
+    d = nbsrv.SrvData()
+    d.state['shm'] = True
+    srvSocket = nbipc.ShmNetBotSocket('127.0.0.1', 0)
+    srvPort = srvSocket.s.getsockname()[1]
+    botSocket = nbipc.ShmNetBotSocket('127.0.0.1', 0, '127.0.0.1', srvPort)
+
+    def serve():
+        count = 0
+        while count < 4 and srvSocket.waitForMessage(2):
+            for msg, ip, port in srvSocket.recvMessages():
+                reply = nbsrv.processMsg(d, msg, nbipc.formatIpPort(ip, port))
+                srvSocket.sendMessage(reply, ip, port)
+                count += 1
+
+    srvThread = threading.Thread(target=serve)
+    srvThread.start()
+    try:
+        joinReply = botSocket.sendRecvMessage({'type': 'joinRequest', 'name': 'shm bot', 'codec': 'struct'})
+        replies = [botSocket.sendRecvMessage({'type': 'getInfoRequest'}) for i in range(3)]
+    finally:
+        srvThread.join()
+
+    if joinReply.get('shm') != nbipc.shmName(botSocket.s.getsockname()[1]) or len(srvSocket.links) != 1 or \
+            replies[2]['type'] != 'getInfoReply' or botSocket.shmSent != 3 or srvSocket.shmSent != 4:
+        log("test 3 failed. joinReply " + str(joinReply) + " replies " + str(replies) +
+            " sent " + str((botSocket.shmSent, srvSocket.shmSent)), "ERROR")
+    srvSocket.close()
+    botSocket.close()
+
+    # a server without -shm leaves the bot on UDP.
+    d = nbsrv.SrvData()
+    srvSocket = nbipc.ShmNetBotSocket('127.0.0.1', 0)
+    srvPort = srvSocket.s.getsockname()[1]
+    botSocket = nbipc.ShmNetBotSocket('127.0.0.1', 0, '127.0.0.1', srvPort)
+    srvThread = threading.Thread(target=serve)
+    srvThread.start()
+    try:
+        joinReply = botSocket.sendRecvMessage({'type': 'joinRequest', 'name': 'udp bot'})
+        for i in range(3):
+            botSocket.sendRecvMessage({'type': 'getInfoRequest'})
+    finally:
+        srvThread.join()
+
+    if 'shm' in joinReply or srvSocket.links or botSocket.shmSent != 0 or srvSocket.shmSent != 0:
+        log("test 4 failed. joinReply " + str(joinReply) + " links " + str(srvSocket.links), "ERROR")
+    srvSocket.close()
+    botSocket.close()
+
+    # the server only maps segments made by shmName() for the bot's port, from loopback, that are big enough.
+    srvSocket = nbipc.ShmNetBotSocket('127.0.0.1', 0)
+    other = shared_memory.SharedMemory(name="netbots_test_other", create=True, size=nbipc.shmSize)
+    small = shared_memory.SharedMemory(name=nbipc.shmName(20001), create=True, size=64)
+    good = shared_memory.SharedMemory(name=nbipc.shmName(20002), create=True, size=nbipc.shmSize)
+    offers = [
+        ("netbots_test_other", '127.0.0.1:20003'),  # not made by shmName()
+        (nbipc.shmName(20002), '127.0.0.1:20003'),  # made for another port
+        (nbipc.shmName(20002), '10.0.0.1:20002'),  # not on this computer
+        (nbipc.shmName(20001), '127.0.0.1:20001'),  # too small
+        ]
+    for name, dest in offers:
+        msg = {'type': 'joinReply', 'conf': {}, 'shm': name}
+        srvSocket.encodeMessage(msg, dest)
+        if 'shm' in msg or srvSocket.links or any(other.buf):
+            log("test 5 failed. server used shared memory " + name + " offered by " + dest, "ERROR")
+    msg = {'type': 'joinReply', 'conf': {}, 'shm': nbipc.shmName(20002)}
+    srvSocket.encodeMessage(msg, '127.0.0.1:20002')
+    if msg.get('shm') != nbipc.shmName(20002) or list(srvSocket.links) != ['127.0.0.1:20002']:
+        log("test 6 failed. server did not use shared memory " + nbipc.shmName(20002), "ERROR")
+    srvSocket.close()
+    for shm in (other, small, good):
+        shm.close()
+        shm.unlink()
+
+
+def testNumpyBackend():
+    if not nbnumpy.available():
+        log("numpy not installed. Skipping numpy backend test.")
+        return
+
+    d = nbsrv.SrvData()
+    d.conf['allowClasses'] = True
+    d.random.seed(3)
+    d.conf['obstacles'] = nbsrv.mkObstacles(d, 3)
+    random.seed(3)
+    bots = {}
+    for i in range(50):
+        bot = copy.deepcopy(d.botTemplate)
+        bot['health'] = random.choice([0, 50, 100])
+        bot['class'] = random.choice(list(d.conf['classes']))
+        bot['x'] = random.random() * d.conf['arenaSize']
+        bot['y'] = random.random() * d.conf['arenaSize']
+        bot['currentSpeed'] = random.choice([0, 50, 100])
+        bot['requestedSpeed'] = random.choice([0, 50, 100])
+        bot['currentDirection'] = random.random() * math.pi * 2
+        bot['requestedDirection'] = random.random() * math.pi * 2
+        bots[i] = bot
+    shells = {}
+    for i in range(0, 50, 5):
+        shells[i] = {'x': bots[i]['x'], 'y': bots[i]['y'], 'direction': random.random() * math.pi * 2,
+                     'distanceRemaining': random.random() * 100}
+    msgs = []
+    for step in range(20):
+        msgs.append([(random.randrange(50), random.choice([
+            {'type': 'getLocationRequest'},
+            {'type': 'getSpeedRequest'},
+            {'type': 'setSpeedRequest', 'requestedSpeed': random.choice([0, 50, 100])},
+            {'type': 'setDirectionRequest', 'requestedDirection': random.random() * math.pi * 2}]))
+            for i in range(10)])
+
+    result = {}
+    replies = {}
+    for backend in ['python', 'numpy']:
+        d.state['backend'] = backend
+        d.bots = copy.deepcopy(bots)
+        d.shells = copy.deepcopy(shells)
+        d.explosions = {}
+        replies[backend] = []
+        for step in range(20):
+            nbsrv.step(d)
+            # replies read the bot dicts so the numpy backend must have copied the arrays to them first.
+            for src, msg in msgs[step]:
+                replies[backend].append(nbsrv.processMsg(d, msg, src))
+        d.syncBots()
+        result[backend] = d.bots
+
+    for i in bots:
+        for fld in ['x', 'y', 'health', 'currentSpeed', 'currentDirection', 'requestedSpeed', 'shellDamage']:
+            if not math.isclose(result['python'][i][fld], result['numpy'][i][fld], rel_tol=1e-9, abs_tol=1e-9):
+                log("test 1 failed. bot " + str(i) + " " + fld + " python: " + str(result['python'][i][fld]) +
+                    " numpy: " + str(result['numpy'][i][fld]), "ERROR")
+                break
+
+    for pyReply, npReply in zip(replies['python'], replies['numpy']):
+        for fld in pyReply:
+            if isinstance(pyReply[fld], float) and math.isclose(pyReply[fld], npReply[fld], rel_tol=1e-9, abs_tol=1e-9):
+                continue
+            if pyReply[fld] != npReply[fld]:
+                log("test 2 failed. python reply " + str(pyReply) + " numpy reply " + str(npReply), "ERROR")
+                break
+
+
 def main():
     testHitSeverity()
+    testFindOverlapingBots()
+    testStepSeparatesBots()
+    testObstacleGrid()
+    testScanRequest()
+    testBatchRequest()
+    testSubscribeRequest()
+    testWaitForGameRequest()
+    testLockstepResends()
+    testViewFrames()
+    testViewerCadence()
+    testReplay()
+    testArena()
+    testArenasInThreads()
+    testPickArena()
+    testRunArenaGames()
+    testIsValidMsg()
+    testStructCodec()
+    testRecvMessages()
+    testSendMessages()
+    testAsyncNetBotSocket()
+    testRetransmitTimeout()
+    testShmNetBotSocket()
+    testNumpyBackend()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file